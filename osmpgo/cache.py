@@ -0,0 +1,118 @@
+import glob
+import hashlib
+import os
+import shutil
+import numpy as np
+import shapely
+
+# Bytes read from the start and the end of an input file for its fingerprint
+SAMPLE_SIZE = 1024 * 1024
+
+
+def fingerprint(path: str) -> str:
+    """
+    Content fingerprint of an OSM file from its size and its first and last megabyte, a copy of the file has the same
+    fingerprint and an updated file a new one as the header and the last blocks change
+    """
+    digest = hashlib.sha256()
+    size = os.path.getsize(path)
+    digest.update(str(size).encode())
+    with open(path, 'rb') as osm_file:
+        digest.update(osm_file.read(SAMPLE_SIZE))
+        if size > SAMPLE_SIZE:
+            osm_file.seek(max(SAMPLE_SIZE, size - SAMPLE_SIZE))
+            digest.update(osm_file.read(SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
+class ExtractCache:
+    """
+    Folder of extracted OSM.XML and .o5m files named by the hash of the input fingerprint, the normalized clip
+    geometry and the options of the extract, with the extension of the output. A hit is hardlinked to the output, or
+    copied when the folder is on another drive. The folder is kept under max_size by removing the least recently used
+    files, a hit counts as a use.
+    """
+
+    def __init__(self, folder: str, max_size: int):
+        self.folder = folder
+        self.max_size = max_size
+        self.fingerprints = {}
+        os.makedirs(folder, exist_ok=True)
+
+    def key(self, inputs: str, geometry: np.ndarray = None, options: str = '') -> str:
+        """
+        Cache key of an extract
+        Args:
+            inputs: OSM File
+            geometry: Clip polygons or bbox box of the extract, None for the whole file
+            options: Any other setting that changes the output, like the osmconvert options
+
+        Returns:
+            The return value is a hex digest
+        """
+        if inputs not in self.fingerprints:
+            self.fingerprints[inputs] = fingerprint(inputs)
+        digest = hashlib.sha256(self.fingerprints[inputs].encode())
+        if geometry is not None:
+            # Same shapes with other ring start points, ring directions or part order give the same key
+            digest.update(shapely.to_wkb(shapely.normalize(shapely.geometrycollections(geometry)), output_dimension=2))
+        digest.update(options.encode())
+        return digest.hexdigest()
+
+    def path(self, key: str, output: str) -> str:
+        return os.path.join(self.folder, f'{key}{extension(output)}')
+
+    def get(self, key: str, output: str) -> bool:
+        """
+        Link the cached extract to the output, replacing an existing output. On a miss the output is left alone, the
+        new extract replaces it rather than write through a hardlink into the cache
+        Returns:
+            The return value is True for a hit
+        """
+        path = self.path(key, output)
+        if not os.path.exists(path):
+            return False
+        # Renaming a link over another link of the same file does nothing, the output is already the extract
+        if not (os.path.exists(output) and os.path.samefile(path, output)):
+            link(path, output + '.tmp')
+            os.replace(output + '.tmp', output)
+        os.utime(path)
+        return True
+
+    def put(self, key: str, output: str) -> None:
+        """
+        Add an extracted OSM.XML or .o5m to the cache and remove the least recently used files over max_size
+        """
+        if not os.path.exists(output) or os.path.getsize(output) > self.max_size:
+            return
+        path = self.path(key, output)
+        link(output, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self.evict()
+
+    def evict(self) -> None:
+        entries = sorted((os.stat(path).st_mtime, os.path.getsize(path), path)
+                         for path in glob.glob(os.path.join(self.folder, '*.*')) if not path.endswith('.tmp'))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+
+
+def extension(path: str) -> str:
+    """
+    Extension of an extract, the .osm of .osm.xml and .osm.pbf is part of it
+    """
+    root, ext = os.path.splitext(os.path.basename(path))
+    if os.path.splitext(root)[1].lower() == '.osm':
+        ext = os.path.splitext(root)[1] + ext
+    return ext.lower()
+
+
+def link(source: str, target: str) -> None:
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
@@ -1,226 +1,433 @@
-import os
-import sys
-import click
-from osmpgo.extract_osmxml import write_poly, write_osm
-from osmpgo.export_osmxml import ReadOSM, ProcessOSM
-from osmpgo.util import combine_gpkg, timer
-import time
-
-
-@click.group()
-def cli():
-    pass
-
-
-# noinspection SpellCheckingInspection
-@cli.command('export', short_help='Export OSM.XML to gpkg')
-@click.argument('inputs', type=click.Path(exists=True))
-@click.argument('output', type=click.Path())
-@click.argument('prefix', type=str)
-@click.option('-t', '--theme', type=str, help='Individual themes in a comma separated list.')
-@click.option('-f', '--feature', type=str, help='Feature type point,line,polygon')
-@click.option('-w', '--workers', type=int, default=3, show_default=True, help='Number of workers')
-@click.option('-m', '--mem_factor', type=int, default=4, show_default=True, help='memory factor for node filesize')
-def export(inputs, output, prefix, theme, feature, workers, mem_factor):
-    # noinspection SpellCheckingInspection
-    """
-
-        INPUTS is the name of the OSM.XML file
-
-        OUTPUT is the name of the output folder
-
-        PREFIX is the name added to the front of the export
-
-        Theme options include:
-
-        aerialway,aeroway,amenity,barrier,boundary,building,craft,emergency,geological,
-        highway,historic,landuse,leisure,man_made,military,natural,office
-        ,place,power,public_transport,railway,route,shop,sport,tourism ,waterway
-
-        Example:
-
-        osmgo export andorra-latest.osm.xml output andorra -w 8 -m 16
-
-        osmgo export andorra-latest.osm.xml  output andorra -t highway -f line
-
-        osmgo export andorra-latest.osm.xml  output andorra -t highway,building -f point,line
-        """
-    begin_time = time.time()
-    print(f'Input XML: {inputs}')
-    print(f'Output folder: {output}')
-    print(f'Output prefix: {prefix}')
-
-    print(f'Workers: {workers}')
-
-    _themes = ['aerialway', 'aeroway', 'amenity', 'boundary', 'building', 'craft', 'emergency', 'geological',
-               'highway', 'historic', 'landuse', 'leisure', 'natural', 'office', 'place', 'power', 'public_transport',
-               'railway', 'route', 'shop', 'tourism', 'waterway']
-
-    if theme is None:
-        themes = _themes
-    else:
-        themes = []
-        for each in theme.split(','):
-            each = each.strip()
-            if each in _themes:
-                themes.append(each)
-            else:
-                print(f'Theme {each} is misspelled or missing')
-                exit()
-    print('Processing the following themes {}'.format(','.join(themes)))
-
-    _features = ['point', 'line', 'polygon']
-
-    if feature is None:
-        features = _features
-    else:
-        features = []
-        for each in feature.split(','):
-            each = each.strip()
-            if each in _features:
-                features.append(each)
-            else:
-                print(f'Feature {each} is misspelled or missing')
-                exit()
-    print('Processing the following features {}'.format(','.join(features)))
-
-    input_folder = True
-    while input_folder and not os.path.exists(output):
-        val = input('Create new folder (Y/N)')
-        if val.lower() == 'y' or val.lower() == 'n':
-            if not os.path.exists(output) and val.lower() == 'y':
-                os.mkdir(output)
-                print(f'Created folder: {output}')
-            elif os.path.exists(output) and val.lower() == 'y' or os.path.exists(output) and val.lower() == 'n':
-                print(f'Folder: {output} exists')
-            else:
-                print(f'You need to create the folder: {output} because you selected N')
-                exit()
-            input_folder = False
-        else:
-            print(f'Your entry: {val} is not valid (Y/N)')
-
-    print('Keep on Trucking')
-
-    rosm = ReadOSM(inputs, themes, features, mem_factor)
-    rosm.readxml()
-
-    posm = ProcessOSM(themes, features, workers, rosm.tempf, output, prefix, rosm.block_count)
-    posm.process()
-
-    print(f'Finished exporting after {timer(begin_time, time.time())}.')
-
-
-'''
-OSMCONVERT is installed in the python env bin folder on Linux systems
-Environment variable can be set or passed in as an argument as well
-Windows example
-set OSMCONVERT=C:/OSM/source/OSMtoGDB/Install/osmconvert.exe
-'''
-
-
-@cli.command('extract', short_help='Extract OSM file to OSM.XML based on shapefile')
-@click.argument('inputs', type=click.Path(exists=True))
-@click.argument('output', type=click.Path())
-@click.option('-c', '--clip_data', type=click.Path(exists=True), help='Path to clip *.shp')
-@click.option('-b', '--bbox', type=str, help='minx,miny,maxx,maxy in decimal degrees')
-@click.option('-l', '--layer', type=str, help='layer name used in gdb')
-@click.option('--osmconvert', envvar='OSMCONVERT', help='Path to osmconvert file')
-def extract(inputs, output, osmconvert, bbox, clip_data, layer):
-    """
-    Extract OSM file to OSM.XML
-
-    Example:
-
-    osmpgo extract andorra-latest.osm.pbf andorra-extract_lc_shp.osm.xml -c andorra_hole.shp
-
-    osmpgo extract andorra-latest.osm.pbf andorra-extract_lc_b.osm.xml -b 1.4275,42.4705,1.7201,42.6325
-
-    osmpgo extract andorra-latest.osm.pbf andorra-extract_lc_gd.osm.xml -c andorra.gdb -l andorra_hole
-    """
-    begin_time = time.time()
-    if os.path.exists(os.path.join(sys.prefix, 'bin/osmconvert')):
-        osmconvert = os.path.join(sys.prefix, 'bin/osmconvert')
-    elif os.path.exists(osmconvert):
-        osmconvert = osmconvert
-    else:
-        print('Unable to find osmconvert program in {} or {}'.format(os.path.join(sys.prefix, 'bin/osmconvert'),
-                                                                     osmconvert))
-        exit()
-
-    print(f'Path to osmconvert: {osmconvert}')
-    if bbox is None:
-        box = None
-    else:
-        box = []
-        for each in bbox.split(','):
-            each = each.strip()
-            try:
-                box.append(float(each))
-            except ValueError:
-                print(f'{each} not a integer or float value')
-                exit()
-        if box[0] >= box[2] or box[1] >= box[3]:
-            print('Coordinates out of sequence')
-            exit()
-        print(f'Bounding box {box}')
-    if clip_data is not None and bbox is not None:
-        print('Clip data and BBOX selected')
-        exit()
-
-    if clip_data is not None:
-        ext = ['.shp', '.gdb']
-        if os.path.splitext(clip_data)[-1] not in ext:
-            print('Clip data not a .shp or .gdb')
-            exit()
-
-        if os.path.splitext(clip_data)[-1] == '.gdb' and layer is None:
-            print('GDB missing layer flag')
-            exit()
-
-    if clip_data is not None:
-        if os.path.splitext(clip_data)[-1] == '.shp':
-            poly = write_poly(clip_data, output)
-            write_osm(inputs, output, osmconvert, poly=poly)
-        else:
-            poly = write_poly(clip_data, output, layer=layer)
-            write_osm(inputs, output, osmconvert, poly=poly)
-        print(poly)
-    elif box is not None:
-        print('bbox')
-        write_osm(inputs, output, osmconvert, bbox=box)
-    else:
-        write_osm(inputs, output, osmconvert)
-
-    # Tried several variations of subprocess to free up file but none of them seemed to work.
-    # try:
-    #     # If file exists, delete it
-    #     if os.path.isfile(poly):
-    #         os.remove(poly)
-    #     else:  ## Show an error ##
-    #         print("Error: %s file not found" % poly)
-    # except OSError as e:
-    #     print(e)
-    #     print(f'Please delete {poly}')
-    print(f'Finished extracting after {timer(begin_time, time.time())}.')
-
-
-@cli.command('combine', short_help='Combine gpkg')
-@click.argument('inputs', type=click.Path(exists=True))
-@click.argument('output', type=click.Path())
-@click.argument('prefix', type=str)
-def combine(inputs, output, prefix):
-    """
-        INPUTS folder of GPKG
-
-        OUTPUT GPKG
-
-        PREFIX of the GPKG in INPUTS folder
-    """
-    begin_time = time.time()
-    if os.path.exists(output):
-        print(f'{output} Geopackage already exists, please delete before continuing')
-        exit()
-
-    combine_gpkg(inputs, output, prefix)
-    print(f'Finished combining after {round(time.time() - begin_time, 0)} seconds.')
+import os
+import sys
+import click
+import geopandas as gpd
+import numpy as np
+import shapely
+from osmpgo.cache import ExtractCache
+from osmpgo.extract_jobs import extract_regions
+from osmpgo.extract_osmxml import write_poly, write_osm, read_clip, read_regions, write_regions, cover_simplify
+from osmpgo.export_osmxml import ReadOSM, ProcessOSM
+from osmpgo.pipeline import Pipeline
+from osmpgo.util import combine_gpkg, combine_fgb, timer
+from osmpgo.writers import FORMATS
+import time
+
+
+@click.group()
+def cli():
+    pass
+
+
+# noinspection SpellCheckingInspection
+@cli.command('export', short_help='Export OSM.XML to gpkg')
+@click.argument('inputs', type=click.Path(exists=True))
+@click.argument('output', type=click.Path())
+@click.argument('prefix', type=str)
+@click.option('-t', '--theme', type=str, help='Individual themes in a comma separated list.')
+@click.option('-f', '--feature', type=str, help='Feature type point,line,polygon')
+@click.option('-w', '--workers', type=int, default=3, show_default=True, help='Number of workers')
+@click.option('-m', '--mem_factor', type=int, default=4, show_default=True, help='memory factor for node filesize')
+@click.option('-p', '--pipeline', is_flag=True, help='Process points and ways while the XML is still being read')
+@click.option('--format', 'output_format', type=click.Choice(list(FORMATS)), default='gpkg', show_default=True,
+              help='Output format, geoparquet and fgb write one file per theme layer, mbtiles writes PREFIX.mbtiles')
+@click.option('--chunk', type=int, default=50000, show_default=True,
+              help='Features a worker collects before appending them to the output layer')
+@click.option('--maxzoom', type=click.IntRange(0, 22), default=14, show_default=True,
+              help='Last zoom level of the mbtiles format')
+@click.option('--partition', type=click.IntRange(1, 16),
+              help='Split every layer into OUTPUT/QUADKEY folders by the tile of the feature centroid at this zoom')
+@click.option('--clip', is_flag=True, help='With --partition, cut features to every tile they cross')
+@click.option('--precision', type=click.FloatRange(min=0, min_open=True),
+              help='Snap coordinates to a grid of this size in degrees, 0.0000001 is the precision of OSM')
+@click.option('--simplify', type=str,
+              help='Simplification tolerance in degrees for every theme, or theme=tolerance pairs in a comma '
+                   'separated list')
+@click.option('-c', '--clip_data', type=click.Path(exists=True),
+              help='Only export the features inside the polygons of a *.shp, *.gdb or *.gpkg')
+@click.option('-l', '--layer', type=str, help='layer name of the clip data used in gdb or gpkg')
+@click.option('-b', '--bbox', type=str, help='Only export the features inside minx,miny,maxx,maxy in decimal degrees')
+@click.option('-s', '--single', is_flag=True,
+              help='Write every layer into OUTPUT/PREFIX.gpkg through one writer process, no combine needed')
+def export(inputs, output, prefix, theme, feature, workers, mem_factor, pipeline, output_format, chunk, maxzoom,
+           partition, clip, precision, simplify, clip_data, layer, bbox, single):
+    # noinspection SpellCheckingInspection
+    """
+
+        INPUTS is the name of the OSM.XML file, or .o5m file
+
+        OUTPUT is the name of the output folder
+
+        PREFIX is the name added to the front of the export
+
+        Theme options include:
+
+        aerialway,aeroway,amenity,barrier,boundary,building,craft,emergency,geological,
+        highway,historic,landuse,leisure,man_made,military,natural,office
+        ,place,power,public_transport,railway,route,shop,sport,tourism ,waterway
+
+        Example:
+
+        osmgo export andorra-latest.osm.xml output andorra -w 8 -m 16
+
+        osmgo export andorra-latest.osm.xml  output andorra -t highway -f line
+
+        osmgo export andorra-latest.osm.xml  output andorra -t highway,building -f point,line
+
+        osmgo export andorra-latest.osm.xml output andorra -w 8 -p
+
+        osmgo export andorra-latest.osm.xml output andorra --format geoparquet
+
+        osmgo export andorra-latest.osm.xml output andorra --format fgb
+
+        osmgo export andorra-latest.osm.xml output andorra -w 8 --format mbtiles --maxzoom 14
+
+        osmgo export andorra-latest.osm.xml output andorra -w 8 --partition 8 --clip
+
+        osmgo export andorra-latest.osm.xml output andorra --precision 0.000001 --simplify landuse=0.0001,natural=0.0001
+
+        osmgo export andorra-latest.osm.xml output andorra -w 8 -s
+
+        osmgo export andorra-latest.osm.xml output andorra -c andorra_hole.shp
+
+        osmgo export andorra-latest.osm.xml output andorra -b 1.4275,42.4705,1.7201,42.6325
+
+        osmgo export andorra-latest.o5m output andorra -w 8
+        """
+    begin_time = time.time()
+    print(f'Input XML: {inputs}')
+    print(f'Output folder: {output}')
+    print(f'Output prefix: {prefix}')
+
+    print(f'Workers: {workers}')
+    print(f'Output format: {output_format}')
+    if single:
+        if output_format != 'gpkg':
+            print('A single output file is only available for the gpkg format')
+            exit()
+        print(f'Single output: {os.path.join(output, prefix)}.gpkg')
+    if partition is not None:
+        if single or output_format == 'mbtiles':
+            print('Partitions are not available for the single output or the mbtiles format')
+            exit()
+        print(f'Partitions: quadkey tiles of zoom {partition}' + (' with clipping' if clip else ''))
+
+    _themes = ['aerialway', 'aeroway', 'amenity', 'boundary', 'building', 'craft', 'emergency', 'geological',
+               'highway', 'historic', 'landuse', 'leisure', 'natural', 'office', 'place', 'power', 'public_transport',
+               'railway', 'route', 'shop', 'tourism', 'waterway']
+
+    if theme is None:
+        themes = _themes
+    else:
+        themes = []
+        for each in theme.split(','):
+            each = each.strip()
+            if each in _themes:
+                themes.append(each)
+            else:
+                print(f'Theme {each} is misspelled or missing')
+                exit()
+    print('Processing the following themes {}'.format(','.join(themes)))
+
+    _features = ['point', 'line', 'polygon']
+
+    if feature is None:
+        features = _features
+    else:
+        features = []
+        for each in feature.split(','):
+            each = each.strip()
+            if each in _features:
+                features.append(each)
+            else:
+                print(f'Feature {each} is misspelled or missing')
+                exit()
+    print('Processing the following features {}'.format(','.join(features)))
+
+    tolerances = {}
+    if simplify is not None:
+        for each in simplify.split(','):
+            name, _, value = each.strip().rpartition('=')
+            try:
+                tolerance = float(value)
+            except ValueError:
+                print(f'{value} not a integer or float value')
+                exit()
+            if name == '':
+                tolerances.update((each_theme, tolerance) for each_theme in themes)
+            elif name in themes:
+                tolerances[name] = tolerance
+            else:
+                print(f'Theme {name} is misspelled or missing')
+                exit()
+        print('Simplifying the following themes {}'.format(
+            ','.join(f'{each}={tolerances[each]}' for each in tolerances)))
+    if precision is not None:
+        print(f'Coordinate precision: {precision} degrees')
+
+    area = None
+    if clip_data is not None and bbox is not None:
+        print('Clip data and BBOX selected')
+        exit()
+    if clip_data is not None:
+        if os.path.splitext(clip_data)[-1] not in ['.shp', '.gdb', '.gpkg']:
+            print('Clip data not a .shp, .gdb or .gpkg')
+            exit()
+        if os.path.splitext(clip_data)[-1] == '.gdb' and layer is None:
+            print('GDB missing layer flag')
+            exit()
+        area = shapely.union_all(read_clip(clip_data, layer=layer)[1])
+        print(f'Clipping to {clip_data}')
+    elif bbox is not None:
+        box = []
+        for each in bbox.split(','):
+            try:
+                box.append(float(each.strip()))
+            except ValueError:
+                print(f'{each} not a integer or float value')
+                exit()
+        if len(box) != 4 or box[0] >= box[2] or box[1] >= box[3]:
+            print('Coordinates out of sequence')
+            exit()
+        area = shapely.box(*box)
+        print(f'Bounding box {box}')
+
+    input_folder = True
+    while input_folder and not os.path.exists(output):
+        val = input('Create new folder (Y/N)')
+        if val.lower() == 'y' or val.lower() == 'n':
+            if not os.path.exists(output) and val.lower() == 'y':
+                os.mkdir(output)
+                print(f'Created folder: {output}')
+            elif os.path.exists(output) and val.lower() == 'y' or os.path.exists(output) and val.lower() == 'n':
+                print(f'Folder: {output} exists')
+            else:
+                print(f'You need to create the folder: {output} because you selected N')
+                exit()
+            input_folder = False
+        else:
+            print(f'Your entry: {val} is not valid (Y/N)')
+
+    print('Keep on Trucking')
+
+    if pipeline and area is not None:
+        print('Clipping reads the whole file before the ways are resolved, running without --pipeline')
+        pipeline = False
+
+    rosm = ReadOSM(inputs, themes, features, mem_factor, clip=area)
+    if pipeline:
+        posm = ProcessOSM(themes, features, workers, rosm.tempf, output, prefix, rosm.block_count, mem_factor,
+                          output_format, chunk, single, maxzoom, partition, clip, precision, tolerances)
+        Pipeline(rosm, posm).run()
+    else:
+        rosm.readxml()
+
+        posm = ProcessOSM(themes, features, workers, rosm.tempf, output, prefix, rosm.block_count, mem_factor,
+                          output_format, chunk, single, maxzoom, partition, clip, precision, tolerances)
+        posm.process()
+
+    print(f'Finished exporting after {timer(begin_time, time.time())}.')
+
+
+'''
+OSMCONVERT is installed in the python env bin folder on Linux systems
+Environment variable can be set or passed in as an argument as well
+Windows example
+set OSMCONVERT=C:/OSM/source/OSMtoGDB/Install/osmconvert.exe
+'''
+
+
+@cli.command('extract', short_help='Extract OSM file to OSM.XML based on shapefile')
+@click.argument('inputs', type=click.Path(exists=True))
+@click.argument('output', type=click.Path())
+@click.option('-c', '--clip_data', type=click.Path(exists=True), help='Path to clip *.shp, *.gdb or *.gpkg')
+@click.option('-b', '--bbox', type=str, multiple=True,
+              help='minx,miny,maxx,maxy in decimal degrees, repeat for one output per bbox')
+@click.option('-l', '--layer', type=str, help='layer name used in gdb or gpkg')
+@click.option('-s', '--split', type=str,
+              help='Write one OSM.XML per feature of the clip data into the OUTPUT folder, named by this field')
+@click.option('--simplify', type=click.FloatRange(min=0, min_open=True),
+              help='Tolerance in degrees to reduce the vertices of the clip data, the result still covers it')
+@click.option('-j', '--jobs', type=click.IntRange(min=1),
+              help='With several regions, run this many osmconvert extracts at once instead of a single pass')
+@click.option('--cache', 'cache_folder', type=click.Path(file_okay=False), envvar='OSMPGO_CACHE',
+              help='Folder to keep extracts in, a repeated extract of the same file and clip data is linked from it')
+@click.option('--cache_size', type=click.IntRange(min=1), default=10240, show_default=True,
+              help='Megabytes of the cache folder, the least recently used extracts are removed')
+@click.option('--osmconvert', envvar='OSMCONVERT', help='Path to osmconvert file')
+def extract(inputs, output, osmconvert, bbox, clip_data, layer, split, simplify, jobs, cache_folder, cache_size):
+    """
+    Extract OSM file to OSM.XML, or to .o5m when OUTPUT ends in .o5m
+
+    Several regions are extracted in a single pass over the OSM file, into OUTPUT/REGION.osm.xml
+
+    Example:
+
+    osmpgo extract andorra-latest.osm.pbf andorra-extract_lc_shp.osm.xml -c andorra_hole.shp
+
+    osmpgo extract andorra-latest.osm.pbf andorra-extract_lc_b.osm.xml -b 1.4275,42.4705,1.7201,42.6325
+
+    osmpgo extract andorra-latest.osm.pbf andorra-extract_lc_gd.osm.xml -c andorra.gdb -l andorra_hole
+
+    osmpgo extract andorra-latest.osm.pbf parishes -c parishes.gpkg -s name
+
+    osmpgo extract andorra-latest.osm.pbf andorra-extract_lc_shp.osm.xml -c andorra_coast.shp --simplify 0.0005
+
+    osmpgo extract andorra-latest.osm.pbf andorra-extract_lc_b.osm.xml -b 1.4275,42.4705,1.7201,42.6325 --cache cache
+
+    osmpgo extract andorra-latest.osm.pbf boxes -b 1.4,42.4,1.55,42.7 -b 1.55,42.4,1.8,42.7
+
+    osmpgo extract andorra-latest.osm.pbf parishes -c parishes.gpkg -s name -j 4
+
+    osmpgo extract andorra-latest.osm.pbf andorra-extract_lc_b.o5m -b 1.4275,42.4705,1.7201,42.6325
+    """
+    begin_time = time.time()
+    if os.path.exists(os.path.join(sys.prefix, 'bin/osmconvert')):
+        osmconvert = os.path.join(sys.prefix, 'bin/osmconvert')
+    elif osmconvert is not None and os.path.exists(osmconvert):
+        osmconvert = osmconvert
+    else:
+        print('Unable to find osmconvert program in {} or {}'.format(os.path.join(sys.prefix, 'bin/osmconvert'),
+                                                                     osmconvert))
+        exit()
+
+    print(f'Path to osmconvert: {osmconvert}')
+    boxes = []
+    for each_bbox in bbox:
+        box = []
+        for each in each_bbox.split(','):
+            each = each.strip()
+            try:
+                box.append(float(each))
+            except ValueError:
+                print(f'{each} not a integer or float value')
+                exit()
+        if len(box) != 4 or box[0] >= box[2] or box[1] >= box[3]:
+            print('Coordinates out of sequence')
+            exit()
+        print(f'Bounding box {box}')
+        boxes.append(box)
+    if clip_data is not None and len(boxes) > 0:
+        print('Clip data and BBOX selected')
+        exit()
+
+    if clip_data is not None:
+        ext = ['.shp', '.gdb', '.gpkg']
+        if os.path.splitext(clip_data)[-1] not in ext:
+            print('Clip data not a .shp, .gdb or .gpkg')
+            exit()
+
+        if os.path.splitext(clip_data)[-1] == '.gdb' and layer is None:
+            print('GDB missing layer flag')
+            exit()
+
+    if split is not None and clip_data is None:
+        print('Split needs clip data')
+        exit()
+
+    cache = ExtractCache(cache_folder, cache_size * 1024 * 1024) if cache_folder is not None else None
+    if split is not None or len(boxes) > 1:
+        if split is not None:
+            regions = read_regions(clip_data, layer=layer, field=split)
+            if simplify is not None:
+                regions = gpd.GeoSeries(cover_simplify(np.asarray(regions.values), simplify), index=regions.index,
+                                        crs=regions.crs)
+        else:
+            regions = gpd.GeoSeries([shapely.box(*box) for box in boxes],
+                                    index=[f'bbox{i}' for i in range(len(boxes))], crs=4326)
+        print(f'Extracting {len(regions)} regions into {output}')
+        paths = {name: os.path.join(output, f'{name}.osm.xml') for name in regions.index}
+        keys = {name: cache.key(inputs, np.asarray([geometry]), 'regions') for name, geometry in regions.items()} \
+            if cache is not None else {}
+        os.makedirs(output, exist_ok=True)
+        if cache is not None and all([cache.get(keys[name], paths[name]) for name in regions.index]):
+            print('\tAll regions from the cache')
+        else:
+            # Region files linked from the cache are replaced, not written through
+            for path in paths.values():
+                if os.path.exists(path):
+                    os.remove(path)
+            if jobs is None:
+                counts = write_regions(inputs, output, osmconvert, regions)
+                for name, (nodes, ways, relations) in counts.items():
+                    print(f'\t{name}: {nodes:,} nodes, {ways:,} ways and {relations:,} relations')
+                    if cache is not None:
+                        cache.put(keys[name], paths[name])
+            else:
+                def report(job, size, message):
+                    if message is None:
+                        print(f'\t{job.name}: {size:,} bytes so far')
+
+                results = extract_regions(inputs, output, osmconvert, regions, workers=jobs, progress=report)
+                for name, result in results.items():
+                    if result.ok:
+                        print(f'\t{name}: {result.size:,} bytes in {timer(0, result.duration)}')
+                        if cache is not None:
+                            cache.put(keys[name], paths[name])
+                    else:
+                        print(f'\t{name}: osmconvert failed with exit code {result.returncode}')
+                        print('\n'.join(result.messages))
+    else:
+        key, written = None, False
+        if cache is not None:
+            # osmconvert writes .o5m by the extension of the output
+            o5m = ' o5m' if output.lower().endswith('.o5m') else ''
+            if clip_data is not None:
+                key = cache.key(inputs, read_clip(clip_data, layer=layer)[1], f'-B {simplify}{o5m}')
+            elif len(boxes) == 1:
+                key = cache.key(inputs, np.asarray([shapely.box(*boxes[0])]), f'-b{o5m}')
+            else:
+                key = cache.key(inputs, options=o5m)
+        if key is not None and cache.get(key, output):
+            print(f'{output} from the cache')
+        elif clip_data is not None:
+            poly = write_poly(clip_data, output, layer=layer, simplify=simplify)
+            written = write_osm(inputs, output, osmconvert, poly=poly)
+            os.remove(poly)
+        elif len(boxes) == 1:
+            print('bbox')
+            written = write_osm(inputs, output, osmconvert, bbox=boxes[0])
+        else:
+            written = write_osm(inputs, output, osmconvert)
+        if key is not None and written:
+            cache.put(key, output)
+
+    print(f'Finished extracting after {timer(begin_time, time.time())}.')
+
+
+@cli.command('combine', short_help='Combine gpkg')
+@click.argument('inputs', nargs=-1, required=True, type=click.Path(exists=True))
+@click.argument('output', type=click.Path())
+@click.argument('prefix', type=str)
+@click.option('--dedupe/--no-dedupe', default=True, show_default=True,
+              help='Skip features whose node_id or way_id was already added from an earlier file')
+@click.option('--format', 'output_format', type=click.Choice(['gpkg', 'fgb']), default='gpkg', show_default=True,
+              help='Format of the files to combine, fgb writes one file per layer into the OUTPUT folder')
+def combine(inputs, output, prefix, dedupe, output_format):
+    """
+        INPUTS one or more folders of GPKG or FlatGeobuf files
+
+        OUTPUT GPKG, or folder for FlatGeobuf
+
+        PREFIX of the GPKG in INPUTS folders, a comma separated list combines several regions
+
+        Same-named layers are appended in the order of INPUTS and PREFIX.
+
+        Example:
+
+        osmgo combine output germany.gpkg germany
+
+        osmgo combine output/france output/germany europe.gpkg france,germany
+
+        osmgo combine output/france output/germany europe france,germany --format fgb
+    """
+    begin_time = time.time()
+    if os.path.exists(output):
+        print(f'{output} already exists, please delete before continuing')
+        exit()
+
+    if output_format == 'fgb':
+        combine_fgb(list(inputs), output, prefix.split(','), dedupe)
+    else:
+        combine_gpkg(list(inputs), output, prefix.split(','), dedupe)
+    print(f'Finished combining after {round(time.time() - begin_time, 0)} seconds.')
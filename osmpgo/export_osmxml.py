@@ -1,696 +1,1572 @@
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from concurrent.futures.process import BrokenProcessPool
-import csv
-import os
-import pkg_resources
-import time
-from shutil import rmtree
-import tempfile
-# import sys
-import pickle
-import geopandas as gpd
-from shapely.geometry import Point, Polygon, LineString
-from typing import Iterable, Any
-from osmpgo.util import timer
-
-
-
-
-def read_themes(themes: list) -> dict:
-    """
-        Uses CSV file and theme parameter to create custom dictionary base on users input
-
-    Args:
-        themes: list of key OSM themes
-
-    Returns:
-        The return value is dictionary that represents the data/field structure of the them
-    """
-
-    std_flds_all = {}
-    # config_file = os.path.join(os.path.dirname(__file__), 'categories_and_fields.csv')
-    config_file = pkg_resources.resource_filename("osmpgo", 'data/categories_and_fields.csv')
-    with open(config_file, 'r') as csv_file:
-        csv_reader = csv.reader(csv_file)
-        for row in csv_reader:
-            fields = []
-            if len(row) > 0:
-                # categories.append(row[0])
-                for fld in row:
-                    if len(fld) > 0:
-                        if fld == 'from':  # 'from' and 'to' fields need to have an underscore for some reason
-                            fld = 'from_'
-                        if fld == 'to':
-                            fld = 'to_'
-                        fields.append(fld)
-                std_flds_all[row[0]] = fields
-
-    # Trim std_flds to only themes passed in by user
-    std_flds = {}
-    for key in themes:
-        if key in std_flds_all:
-            std_flds[key] = std_flds_all[key]
-
-    return std_flds
-
-
-class ReadOSM:
-    """
-        Processing Class
-    """
-
-    def __init__(self, inputs: str, themes: list, features: list, mem_factor: int):
-        self.inputs = inputs
-        self.themes = themes
-        self.features = features
-        self.pointb = False
-        self.lineb = False
-        self.polygonb = False
-        self.tempf = None
-        self.std_flds = None
-        self.categories = None
-        self.mem_factor = mem_factor
-        self.block_count = 0
-
-        if 'point' in features:
-            self.pointb = True
-
-        if 'line' in features:
-            self.lineb = True
-
-        if 'polygon' in features:
-            self.polygonb = True
-
-        self.tempf = tempfile.mkdtemp(dir=os.getcwd())
-
-        self.std_flds = read_themes(themes)
-        self.categories = list(self.std_flds.keys())
-        # print(f'Processing: {",".join(self.categories)}')
-
-    @staticmethod
-    def get_element_name(line: str) -> str:
-        """
-        Gets the value of the named attribute from the string
-        Gets the XML element name from the string passed in.  End of element tag is /element
-        """
-        s = line.find('<')
-        e = line.find(' ', s)
-        el = line[s + 1:e]
-        if el[0:1] == '/':
-            el = el[0:len(el) - 1]
-
-        return el
-
-    @staticmethod
-    def get_attribute_value(name: str, line: str) -> str:
-        """
-        Gets the value of the named attribute from the string
-        Args:
-            name: Name of Tag
-            line: XML Line
-
-        Returns:
-            The return value is a string representing the attribute
-        """
-        sa = line.find(' ' + name + '="') + len(name) + 3
-        ea = line.find('"', sa)
-        attr = line[sa:ea]
-        return attr
-
-    def get_node_details(self, line: str) -> tuple:
-        """
-
-        Args:
-            line: XML Line
-
-        Returns:
-            The return value is a tuple of the ID, Longitude and Lattitude extracted from the XML line.
-        """
-        nid = str(self.get_attribute_value('id', line))
-        nx = float(self.get_attribute_value('lon', line))
-        ny = float(self.get_attribute_value('lat', line))
-
-        return nid, nx, ny
-
-    def return_id(self, line: str) -> str:
-        """
-         Get the id attribute from a line of xml text used for ways and its segments; id is only attribute needed
-
-        Args:
-            line: XML Line
-
-        Returns:
-            The return value is a string that represent the ID
-
-        """
-
-        return self.get_attribute_value('id', line)
-
-    def get_tag_details(self, line: str) -> tuple:
-        """
-        Get key and value from tag
-        Args:
-            line: XML Line
-
-        Returns:
-            The return value is a tuple of the Key and Value extracted from the XML line.
-        """
-
-        k = self.get_attribute_value('k', line)[:29]
-        v = self.get_attribute_value('v', line)[:254]
-
-        return k, v
-
-    def readxml(self):
-        """
-        Reads, interprets XML file then write objects to pickle file.
-        Returns:
-            None
-        """
-
-        # Create initial temp files to keep track of nodes and ways
-        self.block_count = 1
-
-        open_files = {}
-        for key in self.std_flds:
-            if self.lineb or self.polygonb:
-                open_files[f'{key}_way'] = open(os.path.join(self.tempf, f'{key}_way.pkl'), 'wb')
-            if self.pointb:
-                open_files[f'{key}_point'] = open(os.path.join(self.tempf, f'{key}_point.pkl'), 'wb')
-
-        node_file = open(os.path.join(self.tempf, f'nodeblock_{self.block_count}.pkl'), 'wb')
-
-        has_valid_tags = False  # Will be set to true when first valid tag is found
-
-        # Create basic objects to keep track of features
-        node_count = 0
-        way_count = 0
-        point_feature_count = 0
-        # line_count = 0
-        type_code = -1  # -1 is not yet set, 1 is a node, 2 is a way
-        feature_tags = []
-        block_size = self.mem_factor * 1000000  # Size of each temp file for storing nodes
-
-        xml_file = open(self.inputs, 'rb')
-        line_count = 0
-        for xml_line in xml_file:
-            # print(xml_line)
-            try:
-                # Source should be in utf-8, but encoding causes problems sometimes
-                # u_line = unicode(xml_line, 'utf-8', 'replace')
-                u_line = xml_line.decode('utf-8')
-                element_name = self.get_element_name(u_line)
-                # print(element_name)
-                line_count += 1
-                # print(element_name)
-            except Exception as e:
-                print(f'\tError reading line in file: {xml_line}')
-                print(e)
-                continue
-
-            if element_name == 'node':
-
-                try:
-                    type_code = -1  # Still -1 until we know node is valid
-                    feature_tags = []
-                    node_details = self.get_node_details(u_line)
-                    has_valid_tags = False
-
-                    # Make sure node coordinates are valid geographically
-                    if -180 <= node_details[1] <= 180 and -90 <= node_details[2] <= 90:
-                        type_code = 1
-                        # Start a new node block if size limit reached
-                        if node_count > self.block_count * block_size:
-                            node_file.close()
-                            self.block_count += 1
-                            node_file = open(os.path.join(self.tempf, f'nodeblock_{self.block_count}.pkl'), 'wb')
-                        # info = f'{node_details[0]}:{node_details[1]}:{node_details[2]}'
-                        # pickle.dump(info, node_file)
-                        pickle.dump([node_details[0], node_details[1], node_details[2]], node_file)
-
-                        node_count += 1
-                        if node_count > 0 and node_count % 1000000 == 0:
-                            print(f'\tCounting nodes: {node_count:,}')
-
-                except Exception as e:
-                    print(e)
-                    print('\tError reading node!')
-                    continue
-
-            elif element_name == 'way':
-                type_code = 2
-                has_valid_tags = False
-
-                if way_count > 0 and way_count % 100000 == 0:
-                    print(f'\tCounting ways: {way_count:,}')
-
-                way = (self.return_id(u_line), '')
-                way_ref_list = []
-                feature_tags = []
-
-            # nd element will only be found inside a way, save it to its way string
-            elif element_name == 'nd':
-                way_ref_list.append(self.get_attribute_value('ref', u_line))
-            # tag elements can be found inside nodes or ways
-            elif element_name == 'tag':
-
-                # Get name and value of the tag
-                tag_details = self.get_tag_details(u_line)
-
-                # If tag is not blank, add it to feature tags list
-                if tag_details[1] != '':
-
-                    # 'from' and 'to' tags need an underscore for some reason
-                    if tag_details[0] == 'from':
-                        tag_details = ('from_', tag_details[1])
-                    if tag_details[0] == 'to':
-                        tag_details = ('to_', tag_details[1])
-
-                    feature_tags.append((tag_details[0].replace(':', '_'), tag_details[1].replace(',', ' ')))
-                    has_valid_tags = True
-
-            # At a /node element (i.e. a node with tags), create a point and insert it into the points feature class
-            elif '/node' in element_name and has_valid_tags and type_code == 1:
-
-                if self.pointb:
-                    # Node details were saved when opening <node> element was read
-
-                    try:
-                        #                 # Loop through the node's tags
-                        for tag_kv in feature_tags:
-                            node_cursor_key = tag_kv[0]
-                            # If tag matches a feature class, find that cursor
-                            if node_cursor_key in self.categories:
-                                values = {'node_id': node_details[0],
-                                          'geometry': Point(node_details[1], node_details[2])}
-                                # node_cat = node_cursor_key
-                                node_fieldnames = self.std_flds[node_cursor_key]
-                                # Loop through tags again, inserting into field values
-                                for the_tag in feature_tags:
-                                    the_key = the_tag[0]
-                                    if the_key in node_fieldnames:
-                                        value = str(the_tag[1])
-                                        values[the_key] = value
-
-                                pickle.dump(values, open_files[f'{node_cursor_key}_point'])
-                                point_feature_count += 1
-                    except Exception as e:
-                        print(f'\tError processing node with ID: {node_details[0]}')
-                        print(e)
-
-                has_valid_tags = False  # Reset valid tags flag
-
-            # No way will be only one line in the XML, we will have read through its
-            # component <nd ref> and <tag> elements
-            elif '/way' in element_name and has_valid_tags:
-
-                # Done with way, now let's load its attributes (shape comes later)
-                # Need to go back and come up with a better place to put this
-                if len(feature_tags) > 0 and (self.lineb or self.polygonb):
-                    way_id = str(way[0])  # From first line of way XML
-                    try:
-                        # Loop through the way's tags
-                        for tag_kv in feature_tags:
-                            key = tag_kv[0]
-                            # If tag matches a feature class, we will use this way
-                            if key in self.categories:
-                                values = {'attrib': {}}
-                                # way_cat = key
-                                way_fieldnames = self.std_flds[key]
-                                # Loop through tags again, inserting into field values
-                                for the_tag in feature_tags:
-                                    the_key = the_tag[0]
-                                    if the_key in way_fieldnames:
-                                        value = str(the_tag[1])
-                                        values['attrib'][the_key] = value
-
-                                values['ref'] = way_ref_list  # Used as an index to align points in the correct sequence
-                                values['ref_remaing'] = way_ref_list  # Used to keep track of nodes in geometry creation
-                                values['way_cat'] = key
-                                values['way_id'] = way_id
-                                values['coords'] = {}  # Place Holder for Ref Coords
-
-                                # Dump way values to pickle theme
-                                pickle.dump(values, open_files[f'{key}_way'])
-                                way_count += 1
-
-                    except Exception as e:
-                        print(e)
-                        print(f'\tError reading way with id: {way_id}')
-
-                has_valid_tags = False  # Reset valid tags flag
-
-        # Close xml_file if necessary
-        if str(type(xml_file)) == "<type 'file'>":
-            xml_file.close()
-
-        print(f'\tCount: {node_count:,} nodes, {way_count:,} ways')
-        print(f'\tPoint features produced: {point_feature_count:,}')
-
-        # Close files that were written to
-        node_file.close()
-
-        for key in open_files:
-            open_files[key].close()
-
-
-class ProcessOSM:
-    """
-    Processing Class that readout the output fro the ReadOSM process
-    """
-
-    def __init__(self, themes: list, features: list, workers: int,
-                 tempf: str, output: str, prefix: str, block_count: int):
-        self.themes = themes
-        self.features = features
-        self.tempf = tempf
-        self.block_count = block_count
-        self.workers = workers
-        self.output = output
-        self.prefix = prefix
-
-        self.pointb = False
-        self.lineb = False
-        self.polygonb = False
-        self.std_flds = None
-        self.categories = None
-
-        if 'point' in features:
-            self.pointb = True
-
-        if 'line' in features:
-            self.lineb = True
-
-        if 'polygon' in features:
-            self.polygonb = True
-
-        self.std_flds = read_themes(themes)
-        self.categories = list(self.std_flds)
-
-    def process(self) -> None:
-        """
-        Mutliprocessing loop for point and line/polygons. Cleans up tmp directory at the end
-
-        """
-        try:
-            if self.pointb:
-
-                futures = []
-                with ProcessPoolExecutor(max_workers=self.workers) as executor:
-                    for theme in self.themes:
-                        futures.append(executor.submit(self.process_nodes, theme))
-                    for x in as_completed(futures):
-                        print(x.result())
-
-            if self.lineb or self.polygonb:
-
-                futures = []
-                with ProcessPoolExecutor(max_workers=self.workers) as executor:
-                    for theme in self.themes:
-                        futures.append(executor.submit(self.process_ways, theme))
-                    for x in as_completed(futures):
-                        print(x.result())
-
-        except BrokenProcessPool as e:
-            print(e)
-            print('This was more than likely a memory issue. Try running with fewer or even 1 '
-                  'work to troubleshoot problem')
-
-        if os.path.exists(self.tempf):
-            rmtree(self.tempf)
-
-    def process_nodes(self, theme: str) -> str:
-        """
-        Process Point Themes in a GeoPackage
-        Args:
-            theme: Key theme from OSM
-
-        Returns:
-            The return value. String that describes completion
-
-        """
-        begin_time = time.time()
-        print(f'Processing Nodes for {theme}')
-        count = 0
-
-        # Build Data Structure
-
-        std_flds = read_themes([theme])
-        flds = {'node_id': [], 'geometry': []}
-        flds.update({item: [] for item in std_flds[theme]})
-
-        # Load pickle theme element
-        pkl_points = os.path.join(self.tempf, f'{theme}_point.pkl')
-        # Load data from pickle file
-        for node in list(self.loadall(pkl_points)):
-            # print(node)
-            for tag in flds:
-                if tag in node:
-                    flds[tag].append(node[tag])
-                else:
-                    flds[tag].append('')
-
-            count += 1
-        if len(flds['geometry']) > 0:
-            output_gpkg = os.path.join(self.output, f'{self.prefix}_{theme}.gpkg')
-            point_gdf = gpd.GeoDataFrame(flds, geometry='geometry')
-            point_gdf.set_crs(epsg=4326, inplace=True)
-            point_gdf.to_file(output_gpkg, layer=f'{theme}_point', driver="GPKG")
-        else:
-            print(f'Point Theme {theme} is empty')
-
-        text = f'Point Theme {theme} completed after {timer(begin_time, time.time())} with {count} points.'
-        return text
-
-    @staticmethod
-    def loadall(filename: str) -> Iterable[Any]:
-        """
-        Sequential Lazy Unpickler
-        Args:
-            filename: Filename of pickle file
-
-        Returns:
-            The return value. Unpickled OBject
-
-        """
-        with open(filename, "rb") as f:
-            while True:
-                try:
-                    yield pickle.load(f)
-                except EOFError:
-                    break
-
-    def process_ways(self, theme: str) -> str:
-        """
-        Each way is either a line or a polygon and writes out the appropraite geometry to a dictionary that is converted
-        into a geopandas dataframe before being exported to a geopackage.
-
-        The code as it stands does not account for relation that would create multipart polygons and holes
-         in existing polygons
-        Args:
-            theme: Key theme from OSM
-
-        Returns:
-            The return value. String that describes completion
-
-        """
-        begin_time = time.time()
-        print(f'Processing Ways for {theme}')
-
-        # Grab attributes for theme for data schema
-        std_flds = read_themes([theme])
-
-        if self.lineb:
-            line_flds = {'way_id': [], 'geometry': []}
-            line_flds.update({item: [] for item in std_flds[theme]})
-            # for item in std_flds[theme]:
-            #    line_flds[item] = []
-        if self.polygonb:
-            poly_flds = {'way_id': [], 'geometry': []}
-            poly_flds.update({item: [] for item in std_flds[theme]})
-            # for item in std_flds[theme]:
-            #     poly_flds[item] = []
-
-        completed_lines_count = 0
-        completed_polygons_count = 0
-        completed_ways_count = 0
-
-        """
-        Loop through each node block, loading each into memory in turn
-        Each way theme has a single pickle file while the nodes have multiple files
-        With each iteration of a node file a way is either created when it has all it nodes
-        or updated with coordinate information from the nodes it could find and resaved into 
-        a temp file that is saved over the theme way file at the end block loop
-        """
-        try:
-            for block_num in range(1, self.block_count + 1):
-                # print('theme')
-                nodes = {}
-                print(f'\tLoading block: {block_num} of {self.block_count} for {theme} theme')
-                node_file = os.path.join(self.tempf, f'nodeblock_{block_num}.pkl')
-                nodes_file_list = list(self.loadall(node_file))
-                # Add nodes from block to a dictionary
-                try:
-                    for node_string in nodes_file_list:
-                        # node_list = node_string.split(':')
-                        # nodes[node_list[0]] = (node_list[1], node_list[2])
-                        nodes[node_string[0]] = (node_string[1], node_string[2])
-                except Exception as e:
-                    print(e)
-                    print(f'\t\tError loading block: {block_num} of {self.block_count}')
-                    continue  # Should still get some useful features if we continue
-
-                # Get table of unbuilt ways, create new table to be populated with still unbuilt ways
-                try:
-                    # Load pickle theme element
-                    pkl_ways = os.path.join(self.tempf, f'{theme}_way.pkl')
-                    # unbuilt_ways = list(self.loadall(pkl_ways))
-                    # Less memory to lazy load the data
-                    unbuilt_ways = self.loadall(pkl_ways)
-                    still_unbuilt_ways = open(os.path.join(self.tempf, f'still_unbuilt_ways{theme}.pkl'), 'wb')
-
-                except Exception as e:
-                    print(e)
-                    print('\t\tError saving unbuilt ways table!')
-                    continue  # Should still get some useful features if we continue
-
-                # print(len(unbuilt_ways))
-                for way in unbuilt_ways:
-
-                    if completed_ways_count > 0 and completed_ways_count % 10000 == 0:
-                        print(f'\t\tBuilt ways: {completed_ways_count:,}')
-
-                    way_nodes_id_list = way['ref_remaing']  # Starts off as an exact copy of ref key
-                    ref_remaing = []  # key that blank are appended to this list
-                    # way_nodes_list = []
-                    is_way_complete = True  # Can become false if nodes are not in current block
-
-                    # Loop through each node id in the way, attempting to find its coordinates in node block
-                    for way_node_id in way_nodes_id_list:
-                        if way_node_id in nodes:
-                            node_coords = nodes[way_node_id]  # Look up node coordinates in nodes dict
-                            way['coords'][way_node_id] = node_coords
-
-                        # If not found, flag to place in still unbuilt ways table
-                        # No way is left behind unless the there is no representive node in any o fthe files
-                        else:
-                            ref_remaing.append(way_node_id)
-                            is_way_complete = False
-
-                    if is_way_complete:
-                        way_shape = []
-                        for nd in way['ref']:
-                            way_shape.append((float(way['coords'][nd][0]), float(way['coords'][nd][1])))
-
-                        # There are ways in the OSM file that are missing corresponding nodes.
-                        # There are also some ways with partial nodes but the nodes seem to still be in order
-                        if len(way_shape) <= 1:
-                            continue
-
-                        # Get first and last nodes
-                        start_point = way_shape[0]
-                        end_point = way_shape[-1]
-
-                        # If closed way, examine attributes to determine whether to force the way to be a line
-                        if start_point[0] == end_point[0] and start_point[1] == end_point[1]:
-                            force_way_to_line = self.determine_force_way_to_line(theme, way['attrib'])
-
-                        # Process Lines
-                        if self.lineb and (not (
-                                start_point[0] == end_point[0] and start_point[1] == end_point[1]) or
-                                           force_way_to_line):
-                            line_flds['way_id'].append(way['way_id'])
-                            line = [(shape[0], shape[1]) for shape in way_shape]
-                            linestring = LineString(line)
-                            line_flds['geometry'].append(linestring)
-
-                            for key in line_flds:
-                                if key in way['attrib']:
-                                    line_flds[key].append(way['attrib'][key])
-                                elif key != 'way_id' and key != 'geometry':
-                                    line_flds[key].append('')
-                            completed_lines_count += 1
-
-                        # Find polygons...need at least three points
-                        elif self.polygonb and (start_point[0] == end_point[0] and start_point[1] == end_point[1] and
-                                                len(way_shape) > 3):
-                            poly_flds['way_id'].append(way['way_id'])
-                            polygon = []
-                            for shape in way_shape:
-                                polygon.append((shape[0], shape[1]))
-                            polygon = Polygon(polygon)
-                            poly_flds['geometry'].append(polygon)
-
-                            for key in poly_flds:
-                                if key in way['attrib']:
-                                    poly_flds[key].append(way['attrib'][key])
-                                elif key != 'way_id' and key != 'geometry':
-                                    poly_flds[key].append('')
-                            completed_polygons_count += 1
-
-                    else:
-                        # Save incomplete way info
-                        way['ref_remaing'] = ref_remaing
-                        pickle.dump(way, still_unbuilt_ways)
-                try:
-                    nodes.clear()
-                    still_unbuilt_ways.close()
-                    os.remove(os.path.join(self.tempf, f'{theme}_way.pkl'))
-                    os.rename(os.path.join(self.tempf, f'still_unbuilt_ways{theme}.pkl'),
-                              os.path.join(self.tempf, f'{theme}_way.pkl'))
-                except Exception as e:
-                    print(e)
-                    print(f'\tError cleaning up block number: {block_num}')
-
-            # for key in line_flds:
-            #     print(f"{key},{len(line_flds[key])}")
-            # for key in poly_flds:
-            #     print(f"{key},{len(poly_flds[key])}")
-
-            print(f'Creating Geopacakge for {theme}')
-            output_gpkg = os.path.join(self.output, f'{self.prefix}_{theme}.gpkg')
-
-            if self.polygonb:
-                if len(poly_flds['way_id']) > 0:
-                    poly_gdf = gpd.GeoDataFrame(poly_flds, geometry='geometry')
-                    poly_gdf.set_crs(epsg=4326, inplace=True)
-                    poly_gdf.to_file(output_gpkg, layer=f'{theme}_polygon', driver="GPKG")
-
-            if self.lineb:
-                if len(line_flds['way_id']) > 0:
-                    line_gdf = gpd.GeoDataFrame(line_flds, geometry='geometry')
-                    line_gdf.set_crs(epsg=4326, inplace=True)
-                    line_gdf.to_file(output_gpkg, layer=f'{theme}_line', driver="GPKG")
-                else:
-                    print(f'Line Theme {theme} is empty')
-
-            text = f'Line and Polygon Theme {theme} completed after {timer(begin_time, time.time())}' \
-                   f'with {completed_lines_count} lines and {completed_polygons_count} polygons.'
-        except Exception as e:
-            print(e)
-
-        return text
-
-    @staticmethod
-    def determine_force_way_to_line(cat: str, atts: dict) -> bool:
-        """
-        Part of the legacy code
-        Args:
-            cat: Key OSM theme
-            atts: Fields for specific theme.
-
-        Returns:
-            The return value. True for success, False otherwise.
-        """
-
-        if cat in ['barrier', 'boundary', 'highway', 'public_transport', 'railway', 'route']:
-            force_to_line = True
-            try:
-                for att in atts:
-                    if att == 'area' and atts[att] == 'yes':
-                        force_to_line = False
-            except ValueError:
-                force_to_line = True
-        else:
-            force_to_line = False
-        return force_to_line
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import csv
+import glob
+import itertools
+import json
+import math
+import os
+import pkg_resources
+import time
+from shutil import rmtree
+import tempfile
+# import sys
+import pickle
+from array import array
+from bisect import bisect_left
+import numpy as np
+import shapely
+from shapely.geometry import Point, Polygon, LineString
+from typing import Iterable, Any
+from osmpgo.util import timer
+from osmpgo.o5m import O5mReader
+from osmpgo.relations import WayGeometryStore, member_ids, is_member, assemble_multipolygon, assemble_route
+from osmpgo.writers import LayerWriter, LayerBuilder, QueueLayerWriter, TileLayerWriter, layer_writer, \
+    set_output_queue, output_queue, start_output, stop_output
+from osmpgo.tiles import build_mbtiles
+from osmpgo.fields import read_field_types
+from osmpgo.partitions import PartitionLayerWriter, write_manifest
+
+
+
+
+def read_themes(themes: list) -> dict:
+    """
+        Uses CSV file and theme parameter to create custom dictionary base on users input
+
+    Args:
+        themes: list of key OSM themes
+
+    Returns:
+        The return value is dictionary that represents the data/field structure of the them
+    """
+
+    std_flds_all = {}
+    # config_file = os.path.join(os.path.dirname(__file__), 'categories_and_fields.csv')
+    config_file = pkg_resources.resource_filename("osmpgo", 'data/categories_and_fields.csv')
+    with open(config_file, 'r') as csv_file:
+        csv_reader = csv.reader(csv_file)
+        for row in csv_reader:
+            fields = []
+            if len(row) > 0:
+                # categories.append(row[0])
+                for fld in row:
+                    if len(fld) > 0:
+                        if fld == 'from':  # 'from' and 'to' fields need to have an underscore for some reason
+                            fld = 'from_'
+                        if fld == 'to':
+                            fld = 'to_'
+                        fields.append(fld)
+                std_flds_all[row[0]] = fields
+
+    # Trim std_flds to only themes passed in by user
+    std_flds = {}
+    for key in themes:
+        if key in std_flds_all:
+            std_flds[key] = std_flds_all[key]
+
+    return std_flds
+
+
+class NodeOrderError(ValueError):
+    """
+    A node comes after the first way of the file, the pipeline has already handed the node blocks to the resolve shards
+    """
+
+
+class ReadOSM:
+    """
+        Processing Class
+    """
+
+    def __init__(self, inputs: str, themes: list, features: list, mem_factor: int, clip: Any = None):
+        self.inputs = inputs
+        self.clip = clip  # Polygon, MultiPolygon or bbox box in EPSG:4326 to keep the features of, see ClipFilter
+        self.themes = themes
+        self.features = features
+        self.pointb = False
+        self.lineb = False
+        self.polygonb = False
+        self.tempf = None
+        self.std_flds = None
+        self.categories = None
+        self.mem_factor = mem_factor
+        self.block_count = 0
+        self.stats = None
+
+        if 'point' in features:
+            self.pointb = True
+
+        if 'line' in features:
+            self.lineb = True
+
+        if 'polygon' in features:
+            self.polygonb = True
+
+        self.tempf = tempfile.mkdtemp(dir=os.getcwd())
+
+        self.std_flds = read_themes(themes)
+        self.categories = list(self.std_flds.keys())
+        # print(f'Processing: {",".join(self.categories)}')
+
+    @staticmethod
+    def get_element_name(line: str) -> str:
+        """
+        Gets the value of the named attribute from the string
+        Gets the XML element name from the string passed in.  End of element tag is /element
+        """
+        s = line.find('<')
+        e = line.find(' ', s)
+        el = line[s + 1:e]
+        if el[0:1] == '/':
+            el = el[0:len(el) - 1]
+
+        return el
+
+    @staticmethod
+    def get_attribute_value(name: str, line: str) -> str:
+        """
+        Gets the value of the named attribute from the string
+        Args:
+            name: Name of Tag
+            line: XML Line
+
+        Returns:
+            The return value is a string representing the attribute
+        """
+        sa = line.find(' ' + name + '="') + len(name) + 3
+        ea = line.find('"', sa)
+        attr = line[sa:ea]
+        return attr
+
+    def get_node_details(self, line: str) -> tuple:
+        """
+
+        Args:
+            line: XML Line
+
+        Returns:
+            The return value is a tuple of the ID, Longitude and Lattitude extracted from the XML line.
+        """
+        nid = str(self.get_attribute_value('id', line))
+        nx = float(self.get_attribute_value('lon', line))
+        ny = float(self.get_attribute_value('lat', line))
+
+        return nid, nx, ny
+
+    def return_id(self, line: str) -> str:
+        """
+         Get the id attribute from a line of xml text used for ways and its segments; id is only attribute needed
+
+        Args:
+            line: XML Line
+
+        Returns:
+            The return value is a string that represent the ID
+
+        """
+
+        return self.get_attribute_value('id', line)
+
+    def get_tag_details(self, line: str) -> tuple:
+        """
+        Get key and value from tag
+        Args:
+            line: XML Line
+
+        Returns:
+            The return value is a tuple of the Key and Value extracted from the XML line.
+        """
+
+        k = self.get_attribute_value('k', line)[:29]
+        v = self.get_attribute_value('v', line)[:254]
+
+        return k, v
+
+    def xml_elements(self) -> Iterable[tuple]:
+        """
+        Reads the OSM.XML file line by line
+        Returns:
+            The return value is a generator of (element name, details). The details are the node tuple of
+            get_node_details, or None for an invalid node, the way or relation id, the ref of an nd, the
+            (type, ref, role) of a member and the (key, value) of a tag
+        """
+        with open(self.inputs, 'rb') as xml_file:
+            for xml_line in xml_file:
+                try:
+                    # Source should be in utf-8, but encoding causes problems sometimes
+                    u_line = xml_line.decode('utf-8')
+                    element_name = self.get_element_name(u_line)
+                except Exception as e:
+                    print(f'\tError reading line in file: {xml_line}')
+                    print(e)
+                    continue
+
+                if element_name == 'node':
+                    try:
+                        node_details = self.get_node_details(u_line)
+                    except Exception as e:
+                        print(e)
+                        print('\tError reading node!')
+                        node_details = None
+                    yield element_name, node_details
+                elif element_name == 'tag':
+                    yield element_name, self.get_tag_details(u_line)
+                elif element_name == 'nd':
+                    yield element_name, self.get_attribute_value('ref', u_line)
+                elif element_name == 'way' or element_name == 'relation':
+                    yield element_name, self.return_id(u_line)
+                elif element_name == 'member':
+                    yield element_name, (self.get_attribute_value('type', u_line),
+                                         self.get_attribute_value('ref', u_line),
+                                         self.get_attribute_value('role', u_line))
+                else:
+                    yield element_name, None
+
+    def o5m_elements(self) -> Iterable[tuple]:
+        """
+        Reads the .o5m file with O5mReader
+        Returns:
+            The return value is a generator of (element name, details) like xml_elements, ids and refs as strings
+        """
+        for element in O5mReader(self.inputs).elements():
+            element_name = element[0]
+            if element_name == 'node':
+                yield element_name, (str(element[1]), element[2], element[3])
+            elif element_name == 'way':
+                yield element_name, str(element[1])
+                for ref in element[2]:
+                    yield 'nd', str(ref)
+            else:
+                yield element_name, str(element[1])
+                for member_type, ref, role in element[2]:
+                    yield 'member', (member_type, str(ref), role)
+            for k, v in element[-1]:
+                yield 'tag', (k[:29], v[:254])
+            yield '/' + element_name, None
+
+    def readxml(self, pipeline: Any = None):
+        """
+        Reads, interprets XML file, or .o5m file, then write objects to pickle file.
+        Args:
+            pipeline: Optional Pipeline that is handed the point records, the end of the node section and the finished
+                chunks of the way staging while the file is read
+
+        Returns:
+            None
+        """
+
+        # Create initial temp files to keep track of nodes and ways
+        self.block_count = 1
+
+        open_files = {}
+        if self.lineb or self.polygonb:
+            # Ways are staged once with the list of themes they belong to
+            open_files['way'] = open(os.path.join(self.tempf, 'way.pkl'), 'wb')
+            # Ways without a theme are kept aside in case a relation needs them
+            open_files['untagged_way'] = open(os.path.join(self.tempf, 'untagged_way.pkl'), 'wb')
+            open_files['relation'] = open(os.path.join(self.tempf, 'relation.pkl'), 'wb')
+        for key in self.std_flds:
+            if self.pointb and pipeline is None:
+                open_files[f'{key}_point'] = open(os.path.join(self.tempf, f'{key}_point.pkl'), 'wb')
+
+        node_file = open(os.path.join(self.tempf, f'nodeblock_{self.block_count}.pkl'), 'wb')
+
+        has_valid_tags = False  # Will be set to true when first valid tag is found
+
+        # Create basic objects to keep track of features
+        node_count = 0
+        way_count = 0
+        relation_count = 0
+        point_feature_count = 0
+        # line_count = 0
+        type_code = -1  # -1 is not yet set, 1 is a node, 2 is a way, 3 is a relation
+        relation_members = array('q')  # Way ids used by a staged relation
+        # Records staged per theme, used by ProcessOSM to skip empty themes and order the rest
+        self.stats = {feature: {key: 0 for key in self.categories} for feature in ('point', 'way', 'relation')}
+        way_offsets = array('q')  # Record boundaries in the way staging used to split it into shards
+        nodes_finished = False  # Set at the first way or relation when running as a pipeline
+        way_chunk_start = 0
+        feature_tags = []
+        block_size = self.mem_factor * 1000000  # Size of each temp file for storing nodes
+
+        clip_filter = None
+        if self.clip is not None:
+            if pipeline is not None:
+                raise ValueError('Clipping admits nodes after the ways are read, it cannot run as a pipeline')
+            clip_filter = ClipFilter(self.clip, outside=os.path.join(self.tempf, 'outside_nodes.bin'))
+
+        def write_node(details: tuple) -> None:
+            nonlocal node_file, node_count
+            # Start a new node block if size limit reached
+            if node_count > self.block_count * block_size:
+                node_file.close()
+                self.block_count += 1
+                node_file = open(os.path.join(self.tempf, f'nodeblock_{self.block_count}.pkl'), 'wb')
+            # info = f'{node_details[0]}:{node_details[1]}:{node_details[2]}'
+            # pickle.dump(info, node_file)
+            pickle.dump([details[0], details[1], details[2]], node_file)
+
+            node_count += 1
+            if node_count > 0 and node_count % 1000000 == 0:
+                print(f'\tCounting nodes: {node_count:,}')
+
+        def write_point(key: str, values: dict) -> None:
+            nonlocal point_feature_count
+            if pipeline is None:
+                pickle.dump(values, open_files[f'{key}_point'])
+            else:
+                pipeline.point(key, values)
+            point_feature_count += 1
+            self.stats['point'][key] += 1
+
+        def flush_clip() -> None:
+            nodes, points = clip_filter.flush()
+            for details in nodes:
+                write_node(details)
+            for key, values in points:
+                write_point(key, values)
+
+        elements = self.o5m_elements() if self.inputs.lower().endswith('.o5m') else self.xml_elements()
+        for element_name, details in elements:
+
+            if element_name == 'node':
+
+                type_code = -1  # Still -1 until we know node is valid
+                feature_tags = []
+                has_valid_tags = False
+                if details is None:
+                    continue
+                if nodes_finished:
+                    # The node blocks are already handed to the resolve shards
+                    raise NodeOrderError(f'Node {details[0]} comes after the first way, the pipeline needs every '
+                                         f'node before the ways. Sort the file or run without --pipeline')
+                try:
+                    node_details = details
+
+                    # Make sure node coordinates are valid geographically
+                    if -180 <= node_details[1] <= 180 and -90 <= node_details[2] <= 90:
+                        type_code = 1
+                        if clip_filter is None:
+                            write_node(node_details)
+                        else:
+                            # The batch is tested before the next node, after the point records of this one
+                            if len(clip_filter.nodes) >= clip_filter.batch_size:
+                                flush_clip()
+                            clip_filter.nodes.append(node_details)
+
+                except Exception as e:
+                    print(e)
+                    print('\tError reading node!')
+                    continue
+
+            elif element_name == 'way':
+                if clip_filter is not None and clip_filter.nodes:
+                    flush_clip()
+                if pipeline is not None and not nodes_finished:
+                    nodes_finished = True
+                    node_file.close()
+                    pipeline.nodes_done(self.block_count)
+                type_code = 2
+                has_valid_tags = False
+
+                if way_count > 0 and way_count % 100000 == 0:
+                    print(f'\tCounting ways: {way_count:,}')
+
+                way = (details, '')
+                way_ref_list = []
+                feature_tags = []
+
+            elif element_name == 'relation':
+                if clip_filter is not None and clip_filter.nodes:
+                    flush_clip()
+                if pipeline is not None and not nodes_finished:
+                    nodes_finished = True
+                    node_file.close()
+                    pipeline.nodes_done(self.block_count)
+                type_code = 3
+                has_valid_tags = False
+                relation_id = details
+                relation_member_list = []
+                feature_tags = []
+
+            # nd element will only be found inside a way, save it to its way string
+            elif element_name == 'nd':
+                way_ref_list.append(details)
+            # member element will only be found inside a relation, only way members are used
+            elif element_name == 'member':
+                if details[0] == 'way':
+                    relation_member_list.append(details[1:])
+            # tag elements can be found inside nodes or ways
+            elif element_name == 'tag':
+
+                # Get name and value of the tag
+                tag_details = details
+
+                # If tag is not blank, add it to feature tags list
+                if tag_details[1] != '':
+
+                    # 'from' and 'to' tags need an underscore for some reason
+                    if tag_details[0] == 'from':
+                        tag_details = ('from_', tag_details[1])
+                    if tag_details[0] == 'to':
+                        tag_details = ('to_', tag_details[1])
+
+                    feature_tags.append((tag_details[0].replace(':', '_'), tag_details[1].replace(',', ' ')))
+                    has_valid_tags = True
+
+            # At a /node element (i.e. a node with tags), create a point and insert it into the points feature class
+            elif '/node' in element_name and has_valid_tags and type_code == 1:
+
+                if self.pointb:
+                    # Node details were saved when opening <node> element was read
+
+                    try:
+                        #                 # Loop through the node's tags
+                        for tag_kv in feature_tags:
+                            node_cursor_key = tag_kv[0]
+                            # If tag matches a feature class, find that cursor
+                            if node_cursor_key in self.categories:
+                                values = {'node_id': node_details[0],
+                                          'geometry': Point(node_details[1], node_details[2])}
+                                # node_cat = node_cursor_key
+                                node_fieldnames = self.std_flds[node_cursor_key]
+                                # Loop through tags again, inserting into field values
+                                for the_tag in feature_tags:
+                                    the_key = the_tag[0]
+                                    if the_key in node_fieldnames:
+                                        value = str(the_tag[1])
+                                        values[the_key] = value
+
+                                if clip_filter is None:
+                                    write_point(node_cursor_key, values)
+                                else:
+                                    clip_filter.add_point(node_cursor_key, values)
+                    except Exception as e:
+                        print(f'\tError processing node with ID: {node_details[0]}')
+                        print(e)
+
+                has_valid_tags = False  # Reset valid tags flag
+
+            # No way will be only one line in the XML, we will have read through its
+            # component <nd ref> and <tag> elements
+            elif '/way' in element_name:
+
+                # Done with way, now let's load its attributes (shape comes later)
+                # Need to go back and come up with a better place to put this
+                if (self.lineb or self.polygonb) and \
+                        (clip_filter is None or clip_filter.contains('node', way_ref_list)):
+                    way_id = str(way[0])  # From first line of way XML
+                    if clip_filter is not None:
+                        clip_filter.add('way', way_id)
+                        clip_filter.need(way_ref_list)
+                    try:
+                        # Loop through the way's tags to find the themes it belongs to
+                        way_themes = []
+                        way_fieldnames = set()
+                        for tag_kv in feature_tags if has_valid_tags else []:
+                            key = tag_kv[0]
+                            # If tag matches a feature class, we will use this way
+                            if key in self.categories and key not in way_themes:
+                                way_themes.append(key)
+                                way_fieldnames.update(self.std_flds[key])
+
+                        if len(way_themes) > 0:
+                            values = {'attrib': {}}
+                            # Loop through tags again, inserting into field values of any of the themes
+                            for the_tag in feature_tags:
+                                the_key = the_tag[0]
+                                if the_key in way_fieldnames:
+                                    value = str(the_tag[1])
+                                    values['attrib'][the_key] = value
+
+                            values['ref'] = way_ref_list  # Used as an index to align points in the correct sequence
+                            values['ref_remaing'] = way_ref_list  # Used to keep track of nodes in geometry creation
+                            values['themes'] = way_themes
+                            values['way_id'] = way_id
+                            values['coords'] = {}  # Place Holder for Ref Coords
+
+                            # Dump way values to the shared way staging
+                            pickle.dump(values, open_files['way'])
+                            way_count += 1
+                            for key in way_themes:
+                                self.stats['way'][key] += 1
+                            if way_count % 1000 == 0:
+                                way_offsets.append(open_files['way'].tell())
+                                # Hand finished chunks of the staging to the pipeline
+                                if pipeline is not None and \
+                                        way_offsets[-1] - way_chunk_start >= pipeline.chunk_size:
+                                    open_files['way'].flush()
+                                    pipeline.way_chunk(way_chunk_start, way_offsets[-1])
+                                    way_chunk_start = way_offsets[-1]
+                        else:
+                            pickle.dump((way_id, way_ref_list), open_files['untagged_way'])
+
+                    except Exception as e:
+                        print(e)
+                        print(f'\tError reading way with id: {way_id}')
+
+                has_valid_tags = False  # Reset valid tags flag
+
+            # Relations are staged with their member ways, the geometry is assembled after the ways are resolved
+            elif '/relation' in element_name and has_valid_tags and type_code == 3:
+
+                if self.lineb or self.polygonb:
+                    try:
+                        relation_type = dict(feature_tags).get('type')
+                        relation_themes = []
+                        relation_fieldnames = set()
+                        # Multipolygons end up in the polygon layers and routes in the line layers
+                        if relation_type == 'multipolygon' and self.polygonb or relation_type == 'route' and self.lineb:
+                            for tag_kv in feature_tags:
+                                key = tag_kv[0]
+                                if key in self.categories and key not in relation_themes:
+                                    relation_themes.append(key)
+                                    relation_fieldnames.update(self.std_flds[key])
+
+                        if clip_filter is not None and not clip_filter.contains(
+                                'way', [member[0] for member in relation_member_list]):
+                            relation_themes = []
+                        if len(relation_themes) > 0 and len(relation_member_list) > 0:
+                            values = {'relation_id': relation_id,
+                                      'relation_type': relation_type,
+                                      'members': relation_member_list,
+                                      'themes': relation_themes,
+                                      'attrib': {}}
+                            for the_tag in feature_tags:
+                                if the_tag[0] in relation_fieldnames:
+                                    values['attrib'][the_tag[0]] = str(the_tag[1])
+
+                            pickle.dump(values, open_files['relation'])
+                            relation_members.extend(int(member[0]) for member in relation_member_list)
+                            relation_count += 1
+                            for key in relation_themes:
+                                self.stats['relation'][key] += 1
+
+                    except Exception as e:
+                        print(e)
+                        print(f'\tError reading relation with id: {relation_id}')
+
+                has_valid_tags = False  # Reset valid tags flag
+
+        if clip_filter is not None:
+            flush_clip()
+            for details in clip_filter.admitted():
+                write_node(details)
+
+        print(f'\tCount: {node_count:,} nodes, {way_count:,} ways, {relation_count:,} relations')
+        print(f'\tPoint features produced: {point_feature_count:,}')
+
+        # Close files that were written to
+        node_file.close()
+
+        for key in open_files:
+            open_files[key].close()
+
+        with open(os.path.join(self.tempf, 'staging_stats.json'), 'w') as stats_file:
+            json.dump(self.stats, stats_file)
+
+        if self.lineb or self.polygonb:
+            self.stage_member_ways(relation_members, way_offsets)
+
+        if pipeline is not None:
+            if not nodes_finished:
+                pipeline.nodes_done(self.block_count)
+            if self.lineb or self.polygonb:
+                pipeline.ways_done(way_chunk_start, os.path.getsize(os.path.join(self.tempf, 'way.pkl')))
+
+    def stage_member_ways(self, relation_members: array, way_offsets: array) -> None:
+        """
+        Saves the sorted relation member ids and moves the untagged ways that are relation members into the way
+        staging so their geometry is resolved along with the themed ways. The record offsets of the way staging
+        are saved as well.
+        Args:
+            relation_members: Way ids of all the staged relation members
+            way_offsets: Record boundaries in the way staging
+
+        Returns:
+            None
+        """
+        members = np.unique(np.frombuffer(relation_members, dtype='int64'))
+        np.save(os.path.join(self.tempf, 'member_ids.npy'), members)
+
+        untagged = os.path.join(self.tempf, 'untagged_way.pkl')
+        member_count = 0
+        if len(members) > 0:
+            with open(os.path.join(self.tempf, 'way.pkl'), 'ab') as way_file:
+                for way_id, way_ref_list in ProcessOSM.loadall(untagged):
+                    if is_member(members, way_id):
+                        values = {'attrib': {}, 'ref': way_ref_list, 'ref_remaing': way_ref_list, 'themes': [],
+                                  'way_id': way_id, 'coords': {}}
+                        pickle.dump(values, way_file)
+                        member_count += 1
+                        if member_count % 1000 == 0:
+                            way_offsets.append(way_file.tell())
+        os.remove(untagged)
+        np.save(os.path.join(self.tempf, 'way_offsets.npy'), np.frombuffer(way_offsets, dtype='int64'))
+        print(f'\tUntagged relation member ways: {member_count:,}')
+
+
+# Node set aside by ClipFilter
+OUTSIDE_NODE = np.dtype([('id', '<i8'), ('lon', '<f8'), ('lat', '<f8')])
+
+
+class ClipFilter:
+    """
+    Keeps the part of the OSM.XML inside a clip polygon or bbox while it is read. Nodes are collected and tested in
+    batches, a bounds test first and a point in polygon test of the prepared geometry only for the nodes inside the
+    bounds. A way is kept when any of its nodes is inside and a relation when any of its member ways is kept. Nodes
+    outside are set aside in the outside file and only the ones used by kept ways are admitted at the end, so a way
+    that crosses the border keeps all of its nodes.
+    """
+
+    def __init__(self, geometry: Any, batch_size: int = 100000, outside: str = None):
+        self.geometry = geometry
+        self.bounds = geometry.bounds
+        # A bbox needs nothing but the bounds test
+        self.is_box = bool(shapely.equals(geometry, shapely.box(*self.bounds)))
+        shapely.prepare(geometry)
+        self.batch_size = batch_size
+        self.nodes = []  # (id, lon, lat) of the batch
+        self.points = []  # (node index in the batch, theme, point record) of the batch
+        # Kept ids, looked up by bisection as long as they were added in order
+        self.ids = {'node': array('q'), 'way': array('q')}
+        self.ordered = {'node': True, 'way': True}
+        # Nodes outside as OUTSIDE_NODE records and the node refs of the kept ways, None drops the nodes outside
+        self.outside = outside
+        self.outside_file = open(outside, 'wb') if outside is not None else None
+        self.needed = array('q')
+
+    def add_point(self, theme: str, values: dict) -> None:
+        """
+        Point record of the last node added to the batch
+        """
+        self.points.append((len(self.nodes) - 1, theme, values))
+
+    def inside(self, lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+        minx, miny, maxx, maxy = self.bounds
+        mask = (lon >= minx) & (lon <= maxx) & (lat >= miny) & (lat <= maxy)
+        if not self.is_box and mask.any():
+            mask[mask] = shapely.intersects_xy(self.geometry, lon[mask], lat[mask])
+        return mask
+
+    def flush(self) -> tuple:
+        """
+        Test the batch of nodes
+        Returns:
+            The return value is a tuple of the node details and the (theme, point record) of the nodes inside
+        """
+        if len(self.nodes) == 0:
+            return [], []
+        coords = np.array([(node[1], node[2]) for node in self.nodes], dtype=np.float64)
+        mask = self.inside(coords[:, 0], coords[:, 1])
+        keep = mask.tolist()
+        nodes = [node for node, inside in zip(self.nodes, keep) if inside]
+        points = [(theme, values) for index, theme, values in self.points if mask[index]]
+        if self.outside_file is not None and len(nodes) < len(self.nodes):
+            np.array([(int(node[0]), node[1], node[2]) for node, inside in zip(self.nodes, keep) if not inside],
+                     dtype=OUTSIDE_NODE).tofile(self.outside_file)
+        for node in nodes:
+            self.add('node', node[0])
+        self.nodes, self.points = [], []
+        return nodes, points
+
+    def add(self, kind: str, element_id: str) -> None:
+        ids = self.ids[kind]
+        element_id = int(element_id)
+        if len(ids) > 0 and element_id < ids[-1]:
+            self.ordered[kind] = False
+        ids.append(element_id)
+
+    def need(self, refs: list) -> None:
+        """
+        Node refs of a kept way
+        """
+        self.needed.extend(int(ref) for ref in refs)
+
+    def admitted(self) -> Iterable[tuple]:
+        """
+        Nodes outside that are used by the kept ways, once all ways are read
+        Returns:
+            The return value is a generator of the (id, lon, lat) node details
+        """
+        if self.outside_file is None:
+            return
+        self.outside_file.close()
+        needed = np.unique(np.frombuffer(self.needed, dtype=np.int64))
+        with open(self.outside, 'rb') as outside_file:
+            while True:
+                records = np.fromfile(outside_file, dtype=OUTSIDE_NODE, count=self.batch_size)
+                if len(records) == 0:
+                    break
+                for node_id, lon, lat in records[np.isin(records['id'], needed)].tolist():
+                    yield str(node_id), lon, lat
+        os.remove(self.outside)
+        self.outside_file = None
+
+    def contains(self, kind: str, refs: list) -> bool:
+        """
+        Whether any of the node or way ids is kept
+        """
+        if not self.ordered[kind]:
+            self.ids[kind] = array('q', np.sort(np.frombuffer(self.ids[kind], dtype=np.int64)).tobytes())
+            self.ordered[kind] = True
+        ids = self.ids[kind]
+        count = len(ids)
+        for ref in refs:
+            ref = int(ref)
+            position = bisect_left(ids, ref)
+            if position < count and ids[position] == ref:
+                return True
+        return False
+
+
+class PendingWays:
+    """
+    Keeps track of ways that are still missing node coordinates while the node blocks are processed.
+
+    Unresolved ways stay in memory as long as the number of node references they hold fits the budget. Anything
+    over the budget is spilled to a pickle file in the temp folder, so only the overflow is rewritten per block.
+    Completed ways are handed back to the caller and never written again.
+    """
+
+    def __init__(self, staged: str, tempf: str, name: str, budget: int, start: int = 0, end: int = None):
+        self.tempf = tempf
+        self.name = name
+        self.budget = budget
+        self.ways = []
+        self.refs = 0  # Node references held by the in memory ways
+        self.staged = (staged, start, end)  # Byte range of the way staging that belongs to this set
+        self.spilled = staged  # First pass streams the staged ways from readxml
+        self.spill_count = None
+        self.spill_num = 0
+        self.spill_file = None
+
+    def __len__(self) -> int:
+        return len(self.ways) + (self.spill_count or 0)
+
+    def add(self, way: dict) -> None:
+        """
+        Keep an unresolved way in memory or spill it when the budget is used up
+        Args:
+            way: Way dictionary from readxml
+
+        Returns:
+            None
+        """
+        weight = len(way['ref'])
+        if self.refs + weight <= self.budget:
+            self.ways.append(way)
+            self.refs += weight
+        else:
+            if self.spill_file is None:
+                self.spill_num += 1
+                self.spill_file = open(os.path.join(self.tempf, f'pending_{self.name}_{self.spill_num}.pkl'), 'wb')
+                self.spill_count = 0
+            pickle.dump(way, self.spill_file)
+            self.spill_count += 1
+
+    def resolve(self, nodes: dict) -> Iterable[dict]:
+        """
+        Look up the remaining node references of every pending way in a node block
+        Args:
+            nodes: Dictionary of node id to coordinates for the current block
+
+        Returns:
+            The return value. Generator of ways that have all of their coordinates
+        """
+        in_memory = self.ways
+        spilled = self.spilled
+        self.ways = []
+        self.refs = 0
+        self.spilled = None
+        self.spill_count = None
+
+        for way in self._pending(in_memory, spilled, self.staged):
+            ref_remaing = []
+            for way_node_id in way['ref_remaing']:
+                if way_node_id in nodes:
+                    way['coords'][way_node_id] = nodes[way_node_id]
+                else:
+                    ref_remaing.append(way_node_id)
+
+            if len(ref_remaing) == 0:
+                yield way
+            else:
+                way['ref_remaing'] = ref_remaing
+                self.add(way)
+
+        if self.spill_file is not None:
+            self.spilled = self.spill_file.name
+            self.spill_file.close()
+            self.spill_file = None
+
+    @staticmethod
+    def _pending(in_memory: list, spilled: str, staged: tuple) -> Iterable[dict]:
+        """
+        Drains the in memory ways then lazy loads the spilled ways, deleting the spill file once it is read.
+        The way staging is shared between shards so only its byte range is read and the file is kept.
+        """
+        while in_memory:
+            yield in_memory.pop()
+        if spilled is not None and spilled == staged[0]:
+            yield from ProcessOSM.loadall(*staged)
+        elif spilled is not None and os.path.exists(spilled):
+            yield from ProcessOSM.loadall(spilled)
+            os.remove(spilled)
+
+    def close(self) -> None:
+        """
+        Drop any ways left over and remove the spill file
+        """
+        self.ways = []
+        self.refs = 0
+        if self.spilled is not None and self.spilled != self.staged[0] and os.path.exists(self.spilled):
+            os.remove(self.spilled)
+        self.spilled = None
+        self.spill_count = None
+
+
+class ProcessOSM:
+    """
+    Processing Class that readout the output fro the ReadOSM process
+    """
+
+    def __init__(self, themes: list, features: list, workers: int,
+                 tempf: str, output: str, prefix: str, block_count: int, mem_factor: int = 4,
+                 output_format: str = 'gpkg', layer_chunk: int = 50000, single: bool = False, max_zoom: int = 14,
+                 partition_zoom: int = None, clip: bool = False, precision: float = None, simplify: dict = None):
+        self.themes = themes
+        self.features = features
+        self.tempf = tempf
+        self.block_count = block_count
+        self.workers = workers
+        self.output = output
+        self.prefix = prefix
+        self.output_format = output_format  # Key of writers.FORMATS
+        self.layer_chunk = layer_chunk  # Features per chunk appended to an output layer
+        self.single = single  # Every layer goes to {prefix}.gpkg through one writer process
+        self.max_zoom = max_zoom  # Last zoom level of the mbtiles format
+        self.partition_zoom = partition_zoom  # Zoom of the quadkey tiles the layers are split into, None for no split
+        self.clip = clip  # Cut the features of a partitioned export to the tiles they cross
+        self.precision = precision  # Grid size in degrees the output coordinates are snapped to
+        self.simplify = simplify or {}  # Theme to simplification tolerance in degrees
+        # Node references a worker keeps in memory for unresolved ways, same scale as the node blocks
+        self.way_budget = mem_factor * 1000000
+        # Staging bytes handled by one worker, larger staging files are split into shards
+        self.shard_size = 64 * 1024 * 1024
+
+        self.pointb = False
+        self.lineb = False
+        self.polygonb = False
+        self.std_flds = None
+        self.categories = None
+
+        if 'point' in features:
+            self.pointb = True
+
+        if 'line' in features:
+            self.lineb = True
+
+        if 'polygon' in features:
+            self.polygonb = True
+
+        self.std_flds = read_themes(themes)
+        self.categories = list(self.std_flds)
+        self.field_types = read_field_types()  # Numeric fields parsed when a layer chunk is written
+
+    def process(self) -> None:
+        """
+        Mutliprocessing loop for point and line/polygons. Cleans up tmp directory at the end
+
+        """
+        writer = start_output(self.single_output()) if self.single else None
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=set_output_queue,
+                                     initargs=(output_queue(),)) as executor:
+                scheduler = ThemeScheduler(self, executor)
+
+                # The resolve shards hold the most work so they go in first, followed by the largest themes.
+                if self.lineb or self.polygonb:
+                    if all(costs[0] == 0 for costs in self.theme_costs('way').values()):
+                        print('\tSkipping way resolution, no ways or relations were staged')
+                    else:
+                        shards = self.plan_shards()
+                        print(f'Resolving ways in {len(shards)} shards')
+                        for start, end in shards:
+                            scheduler.submit_resolve(start, end)
+                scheduler.close_resolve()
+
+                if self.pointb:
+                    for theme in self.schedule('point'):
+                        scheduler.submit_points(theme)
+
+                scheduler.run()
+                self.finish_output(executor)
+
+        except BrokenProcessPool as e:
+            print(e)
+            print('This was more than likely a memory issue. Try running with fewer or even 1 '
+                  'work to troubleshoot problem')
+
+        if writer is not None:
+            stop_output(writer)
+        if os.path.exists(self.tempf):
+            rmtree(self.tempf)
+
+    def single_output(self) -> str:
+        return os.path.join(self.output, f'{self.prefix}.gpkg')
+
+    def finish_output(self, executor: ProcessPoolExecutor) -> None:
+        """
+        Formats that are built from the finished layers. For mbtiles the staged layers are tiled by the process pool
+        into {prefix}.mbtiles and removed afterwards, a partitioned export gets the manifest of its partitions.
+        Args:
+            executor: Process pool of the export
+
+        Returns:
+            None
+        """
+        if self.partition_zoom is not None:
+            manifest = write_manifest(self.output, self.prefix, self.partition_zoom, self.clip, self.output_format)
+            print(f'Wrote partition manifest {manifest}')
+        if self.output_format != 'mbtiles':
+            return
+        layers = [(f'{theme}_{feature}', TileLayerWriter.layer_path(self.output, f'{self.prefix}_{theme}', feature))
+                  for theme in self.themes for feature in self.features]
+        print(f'Building vector tiles up to zoom {self.max_zoom}')
+        build_mbtiles(layers, os.path.join(self.output, f'{self.prefix}.mbtiles'), executor, self.workers,
+                      max_zoom=self.max_zoom, name=self.prefix)
+        for _, path in layers:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def theme_costs(self, feature: str) -> dict:
+        """
+        Reads the staging record counts from readxml and the staging file sizes of each theme
+        Args:
+            feature: point or way
+
+        Returns:
+            The return value is a dictionary of theme to (records, bytes), records is None if readxml did not save
+            its counts
+
+        """
+        stats = None
+        stats_file = os.path.join(self.tempf, 'staging_stats.json')
+        if os.path.exists(stats_file):
+            with open(stats_file) as fp:
+                stats = json.load(fp)
+
+        costs = {}
+        for theme in self.themes:
+            if feature == 'point':
+                records = None if stats is None else stats['point'].get(theme, 0)
+                files = [os.path.join(self.tempf, f'{theme}_point.pkl')]
+            else:
+                records = None if stats is None else stats['way'].get(theme, 0) + stats['relation'].get(theme, 0)
+                files = glob.glob(os.path.join(self.tempf, f'{theme}_resolved_*.pkl'))
+                files.append(os.path.join(self.tempf, f'{theme}_relation.pkl'))
+            costs[theme] = (records, sum(os.path.getsize(each) for each in files if os.path.exists(each)))
+        return costs
+
+    def schedule(self, feature: str) -> list:
+        """
+        Drops the themes without any staged records and orders the rest largest first, so the biggest themes are not
+        left to run on their own at the end
+        Args:
+            feature: point or way
+
+        Returns:
+            The return value is the list of themes in submit order
+
+        """
+        costs = self.theme_costs(feature)
+        themes = [theme for theme in self.themes if costs[theme][0] != 0]
+        themes.sort(key=lambda each: costs[each][1], reverse=True)
+
+        empty = [theme for theme in self.themes if costs[theme][0] == 0]
+        if len(empty) > 0:
+            print(f'Skipping empty {feature} themes: {", ".join(empty)}')
+
+        order = ', '.join(f'{theme} ({costs[theme][1] / 1000000:,.1f} MB'
+                          + ('' if costs[theme][0] is None else f', {costs[theme][0]:,} records') + ')'
+                          for theme in themes)
+        print(f'Scheduling {feature} themes largest first: {order}')
+        return themes
+
+    def plan_shards(self) -> list:
+        """
+        Splits the way staging into byte ranges for the resolve workers. The number of shards follows the size of the
+        staging file and is capped by the number of workers.
+        Returns:
+            The return value is a list of (start, end) byte offsets
+
+        """
+        way_file = os.path.join(self.tempf, 'way.pkl')
+        size = os.path.getsize(way_file) if os.path.exists(way_file) else 0
+        count = max(1, min(self.workers, math.ceil(size / self.shard_size)))
+
+        offsets_file = os.path.join(self.tempf, 'way_offsets.npy')
+        offsets = np.load(offsets_file) if os.path.exists(offsets_file) else np.empty(0, dtype='int64')
+
+        # Shards can only start on a record boundary
+        bounds = [0]
+        for k in range(1, count):
+            i = np.searchsorted(offsets, size * k / count)
+            if i < len(offsets) and bounds[-1] < offsets[i] < size:
+                bounds.append(int(offsets[i]))
+        bounds.append(size)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def plan_theme(self, theme: str, shard_count: int) -> list:
+        """
+        Groups the resolved shards of a theme into the parts built by separate workers. Small themes are built in
+        one part, large ones get a part per resolved shard.
+        Args:
+            theme: Key theme from OSM
+            shard_count: Number of resolve shards
+
+        Returns:
+            The return value is a list of lists of shard numbers
+
+        """
+        sizes = []
+        for shard in range(shard_count):
+            resolved = os.path.join(self.tempf, f'{theme}_resolved_{shard}.pkl')
+            sizes.append(os.path.getsize(resolved) if os.path.exists(resolved) else 0)
+
+        if sum(sizes) <= self.shard_size or shard_count <= 1:
+            return [list(range(shard_count))]
+        return [[shard] for shard in sorted(range(shard_count), key=lambda each: sizes[each], reverse=True)]
+
+    def process_nodes(self, theme: str) -> str:
+        """
+        Process Point Themes in a GeoPackage
+        Args:
+            theme: Key theme from OSM
+
+        Returns:
+            The return value. String that describes completion
+
+        """
+        print(f'Processing Nodes for {theme}')
+
+        # Stream the point records from the pickle file
+        pkl_points = os.path.join(self.tempf, f'{theme}_point.pkl')
+        return self.write_points(theme, self.loadall(pkl_points))
+
+    def write_points(self, theme: str, nodes: Iterable[dict]) -> str:
+        """
+        Builds and writes the point layer of a theme from the point records of readxml
+        Args:
+            theme: Key theme from OSM
+            nodes: Point records
+
+        Returns:
+            The return value. String that describes completion
+
+        """
+        begin_time = time.time()
+
+        points = self.layer_builder(theme, 'point')
+        for node in nodes:
+            points.add(node)
+        points.close()
+        if points.count == 0:
+            print(f'Point Theme {theme} is empty')
+
+        text = f'Point Theme {theme} completed after {timer(begin_time, time.time())} with {points.count} points.'
+        return text
+
+    @staticmethod
+    def loadall(filename: str, start: int = 0, end: int = None) -> Iterable[Any]:
+        """
+        Sequential Lazy Unpickler
+        Args:
+            filename: Filename of pickle file
+            start: Byte offset of the first record to read
+            end: Byte offset to stop reading at, the end of the file if None
+
+        Returns:
+            The return value. Unpickled OBject
+
+        """
+        with open(filename, "rb") as f:
+            f.seek(start)
+            while end is None or f.tell() < end:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    break
+
+    def resolve_ways(self, shard: int = 0, start: int = 0, end: int = None, store_members: bool = True) -> str:
+        """
+        Resolves the coordinates of every staged way once, no matter how many themes it belongs to, and fans the
+        finished shape out to a resolved pickle file for each of its themes.
+        Args:
+            shard: Shard number used to name the output files
+            start: Byte offset of the shard in the way staging
+            end: Byte offset of the end of the shard, the end of the file if None
+            store_members: Keep the shapes of relation members, off when the members are not known yet and
+                collect_members picks them up later
+
+        Returns:
+            The return value. String that describes completion
+
+        """
+        begin_time = time.time()
+        print(f'Resolving way geometries for shard {shard}')
+
+        resolved_files = {theme: open(os.path.join(self.tempf, f'{theme}_resolved_{shard}.pkl'), 'wb')
+                          for theme in self.categories}
+        resolved_count = 0
+        # Shapes of ways that belong to a relation are kept for the relation stage
+        members = member_ids(os.path.join(self.tempf, 'member_ids.npy')) if store_members else np.empty(0, 'int64')
+        member_store = WayGeometryStore(os.path.join(self.tempf, f'member_geom_{shard}.sqlite'))
+
+        """
+        Loop through each node block, loading each into memory in turn
+        All ways share a single staging file while the nodes have multiple files
+        With each iteration of a node file a way is either finished when it has all it nodes
+        or kept in the pending set with the coordinate information from the nodes it could find
+        """
+        pending = PendingWays(os.path.join(self.tempf, 'way.pkl'), self.tempf, f'way_{shard}', self.way_budget,
+                              start, end)
+        for block_num in range(1, self.block_count + 1):
+            nodes = {}
+            print(f'\tLoading block: {block_num} of {self.block_count} for way shard {shard}')
+            node_file = os.path.join(self.tempf, f'nodeblock_{block_num}.pkl')
+            nodes_file_list = list(self.loadall(node_file))
+            # Add nodes from block to a dictionary
+            try:
+                for node_string in nodes_file_list:
+                    nodes[node_string[0]] = (node_string[1], node_string[2])
+            except Exception as e:
+                print(e)
+                print(f'\t\tError loading block: {block_num} of {self.block_count}')
+                continue  # Should still get some useful features if we continue
+
+            # Completed ways come back from the pending set, the rest stay in memory or in the spill file
+            for way in pending.resolve(nodes):
+                way_shape = []
+                for nd in way['ref']:
+                    way_shape.append((float(way['coords'][nd][0]), float(way['coords'][nd][1])))
+
+                if is_member(members, way['way_id']):
+                    member_store.add(way['way_id'], way_shape)
+
+                # Geometry is shared, only the attributes of each theme are split out
+                for theme in way['themes']:
+                    if theme in resolved_files:
+                        fields = self.std_flds[theme]
+                        attrib = {key: value for key, value in way['attrib'].items() if key in fields}
+                        pickle.dump({'way_id': way['way_id'], 'shape': way_shape, 'attrib': attrib},
+                                    resolved_files[theme])
+
+                resolved_count += 1
+                if resolved_count % 100000 == 0:
+                    print(f'\t\tResolved ways: {resolved_count:,}')
+
+            nodes.clear()
+
+        if len(pending) > 0:
+            print(f'\t{len(pending):,} ways are missing nodes and were skipped')
+        pending.close()
+        member_store.close()
+
+        for theme in resolved_files:
+            resolved_files[theme].close()
+
+        text = f'Resolved {resolved_count:,} ways in shard {shard} after {timer(begin_time, time.time())}'
+        return text
+
+    def collect_members(self, shard: int) -> str:
+        """
+        Copies the relation members of a shard that was resolved before the members were known from its resolved
+        theme files into the member store
+        Args:
+            shard: Shard number of the resolved files
+
+        Returns:
+            The return value. String that describes completion
+        """
+        members = member_ids(os.path.join(self.tempf, 'member_ids.npy'))
+        if len(members) == 0:
+            return f'No relation members to collect for shard {shard}'
+        member_store = WayGeometryStore(os.path.join(self.tempf, f'member_geom_{shard}.sqlite'))
+        collected = set()
+        for theme in self.categories:
+            # A way is in the resolved file of each of its themes
+            for way in self.loadall(os.path.join(self.tempf, f'{theme}_resolved_{shard}.pkl')):
+                if way['way_id'] not in collected and is_member(members, way['way_id']):
+                    member_store.add(way['way_id'], way['shape'])
+                    collected.add(way['way_id'])
+        member_store.close()
+        return f'Collected {len(collected):,} relation members from shard {shard}'
+
+    def process_relations(self) -> str:
+        """
+        Assembles the staged relations from the member way shapes saved by resolve_ways and fans the geometry out to
+        a relation pickle file for each of its themes.
+        Returns:
+            The return value. String that describes completion
+
+        """
+        begin_time = time.time()
+        print('Processing relations')
+
+        relation_files = {theme: open(os.path.join(self.tempf, f'{theme}_relation.pkl'), 'wb')
+                          for theme in self.categories}
+        member_stores = [WayGeometryStore(filename)
+                         for filename in glob.glob(os.path.join(self.tempf, 'member_geom_*.sqlite'))]
+        relation_count = 0
+        failed_count = 0
+
+        # Relations are loaded in chunks so member shapes are looked up in bulk
+        chunk = []
+        for relation in itertools.chain(self.loadall(os.path.join(self.tempf, 'relation.pkl')), [None]):
+            if relation is not None:
+                chunk.append(relation)
+                if len(chunk) < 1000:
+                    continue
+
+            way_ids = [member[0] for each in chunk for member in each['members']]
+            shapes = {}
+            for member_store in member_stores:
+                shapes.update(member_store.get(way_ids))
+            for each in chunk:
+                try:
+                    geometry = None
+                    if each['relation_type'] == 'multipolygon':
+                        geometry = assemble_multipolygon(each['members'], shapes)
+                    elif each['relation_type'] == 'route':
+                        geometry = assemble_route(each['members'], shapes)
+                except Exception as e:
+                    print(e)
+                    print(f'\tError building relation with id: {each["relation_id"]}')
+                    geometry = None
+
+                if geometry is None:
+                    failed_count += 1
+                    continue
+
+                for theme in each['themes']:
+                    if theme in relation_files:
+                        fields = self.std_flds[theme]
+                        attrib = {key: value for key, value in each['attrib'].items() if key in fields}
+                        pickle.dump({'relation_id': each['relation_id'], 'relation_type': each['relation_type'],
+                                     'geometry': geometry, 'attrib': attrib}, relation_files[theme])
+                relation_count += 1
+            chunk = []
+
+        for member_store in member_stores:
+            member_store.close()
+        for theme in relation_files:
+            relation_files[theme].close()
+
+        text = f'Built {relation_count:,} relations after {timer(begin_time, time.time())}, ' \
+               f'{failed_count:,} relations could not be built'
+        return text
+
+    def process_ways(self, theme: str, shards: list = None, part: int = None) -> str:
+        """
+        Each way is either a line or a polygon and its geometry and fields are added to the layer builder, which writes
+        them out in chunks of layer_chunk features. The way coordinates are already resolved by resolve_ways.
+
+        Multipolygon and route relations built by process_relations are added to the polygon and line layers with a
+        relation_id
+
+        Large themes are built in parts that each write partial layers, see merge_parts
+        Args:
+            theme: Key theme from OSM
+            shards: Resolve shards to build, all of them if None
+            part: Part number of a large theme, None when the theme is built in one go
+
+        Returns:
+            The return value. String that describes completion
+
+        """
+        begin_time = time.time()
+        print(f'Processing Ways for {theme}' + ('' if part is None else f' part {part}'))
+
+        if self.lineb:
+            lines = self.layer_builder(theme, 'line', part)
+        if self.polygonb:
+            polygons = self.layer_builder(theme, 'polygon', part)
+
+        completed_lines_count = 0
+        completed_polygons_count = 0
+        completed_ways_count = 0
+
+        try:
+            if shards is None:
+                pkl_ways = sorted(glob.glob(os.path.join(self.tempf, f'{theme}_resolved_*.pkl')))
+            else:
+                pkl_ways = [os.path.join(self.tempf, f'{theme}_resolved_{shard}.pkl') for shard in shards]
+            for way in itertools.chain.from_iterable(self.loadall(each) for each in pkl_ways if os.path.exists(each)):
+
+                if completed_ways_count > 0 and completed_ways_count % 10000 == 0:
+                    print(f'\t\tBuilt ways: {completed_ways_count:,}')
+
+                way_shape = way['shape']
+
+                # There are ways in the OSM file that are missing corresponding nodes.
+                # There are also some ways with partial nodes but the nodes seem to still be in order
+                if len(way_shape) <= 1:
+                    continue
+
+                # Get first and last nodes
+                start_point = way_shape[0]
+                end_point = way_shape[-1]
+
+                # If closed way, examine attributes to determine whether to force the way to be a line
+                if start_point[0] == end_point[0] and start_point[1] == end_point[1]:
+                    force_way_to_line = self.determine_force_way_to_line(theme, way['attrib'])
+
+                # Process Lines
+                if self.lineb and (not (
+                        start_point[0] == end_point[0] and start_point[1] == end_point[1]) or
+                                   force_way_to_line):
+                    lines.add({**way['attrib'], 'way_id': way['way_id'], 'geometry': LineString(way_shape)})
+                    completed_lines_count += 1
+
+                # Find polygons...need at least three points
+                elif self.polygonb and (start_point[0] == end_point[0] and start_point[1] == end_point[1] and
+                                        len(way_shape) > 3):
+                    polygons.add({**way['attrib'], 'way_id': way['way_id'], 'geometry': Polygon(way_shape)})
+                    completed_polygons_count += 1
+
+            # Multipolygon relations are added to the polygon layer and routes to the line layer
+            pkl_relations = os.path.join(self.tempf, f'{theme}_relation.pkl')
+            if part in (None, 0) and os.path.exists(pkl_relations):
+                for relation in self.loadall(pkl_relations):
+                    if self.polygonb and relation['relation_type'] == 'multipolygon':
+                        builder = polygons
+                        completed_polygons_count += 1
+                    elif self.lineb and relation['relation_type'] == 'route':
+                        builder = lines
+                        completed_lines_count += 1
+                    else:
+                        continue
+                    builder.add({**relation['attrib'], 'way_id': '', 'relation_id': relation['relation_id'],
+                                 'geometry': relation['geometry']})
+
+            print(f'Finishing {self.output_format} output for {theme}')
+
+            if self.polygonb:
+                polygons.close()
+
+            if self.lineb:
+                lines.close()
+                if lines.count == 0:
+                    print(f'Line Theme {theme} is empty')
+
+            text = f'Line and Polygon Theme {theme}' + ('' if part is None else f' part {part}') + \
+                   f' completed after {timer(begin_time, time.time())}' \
+                   f'with {completed_lines_count} lines and {completed_polygons_count} polygons.'
+        except Exception as e:
+            print(e)
+            text = f'Line and Polygon Theme {theme}' + ('' if part is None else f' part {part}') + f' failed: {e}'
+
+        return text
+
+    def merge_parts(self, theme: str, part_count: int) -> str:
+        """
+        Appends the partial layers of a large theme into its output layers
+        Args:
+            theme: Key theme from OSM
+            part_count: Number of parts the theme was built in
+
+        Returns:
+            The return value. String that describes completion
+
+        """
+        begin_time = time.time()
+        for feature in [each for each in ('polygon', 'line') if each in self.features]:
+            writer = self.layer_writer(theme, feature)
+            for part in range(part_count):
+                writer.copy(writer.layer_path(self.tempf, f'{theme}_part{part}', feature))
+            writer.close()
+
+        text = f'Merged {part_count} parts of {theme} theme after {timer(begin_time, time.time())}'
+        return text
+
+    def layer_builder(self, theme: str, feature: str, part: int = None) -> LayerBuilder:
+        """
+        Open a builder for a theme layer with the fields of the theme
+        Args:
+            theme: Key theme from OSM
+            feature: point, line or polygon
+            part: Part number of a large theme
+
+        Returns:
+            The return value is a LayerBuilder, close it once every feature is added
+        """
+        ids = ['node_id'] if feature == 'point' else ['way_id', 'relation_id']
+        fields = ids + ['geometry'] + read_themes([theme])[theme]
+        return LayerBuilder(self.layer_writer(theme, feature, part), fields, self.layer_chunk, self.field_types,
+                            self.precision, self.simplify.get(theme))
+
+    def layer_writer(self, theme: str, feature: str, part: int = None) -> LayerWriter:
+        """
+        Open the writer of a theme layer in the output format
+        Args:
+            theme: Key theme from OSM
+            feature: point, line or polygon
+            part: Part number of a large theme, parts are written to the tmp directory for merge_parts
+
+        Returns:
+            The return value is a LayerWriter, close it once every chunk is written
+        """
+        if self.single:
+            # The writer process appends every part to the same layer
+            return QueueLayerWriter(output_queue(), theme, feature)
+        if part is None and self.partition_zoom is not None:
+            return PartitionLayerWriter(self.output_format, self.output, f'{self.prefix}_{theme}', theme, feature,
+                                        self.partition_zoom, self.clip)
+        if part is None:
+            return layer_writer(self.output_format, self.output, f'{self.prefix}_{theme}', theme, feature)
+        return layer_writer(self.output_format, self.tempf, f'{theme}_part{part}', theme, feature)
+
+    @staticmethod
+    def determine_force_way_to_line(cat: str, atts: dict) -> bool:
+        """
+        Part of the legacy code
+        Args:
+            cat: Key OSM theme
+            atts: Fields for specific theme.
+
+        Returns:
+            The return value. True for success, False otherwise.
+        """
+
+        if cat in ['barrier', 'boundary', 'highway', 'public_transport', 'railway', 'route']:
+            force_to_line = True
+            try:
+                for att in atts:
+                    if att == 'area' and atts[att] == 'yes':
+                        force_to_line = False
+            except ValueError:
+                force_to_line = True
+        else:
+            force_to_line = False
+        return force_to_line
+
+
+class ThemeScheduler:
+    """
+    Submits the ProcessOSM jobs to a process pool as their inputs become ready. Resolve shards come first, the
+    relations are assembled when every shard is resolved and its relation members are stored, and each theme is built
+    once the relations are done and its point layer is written, because a theme's layers share one geopackage.
+    """
+
+    def __init__(self, posm: ProcessOSM, executor: ProcessPoolExecutor):
+        self.posm = posm
+        self.executor = executor
+        self.futures = {}  # Future to the job name and theme
+        self.shards = 0
+        self.resolve_pending = 0
+        self.resolve_closed = False
+        self.deferred = []  # Shards resolved before the relation members were known
+        self.members_pending = 0
+        self.points_pending = set()
+        self.parts_pending = {}
+        self.way_themes = []
+        self.ways_ready = False
+
+    def submit(self, job: str, theme: Any, fn, *args) -> None:
+        self.futures[self.executor.submit(fn, *args)] = (job, theme)
+
+    def submit_resolve(self, start: int, end: int, store_members: bool = True) -> None:
+        """
+        Resolve a byte range of the way staging as the next shard
+        """
+        self.submit('resolve', None, self.posm.resolve_ways, self.shards, start, end, store_members)
+        if not store_members:
+            self.deferred.append(self.shards)
+        self.shards += 1
+        self.resolve_pending += 1
+
+    def close_resolve(self) -> None:
+        """
+        No more resolve shards will be submitted, relations start when the pending shards finish
+        """
+        self.resolve_closed = True
+        if self.resolve_pending == 0 and self.shards > 0:
+            self.resolve_done()
+
+    def resolve_done(self) -> None:
+        """
+        Every shard is resolved, collect the members of the deferred shards before the relations are assembled
+        """
+        if len(self.deferred) == 0:
+            self.submit('relations', None, self.posm.process_relations)
+            return
+        for shard in self.deferred:
+            self.submit('members', None, self.posm.collect_members, shard)
+        self.members_pending = len(self.deferred)
+        self.deferred = []
+
+    def submit_points(self, theme: str) -> None:
+        self.submit('nodes', theme, self.posm.process_nodes, theme)
+        self.points_pending.add(theme)
+
+    def submit_theme(self, theme: str) -> None:
+        parts = self.posm.plan_theme(theme, self.shards)
+        if len(parts) == 1:
+            self.submit('ways', theme, self.posm.process_ways, theme, parts[0])
+        else:
+            print(f'Splitting {theme} theme into {len(parts)} shards')
+            self.parts_pending[theme] = len(parts)
+            for part, part_shards in enumerate(parts):
+                self.submit('part', theme, self.posm.process_ways, theme, part_shards, part)
+
+    def done(self, future) -> None:
+        """
+        Report a finished job and submit the jobs that were waiting on it
+        """
+        job, theme = self.futures.pop(future)
+        print(future.result())
+        if job == 'resolve':
+            self.resolve_pending -= 1
+            if self.resolve_pending == 0 and self.resolve_closed:
+                self.resolve_done()
+        elif job == 'members':
+            self.members_pending -= 1
+            if self.members_pending == 0:
+                self.submit('relations', None, self.posm.process_relations)
+        elif job == 'relations':
+            self.ways_ready = True
+            self.way_themes = self.posm.schedule('way')
+            for each in self.way_themes:
+                if each not in self.points_pending:
+                    self.submit_theme(each)
+        elif job == 'nodes':
+            self.points_done(theme)
+        elif job == 'part':
+            self.parts_pending[theme] -= 1
+            if self.parts_pending[theme] == 0 and not self.posm.single:
+                self.submit('merge', theme, self.posm.merge_parts, theme,
+                            len(self.posm.plan_theme(theme, self.shards)))
+
+    def points_done(self, theme: str) -> None:
+        self.points_pending.discard(theme)
+        if self.ways_ready and theme in self.way_themes:
+            self.submit_theme(theme)
+
+    def poll(self) -> None:
+        """
+        Handle the jobs that are already finished without waiting
+        """
+        for future in [each for each in self.futures if each.done()]:
+            self.done(future)
+
+    def run(self) -> None:
+        """
+        Wait for every job, including the ones submitted along the way
+        """
+        while self.futures:
+            finished, _ = wait(list(self.futures), return_when=FIRST_COMPLETED)
+            for future in finished:
+                self.done(future)
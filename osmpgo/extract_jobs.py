@@ -0,0 +1,148 @@
+import asyncio
+import os
+import re
+import time
+import geopandas as gpd
+import numpy as np
+import shapely
+from typing import Callable
+from osmpgo.extract_osmxml import osmconvert_args, save_poly
+
+# osmconvert reports the last element it read when it finishes
+LAST = re.compile(r'Last processed: (node|way|relation) (-?\d+)')
+
+
+def default_workers() -> int:
+    """
+    Number of osmconvert processes to run at once. Each one reads the whole input file, past four of them the disk is
+    the limit rather than the cores
+    """
+    return max(1, min(os.cpu_count() or 1, 4))
+
+
+class ExtractJob:
+    """
+    One osmconvert extract of a bbox or a .poly file, with its own temporary files so several can run at once
+    """
+
+    def __init__(self, name: str, inputs: str, output: str, poly: str = None, bbox: list = None):
+        self.name = name
+        self.inputs = inputs
+        self.output = output
+        self.poly = poly
+        self.bbox = bbox
+
+    def args(self, osmconvert: str) -> list:
+        return osmconvert_args(osmconvert, self.inputs, self.output, poly=self.poly, bbox=self.bbox,
+                               temp=f'{self.output}_temp') + ['--verbose']
+
+
+class ExtractResult:
+    """
+    Outcome of an ExtractJob, the exit code of osmconvert, seconds it ran, bytes of the output, its stderr messages
+    and the last (kind, id) it processed
+    """
+
+    def __init__(self, job: ExtractJob, returncode: int, duration: float, size: int, messages: list):
+        self.job = job
+        self.returncode = returncode
+        self.duration = duration
+        self.size = size
+        self.messages = messages
+        found = [match for match in map(LAST.search, messages) if match]
+        self.last = (found[-1].group(1), int(found[-1].group(2))) if found else None
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+
+def output_size(path: str) -> int:
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+async def run_job(job: ExtractJob, osmconvert: str, slots: asyncio.Semaphore, progress: Callable = None,
+                  interval: float = 1.0) -> ExtractResult:
+    """
+    Run osmconvert for a job once a slot is free. progress is called with the job, the bytes written so far and a
+    stderr message, or None for the message every interval seconds while osmconvert is quiet
+    """
+    async with slots:
+        begin = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(*job.args(osmconvert), stdout=asyncio.subprocess.DEVNULL,
+                                                       stderr=asyncio.subprocess.PIPE)
+        messages = []
+
+        async def read_messages():
+            async for line in process.stderr:
+                message = line.decode('utf-8', errors='replace').strip()
+                if message:
+                    messages.append(message)
+                    if progress is not None:
+                        progress(job, output_size(job.output), message)
+
+        reader = asyncio.ensure_future(read_messages())
+        while not reader.done():
+            await asyncio.wait([reader], timeout=interval)
+            if progress is not None and not reader.done():
+                progress(job, output_size(job.output), None)
+        returncode = await process.wait()
+        return ExtractResult(job, returncode, time.perf_counter() - begin, output_size(job.output), messages)
+
+
+async def run_jobs(jobs: list, osmconvert: str, workers: int = None, progress: Callable = None,
+                   interval: float = 1.0) -> list:
+    slots = asyncio.Semaphore(workers if workers is not None else default_workers())
+    return await asyncio.gather(*[run_job(job, osmconvert, slots, progress, interval) for job in jobs])
+
+
+def run_extracts(jobs: list, osmconvert: str, workers: int = None, progress: Callable = None,
+                 interval: float = 1.0) -> list:
+    """
+    Run osmconvert extracts concurrently, at most workers at a time
+    Args:
+        jobs: ExtractJob list
+        osmconvert: Path to osmconvert executable
+        workers: Number of osmconvert processes at once, see default_workers
+        progress: Called with (job, bytes written, stderr message or None) while the jobs run
+        interval: Seconds between progress calls of a running job
+
+    Returns:
+        The return value is a list of ExtractResult in the order of the jobs
+    """
+    return asyncio.run(run_jobs(jobs, osmconvert, workers, progress, interval))
+
+
+def extract_regions(inputs: str, output: str, osmconvert: str, regions: gpd.GeoSeries, workers: int = None,
+                    progress: Callable = None, interval: float = 10.0) -> dict:
+    """
+    Used OSMCONVERT to write an OSM.XML file per region with one osmconvert process per region, several at a time. A
+    rectangular region is extracted with -b and any other with a .poly file. Alternative to write_regions when there
+    are cores and disk bandwidth to spare
+    Args:
+        inputs: OSM File
+        output: Output folder for the {region}.osm.xml files
+        osmconvert: Path to osmconvert executable
+        regions: Region polygons indexed by name, see read_regions
+        workers: Number of osmconvert processes at once, see default_workers
+        progress: See run_extracts
+        interval: Seconds between progress calls of a running job
+
+    Returns:
+        The return value is a dictionary of region name to ExtractResult
+    """
+    os.makedirs(output, exist_ok=True)
+    jobs = []
+    for name, geometry in regions.items():
+        path = os.path.join(output, f'{name}.osm.xml')
+        if shapely.equals(geometry, shapely.box(*geometry.bounds)):
+            jobs.append(ExtractJob(name, inputs, path, bbox=list(geometry.bounds)))
+        else:
+            jobs.append(ExtractJob(name, inputs, path, poly=save_poly(np.asarray([geometry]), name, output)))
+    try:
+        results = run_extracts(jobs, osmconvert, workers, progress, interval)
+    finally:
+        for job in jobs:
+            if job.poly is not None:
+                os.remove(job.poly)
+    return {job.name: result for job, result in zip(jobs, results)}
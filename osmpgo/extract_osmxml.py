@@ -1,164 +1,397 @@
-import os
-import geopandas as gpd
-import subprocess
-from tempfile import mkstemp
-from typing import List, Dict, Union, Optional, Any
-
-
-def write_osm(inputs: str, output: str, osmconvert: str, poly: str = None, bbox: list = None) -> None:
-    """
-    Used OSMCONVERT to write OSM.XML file for use by the export package
-    Args:
-        inputs: OSM File
-        output: Output location for OSM.XML
-        osmconvert: Path to osmconvert executable
-        poly: file path to poly file
-        bbox: list of coordinates
-
-    Returns:
-        The return is None
-    """
-
-    try:
-        # cmd = None
-        if poly is not None:
-            cmd = '{}  {} -B={} -o={} -t={}/osm_temp'.format(osmconvert, inputs, poly, output, os.path.dirname(output))
-            # subprocess.run(cmd, shell=True)
-            subprocess.check_call(cmd, stderr=subprocess.STDOUT, shell=True)
-            # proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-            # out, err = proc.communicate()
-            # proc.wait()
-            # print(f'{proc.returncode} {out} {err}')
-
-        elif bbox is not None:
-            cmd = '{} {} -b={},{},{},{} -o={} -t={}/osm_temp'.format(osmconvert, inputs, bbox[0], bbox[1], bbox[2],
-                                                                     bbox[3], output, os.path.dirname(output))
-            # subprocess.run(cmd, shell=True)
-            # result = subprocess.check_output(cmd, stderr=subprocess.STDOUT, universal_newlines=True,  shell=True)
-            # print(result)
-            subprocess.check_call(cmd, stderr=subprocess.STDOUT, shell=True)
-        else:
-            cmd = '{}  {} -o={} -t={}/osm_temp'.format(osmconvert, inputs, output, os.path.dirname(output))
-            # subprocess.run(cmd, shell=True)
-            # result = subprocess.check_output(cmd, stderr=subprocess.STDOUT, universal_newlines=True,  shell=True)
-            # print(result)
-            subprocess.check_call(cmd, stderr=subprocess.STDOUT, shell=True)
-
-    except subprocess.CalledProcessError as ex:  # error code <> 0
-        print("--------error------")
-        print(ex.cmd)
-        print(ex.returncode)
-        print(ex.output)  # contains stdout and stderr together
-
-
-def write_poly(clip_data: str, output: str, layer: str = None) -> str:
-    """
-        Read shapefile/shape and write *.poly file for use with osmconvert
-
-    Args:
-        clip_data: path to geometry file (shape/fgdb)
-        output: output file path
-        layer: layer name if FGDB
-
-    Returns:
-        The return is a string to the path of the .poly file
-
-    """
-    if os.path.splitext(clip_data)[-1] == '.shp':
-        print('Processing shapefile')
-        wb_poly = gpd.read_file(clip_data)
-        attr = os.path.basename(clip_data).split('.')[0]
-    else:
-        print('Processing FileGDB')
-        wb_poly = gpd.read_file(clip_data, driver="FileGDB", layer=layer)
-        attr = layer
-
-    # poly = os.path.join(os.path.dirname(output), f'{attr}.poly')
-    poly = mkstemp(prefix=f'{attr}_clip_', suffix='.poly', dir=os.path.dirname(output))[1]
-
-    with open(poly, 'w') as fp:
-        fp.write(attr + "\n")
-        total_ring_count = 0
-        for _, f in wb_poly.iterrows():
-            geom = f.geometry
-            coordinates = extract_coords(geom)
-            for coordinate in coordinates:
-
-                fp.write('{0}\n'.format(total_ring_count))
-                for coords in coordinate[0]['exterior_coords']:
-                    x = '{:.7E}'.format(coords[0])
-                    y = '{:.7E}'.format(coords[1])
-                    fp.write('\t{0}\t{1}\n'.format(x, y))
-                fp.write("END\n")
-                total_ring_count += 1
-                for rings in coordinate[0]['interior_coords']:
-                    fp.write('!{0}\n'.format(total_ring_count))
-                    for coords in rings:
-                        x = '{:.7E}'.format(coords[0])
-                        y = '{:.7E}'.format(coords[1])
-                        fp.write('\t{0}\t{1}\n'.format(x, y))
-                    total_ring_count += 1
-                    fp.write("END\n")
-
-        fp.write("END\n")
-    return poly
-
-
-def extract_coords(geom) -> list:
-    """
-    Extract Polygon/MultiPolygon coordinates
-    Args:
-        geom: shapely geometry object
-
-    Returns:
-        The return is a list of extracted coordinates
-
-    """
-    coords = []
-    if geom.type == 'Polygon':
-        coords.append(extract_poly_coords(geom))
-    elif geom.type == 'MultiPolygon':
-        coords.extend(extract_multi_poly_coords(geom))
-    else:
-        raise ValueError('Unhandled geometry type: ' + repr(geom.type))
-    return coords
-
-
-def extract_poly_coords(geom) -> List[Dict[str, Union[Optional[list], Any]]]:
-    """
-    Extract Polygon Coords
-    Args:
-        geom: shapely polygon object
-
-    Returns:
-        The return is a dictionary of internal and external coordinates
-
-    """
-    exterior_coords = None
-    interior_coords = None
-    if geom.type == 'Polygon':
-        exterior_coords = geom.exterior.coords[:]
-        interior_coords = []
-        for interior in geom.interiors:
-            interior_coords.append(interior.coords[:])
-
-    return [{'exterior_coords': exterior_coords,
-             'interior_coords': interior_coords}]
-
-
-# noinspection SpellCheckingInspection
-def extract_multi_poly_coords(geom) -> list:
-    """
-    Extract MultiPolygon Coords
-    Args:
-        geom: shapely polygon object
-
-    Returns:
-        The return is a dictionary of internal and external coordinates
-
-    """
-    coords = []
-    if geom.type == 'MultiPolygon':
-        for part in geom:
-            coords.append(extract_poly_coords(part))  # Recursive call
-    return coords
+import os
+import re
+import geopandas as gpd
+import numpy as np
+import shapely
+import subprocess
+from array import array
+from tempfile import mkstemp
+from typing import Any
+
+ELEMENTS = ('node', 'way', 'relation')
+# An element with its start tag attributes and its body of tags, node refs or members
+ELEMENT = re.compile(r'[ \t]*<(node|way|relation) id="(-?\d+)"([^>]*?)(?:/>|>(.*?)</\1>)[^\n]*\n', re.S)
+LON = re.compile(r'\slon="([^"]+)"')
+LAT = re.compile(r'\slat="([^"]+)"')
+REF = re.compile(r'<nd ref="(-?\d+)"')
+MEMBER = re.compile(r'<member type="(\w+)" ref="(-?\d+)"')
+
+
+def osmconvert_args(osmconvert: str, inputs: str, output: str, poly: str = None, bbox: list = None,
+                    temp: str = None) -> list:
+    """
+    Command line of an osmconvert extract as a list of arguments, no shell is involved
+    Args:
+        osmconvert: Path to osmconvert executable
+        inputs: OSM File
+        output: Output location for OSM.XML
+        poly: file path to poly file
+        bbox: list of coordinates
+        temp: prefix of the temporary files of osmconvert, extracts running at the same time need their own
+
+    Returns:
+        The return value is the list of arguments
+    """
+    args = [osmconvert, inputs]
+    if poly is not None:
+        args.append(f'-B={poly}')
+    elif bbox is not None:
+        args.append('-b={},{},{},{}'.format(*bbox))
+    temp = temp if temp is not None else os.path.join(os.path.dirname(output), 'osm_temp')
+    return args + [f'-o={output}', f'-t={temp}']
+
+
+def write_osm(inputs: str, output: str, osmconvert: str, poly: str = None, bbox: list = None) -> bool:
+    """
+    Used OSMCONVERT to write OSM.XML file for use by the export package. The extract goes to a temporary file next to
+    the output that replaces it once osmconvert succeeded, an existing output is never written through.
+    Args:
+        inputs: OSM File
+        output: Output location for OSM.XML, or .o5m when it ends in .o5m
+        osmconvert: Path to osmconvert executable
+        poly: file path to poly file
+        bbox: list of coordinates
+
+    Returns:
+        The return is True when osmconvert succeeded
+    """
+    # The temporary file keeps the name of the output at its end, osmconvert picks the format by the extension
+    handle, temp = mkstemp(suffix=f'_{os.path.basename(output)}', dir=os.path.dirname(os.path.abspath(output)))
+    os.close(handle)
+    try:
+        subprocess.check_call(osmconvert_args(osmconvert, inputs, temp, poly=poly, bbox=bbox),
+                              stderr=subprocess.STDOUT)
+        os.replace(temp, output)
+        return True
+
+    except subprocess.CalledProcessError as ex:  # error code <> 0
+        print("--------error------")
+        print(' '.join(ex.cmd))
+        print(ex.returncode)
+        print(ex.output)  # contains stdout and stderr together
+        os.remove(temp)
+        return False
+
+
+def read_clip(clip_data: str, layer: str = None) -> tuple:
+    """
+    Read the polygons of a shapefile, FileGDB or GeoPackage used to clip an extract
+    Args:
+        clip_data: path to geometry file (shape/fgdb/gpkg)
+        layer: layer name if FGDB or GeoPackage
+
+    Returns:
+        The return value is a tuple of the name of the clip data and an array of its Polygons and MultiPolygons in
+        EPSG:4326
+    """
+    if os.path.splitext(clip_data)[-1] == '.shp':
+        print('Processing shapefile')
+        wb_poly = gpd.read_file(clip_data)
+        attr = os.path.basename(clip_data).split('.')[0]
+    else:
+        print('Processing FileGDB' if os.path.splitext(clip_data)[-1] == '.gdb' else 'Processing GeoPackage')
+        wb_poly = gpd.read_file(clip_data, layer=layer)
+        attr = layer if layer is not None else os.path.basename(clip_data).split('.')[0]
+    if wb_poly.crs is not None:
+        wb_poly = wb_poly.to_crs(4326)
+
+    geometry = np.asarray(wb_poly.geometry.values)
+    kinds = set(shapely.get_type_id(geometry).tolist()) - {3, 6}
+    if kinds:
+        raise ValueError('Unhandled geometry type: ' + repr(shapely.GeometryType(kinds.pop()).name))
+    return attr, geometry
+
+
+def write_poly(clip_data: str, output: str, layer: str = None, simplify: float = None) -> str:
+    """
+        Read shapefile/shape and write *.poly file for use with osmconvert
+
+    Args:
+        clip_data: path to geometry file (shape/fgdb/gpkg)
+        output: output file path
+        layer: layer name if FGDB or GeoPackage
+        simplify: tolerance in degrees to reduce the vertices of the clip polygons, see cover_simplify
+
+    Returns:
+        The return is a string to the path of the .poly file
+
+    """
+    attr, geometry = read_clip(clip_data, layer=layer)
+    if simplify is not None:
+        geometry = cover_simplify(geometry, simplify)
+    return save_poly(geometry, attr, os.path.dirname(output))
+
+
+def save_poly(geometry: np.ndarray, attr: str, folder: str) -> str:
+    """
+    Write polygons to a new *.poly file for use with osmconvert
+    Args:
+        geometry: Polygons and MultiPolygons in EPSG:4326
+        attr: name of the polygon, the first line of the file
+        folder: folder of the file
+
+    Returns:
+        The return is a string to the path of the .poly file
+    """
+    # Every ring of every polygon part, the exterior of a part comes before its holes
+    rings, parts = shapely.get_rings(shapely.get_parts(geometry), return_index=True)
+    exterior = np.r_[True, parts[1:] != parts[:-1]]
+    coords, index = shapely.get_coordinates(rings, return_index=True)
+    ends = np.cumsum(np.bincount(index, minlength=len(rings)))
+    if len(coords) > 60000:
+        print(f'{len(coords):,} vertices in the clip data, osmconvert reads at most 60,000. Use --simplify')
+
+    # poly = os.path.join(os.path.dirname(output), f'{attr}.poly')
+    handle, poly = mkstemp(prefix=f'{attr}_clip_', suffix='.poly', dir=folder)
+    os.close(handle)
+
+    with open(poly, 'w') as fp:
+        fp.write(attr + "\n")
+        begin = 0
+        for ring, end in enumerate(ends.tolist()):
+            # All the vertices of a ring in a single format call
+            fp.write(('{0}\n' if exterior[ring] else '!{0}\n').format(ring))
+            fp.write('\t%.7E\t%.7E\n' * (end - begin) % tuple(coords[begin:end].ravel().tolist()))
+            fp.write("END\n")
+            begin = end
+        fp.write("END\n")
+    return poly
+
+
+def cover_simplify(geometry: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Reduce the vertices of clip polygons while the result still covers the original polygon, so no node inside the
+    clip data is lost. The simplified polygons are grown by the tolerance with mitred corners, a polygon that still
+    would not cover its original is merged with it.
+    Args:
+        geometry: Polygons and MultiPolygons
+        tolerance: Tolerance in degrees of the simplification and of the growth
+
+    Returns:
+        The return value is an array of the simplified polygons
+    """
+    simplified = shapely.buffer(shapely.simplify(geometry, tolerance, preserve_topology=True), tolerance,
+                                join_style='mitre', mitre_limit=2.0)
+    uncovered = ~shapely.covers(simplified, geometry)
+    simplified[uncovered] = shapely.union(simplified[uncovered], geometry[uncovered])
+    return simplified
+
+
+def read_regions(clip_data: str, layer: str = None, field: str = None) -> gpd.GeoSeries:
+    """
+    Read the polygons of a shapefile, FileGDB or GeoPackage as the regions of a multi-region extract
+    Args:
+        clip_data: path to geometry file (shape/fgdb/gpkg)
+        layer: layer name if FGDB or GeoPackage
+        field: field with the name of each region, features with the same name are merged. The feature number is
+            used without a field
+
+    Returns:
+        The return value is a GeoSeries of the region polygons in EPSG:4326 indexed by region name
+    """
+    gdf = gpd.read_file(clip_data, layer=layer)
+    if gdf.crs is not None:
+        gdf = gdf.to_crs(4326)
+    names = gdf[field].astype(str) if field is not None else gdf.index.astype(str)
+    # Region names become file names
+    gdf['region'] = [re.sub(r'[^\w.-]+', '_', name) for name in names]
+    return gdf.dissolve(by='region').geometry
+
+
+class RegionSplitter:
+    """
+    Writes the elements of one OSM.XML stream into an OSM.XML file per region in a single pass. Elements are tested
+    in batches, nodes by a spatial index query of the region polygons and ways and relations by looking up their
+    node and member ids in the sorted ids already written to each region. A way is written to every region that has
+    one of its nodes and a relation to every region that has one of its members, like osmconvert does for a single
+    polygon.
+    """
+
+    def __init__(self, regions: gpd.GeoSeries, folder: str, batch_size: int = 50000):
+        self.names = list(regions.index)
+        self.regions = regions
+        self.tree = shapely.STRtree(np.asarray(regions.values))
+        self.paths = [os.path.join(folder, f'{name}.osm.xml') for name in self.names]
+        self.files = [open(path, 'w', encoding='utf-8') for path in self.paths]
+        self.batch_size = batch_size
+        self.started = False
+        self.kind = None
+        # (id, text, data) of the elements of the current kind, data is (lon, lat) of a node, the node refs of a way
+        # or the (type, ref) members of a relation
+        self.batch = []
+        # Ids written to each region per element kind, osmconvert writes the elements sorted by id
+        self.ids = {kind: [array('q') for _ in self.names] for kind in ELEMENTS}
+        self.ordered = {kind: True for kind in ELEMENTS}
+        self.last_id = {kind: -2 ** 63 for kind in ELEMENTS}
+
+    def start(self, header: list) -> None:
+        """
+        Write the start of every region file, the lines before the first element of the stream with the bounds of the
+        region
+        """
+        for name, osm_file in zip(self.names, self.files):
+            minx, miny, maxx, maxy = self.regions[name].bounds
+            osm_file.writelines(header)
+            osm_file.write(f'\t<bounds minlat="{miny:.7f}" minlon="{minx:.7f}" maxlat="{maxy:.7f}" '
+                           f'maxlon="{maxx:.7f}"/>\n')
+        self.started = True
+
+    def region_ids(self, kind: str, region: int) -> np.ndarray:
+        ids = np.frombuffer(self.ids[kind][region], dtype=np.int64) if len(self.ids[kind][region]) else \
+            np.zeros(0, dtype=np.int64)
+        return ids if self.ordered[kind] else np.sort(ids)
+
+    def match_refs(self, refs: list, kinds: np.ndarray) -> tuple:
+        """
+        Regions of the elements of the batch that have one of their refs written to the region
+        Args:
+            refs: Referenced ids of each element of the batch
+            kinds: Index in ELEMENTS of the kind of every referenced id
+
+        Returns:
+            The return value is a tuple of batch indices and region indices
+        """
+        lengths = np.array([len(each) for each in refs], dtype=np.int64)
+        flat = np.fromiter((ref for each in refs for ref in each), dtype=np.int64, count=int(lengths.sum()))
+        owner = np.repeat(np.arange(len(refs)), lengths)
+        elements, regions = [], []
+        for region in range(len(self.names)):
+            found = np.zeros(len(flat), dtype=bool)
+            for kind in np.unique(kinds).tolist():
+                ids = self.region_ids(ELEMENTS[kind], region)
+                if len(ids) == 0:
+                    continue
+                position = np.minimum(np.searchsorted(ids, flat), len(ids) - 1)
+                found |= (kinds == kind) & (ids[position] == flat)
+            hits = np.unique(owner[found])
+            elements.append(hits)
+            regions.append(np.full(len(hits), region))
+        return np.concatenate(elements), np.concatenate(regions)
+
+    def match_nested(self, members: list, elements: np.ndarray, regions: np.ndarray) -> tuple:
+        """
+        Add the relations of the batch with a member relation of the same batch in a region, until no more are found
+        """
+        position = {each[0]: index for index, each in enumerate(self.batch)}
+        parents = [(index, position[ref]) for index, each in enumerate(members) for kind, ref in each
+                   if kind == 'relation' and ref in position]
+        pairs = set(zip(elements.tolist(), regions.tolist()))
+        if not parents or not pairs:
+            return elements, regions
+        added = True
+        while added:
+            found = {(parent, region) for parent, child in parents for element, region in pairs if element == child}
+            added = len(found - pairs) > 0
+            pairs |= found
+        elements, regions = zip(*pairs)
+        return np.array(elements, dtype=np.int64), np.array(regions, dtype=np.int64)
+
+    def flush(self) -> None:
+        """
+        Write the elements of the batch to the regions they belong to
+        """
+        if len(self.batch) == 0:
+            return
+        ids = np.array([each[0] for each in self.batch], dtype=np.int64)
+        if ids[0] < self.last_id[self.kind] or np.any(ids[1:] < ids[:-1]):
+            self.ordered[self.kind] = False
+        self.last_id[self.kind] = ids[-1]
+        data = [each[2] for each in self.batch]
+        if self.kind == 'node':
+            coords = np.array(data, dtype=np.float64).reshape(-1, 2)
+            elements, regions = self.tree.query(shapely.points(coords), predicate='intersects')
+        elif self.kind == 'way':
+            elements, regions = self.match_refs(data, np.zeros(sum(len(refs) for refs in data), dtype=np.int64))
+        else:
+            kinds = np.array([ELEMENTS.index(kind) for members in data for kind, _ in members], dtype=np.int64)
+            elements, regions = self.match_refs([[ref for _, ref in members] for members in data], kinds)
+            elements, regions = self.match_nested(data, elements, regions)
+
+        order = np.lexsort((elements, regions))
+        for element, region in zip(elements[order].tolist(), regions[order].tolist()):
+            element_id, text, _ = self.batch[element]
+            self.files[region].write(text)
+            self.ids[self.kind][region].append(element_id)
+        self.batch = []
+
+    def close(self) -> dict:
+        """
+        Write the remaining elements and close the region files
+        Returns:
+            The return value is a dictionary of region name to the number of nodes, ways and relations written
+        """
+        if not self.started:
+            self.start(["<?xml version='1.0' encoding='UTF-8'?>\n", '<osm version="0.6">\n'])
+        self.flush()
+        counts = {}
+        for region, (name, osm_file) in enumerate(zip(self.names, self.files)):
+            osm_file.write('</osm>\n')
+            osm_file.close()
+            counts[name] = tuple(len(self.ids[kind][region]) for kind in ELEMENTS)
+        return counts
+
+
+def split_osm(stream: Any, splitter: RegionSplitter, block_size: int = 4 * 1024 * 1024) -> dict:
+    """
+    Feed the elements of an OSM.XML stream to a RegionSplitter. The stream is read in blocks and the elements of a
+    block are found by one regular expression scan instead of line by line
+    Args:
+        stream: Text stream of the OSM.XML
+        splitter: RegionSplitter of the output regions
+        block_size: Characters read at a time
+
+    Returns:
+        The return value is the dictionary of RegionSplitter.close
+    """
+    rest = ''
+    while True:
+        block = stream.read(block_size)
+        text = rest + block
+        position = 0
+        for match in ELEMENT.finditer(text):
+            kind, element_id, start, body = match.group(1, 2, 3, 4)
+            if not splitter.started:
+                splitter.start([line + '\n' for line in text[:match.start()].splitlines()
+                                if line.strip() and not line.lstrip().startswith('<bounds')])
+            if kind == 'node':
+                data = (float(LON.search(start).group(1)), float(LAT.search(start).group(1)))
+            elif kind == 'way':
+                data = [int(ref) for ref in REF.findall(body)]
+            else:
+                data = [(member_type, int(ref)) for member_type, ref in MEMBER.findall(body)]
+            if kind != splitter.kind or len(splitter.batch) >= splitter.batch_size:
+                splitter.flush()
+                splitter.kind = kind
+            splitter.batch.append((int(element_id), match.group(0), data))
+            position = match.end()
+        rest = text[position:]
+        if not block:
+            return splitter.close()
+
+
+def write_regions(inputs: str, output: str, osmconvert: str, regions: gpd.GeoSeries) -> dict:
+    """
+    Used OSMCONVERT to read the OSM file once and write an OSM.XML file per region for use by the export package.
+    osmconvert cuts the input to the bounding box of all regions and streams it as OSM.XML, decompressing in its own
+    process while the elements are split here.
+    Args:
+        inputs: OSM File
+        output: Output folder for the {region}.osm.xml files
+        osmconvert: Path to osmconvert executable
+        regions: Region polygons indexed by name, see read_regions
+
+    Returns:
+        The return value is a dictionary of region name to the number of nodes, ways and relations written, empty when
+        osmconvert failed
+    """
+    os.makedirs(output, exist_ok=True)
+    minx, miny, maxx, maxy = regions.total_bounds
+    cmd = [osmconvert, inputs, f'-b={minx},{miny},{maxx},{maxy}', '--out-osm', f'-t={output}/osm_temp']
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, encoding='utf-8', bufsize=1024 * 1024) as process:
+        counts = split_osm(process.stdout, RegionSplitter(regions, output))
+    if process.returncode != 0:
+        print("--------error------")
+        print(' '.join(cmd))
+        print(process.returncode)
+        return {}
+    return counts
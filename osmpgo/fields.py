@@ -0,0 +1,74 @@
+import csv
+import pkg_resources
+import pandas as pd
+
+NUMBER = r'[+-]?(?:\d+(?:\.\d*)?|\.\d+)'
+# Meters per length unit, a missing unit is meters
+LENGTH_UNITS = {'': 1.0, 'm': 1.0, 'km': 1000.0, 'cm': 0.01, 'mm': 0.001, 'mi': 1609.344, 'nmi': 1852.0,
+                'ft': 0.3048, 'feet': 0.3048, "'": 0.3048, 'in': 0.0254, '"': 0.0254}
+# Kilometers per hour of a speed unit, a missing unit is km/h
+SPEED_UNITS = {'': 1.0, 'km/h': 1.0, 'kmh': 1.0, 'kph': 1.0, 'mph': 1.609344, 'knots': 1.852}
+LENGTH = rf'^\s*(?P<value>{NUMBER})\s*(?P<unit>{"|".join(sorted(LENGTH_UNITS, key=len, reverse=True))})\s*$'
+FEET_INCHES = rf'^\s*(?P<feet>\d+)\s*\'\s*(?P<inches>{NUMBER})\s*"\s*$'
+SPEED = rf'^\s*(?P<value>{NUMBER})\s*(?P<unit>km/h|kmh|kph|mph|knots|)\s*$'
+
+
+def read_field_types() -> dict:
+    """
+        Uses the data/field_types.csv file to look up the numeric and low-cardinality fields, every other field stays a
+        string
+
+    Returns:
+        The return value is a dictionary of field name to int, float, length (meters), speed (km/h) or category
+    """
+    config_file = pkg_resources.resource_filename("osmpgo", 'data/field_types.csv')
+    with open(config_file, 'r') as csv_file:
+        return {row[0]: row[1] for row in csv.reader(csv_file) if len(row) > 1}
+
+
+def parse_field(values: list, kind: str) -> pd.Series:
+    """
+    Vectorized parse of the tag values of a typed field, values of a numeric field that do not parse such as 'none',
+    'signals' or a list of values become missing
+    Args:
+        values: Tag values of the field, '' for features without the tag
+        kind: int, float, length, speed or category
+
+    Returns:
+        The return value is a nullable Int64 series for int, a categorical series for category and a nullable Float64
+        series for the other kinds
+    """
+    if kind == 'category':
+        # Features without the tag are missing, not a category of their own
+        return pd.Series([None if value == '' else value for value in values], dtype='category')
+    text = pd.Series(values, dtype='string')
+    if kind == 'int':
+        # More than 18 digits may not fit in an int64 and becomes missing like any other value that does not parse
+        return pd.to_numeric(text.where(text.str.fullmatch(r'\s*[+-]?\d{1,18}\s*')).str.strip()).astype('Int64')
+    if kind == 'float':
+        return pd.to_numeric(text.where(text.str.fullmatch(rf'\s*{NUMBER}\s*')).str.strip()).astype('Float64')
+    if kind == 'length':
+        parts = text.str.extract(LENGTH)
+        number = parts['value'].astype('Float64') * parts['unit'].map(LENGTH_UNITS).astype('Float64')
+        # 6'2" style heights
+        feet = text.str.extract(FEET_INCHES)
+        inches = feet['feet'].astype('Float64') * 0.3048 + feet['inches'].astype('Float64') * 0.0254
+        return number.fillna(inches)
+    if kind == 'speed':
+        parts = text.str.extract(SPEED)
+        return parts['value'].astype('Float64') * parts['unit'].map(SPEED_UNITS).astype('Float64')
+    raise ValueError(f'Unknown field type {kind}')
+
+
+def typed_fields(flds: dict, types: dict) -> dict:
+    """
+    Replace the value lists of the typed fields with parsed columns, other fields are left unchanged
+    Args:
+        flds: Field name to list of values
+        types: Field name to type, see read_field_types
+
+    Returns:
+        The return value is a dictionary of the same fields
+    """
+    return {field: parse_field(values, types[field]) if field in types else values
+            for field, values in flds.items()}
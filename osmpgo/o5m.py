@@ -0,0 +1,209 @@
+from typing import Iterable, Any
+
+NODE, WAY, RELATION = 0x10, 0x11, 0x12
+RESET = 0xff
+# Strings referenced by a back reference into the last TABLE_SIZE strings, longer strings are never referenced
+TABLE_SIZE = 15000
+TABLE_STRING = 250
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+
+def uvarint(data: bytes, pos: int) -> tuple:
+    """
+    Unsigned number of 7 bit groups, least significant group first
+    Returns:
+        The return value is a tuple of the number and the position after it
+    """
+    byte = data[pos]
+    if byte < 0x80:
+        return byte, pos + 1
+    value = byte & 0x7f
+    shift = 7
+    while True:
+        pos += 1
+        byte = data[pos]
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos + 1
+        shift += 7
+
+
+def svarint(data: bytes, pos: int) -> tuple:
+    """
+    Signed number, the lowest bit of the unsigned number is the sign
+    Returns:
+        The return value is a tuple of the number and the position after it
+    """
+    byte = data[pos]
+    if byte < 0x80:
+        return (byte >> 1) ^ -(byte & 1), pos + 1
+    value = byte & 0x7f
+    shift = 7
+    while True:
+        pos += 1
+        byte = data[pos]
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (value >> 1) ^ -(value & 1), pos + 1
+        shift += 7
+
+
+class O5mReader:
+    """
+    Decodes the .o5m format written by osmconvert. Ids, coordinates and refs are delta coded against the previous
+    element of the file, strings are either given inline or as a back reference into a table of the last strings, and
+    a reset dataset clears the delta counters and the string table. Author information is skipped and delete
+    requests of .o5c change files are dropped.
+    """
+
+    def __init__(self, path: str, block_size: int = 16 * 1024 * 1024):
+        self.path = path
+        self.block_size = block_size
+        self.table = [None] * TABLE_SIZE
+        self.reset()
+
+    def reset(self) -> None:
+        self.table_index = 0
+        self.id = 0
+        self.lon = 0
+        self.lat = 0
+        self.timestamp = 0
+        self.changeset = 0
+        self.refs = [0, 0, 0]  # Last node, way and relation ref
+
+    def string(self, data: bytes, pos: int, pair: bool = True, decode: bool = True, uid: bool = False) -> tuple:
+        """
+        Read a string pair, or a single string
+        Args:
+            uid: the first string of the pair is a uid varint, empty for anonymous objects
+        Returns:
+            The return value is a tuple of the string pair, or string, and the position after it
+        """
+        if data[pos] != 0:
+            ref, pos = uvarint(data, pos)
+            return self.table[(self.table_index - ref) % TABLE_SIZE], pos
+        if uid:
+            number, first = uvarint(data, pos + 1) if data[pos + 1] != 0 else (0, pos + 1)
+        else:
+            first = data.index(0, pos + 1)
+        end = data.index(0, first + 1) if pair else first
+        if not decode:
+            value = None
+        elif uid:
+            value = (number, data[first + 1:end].decode('utf-8', errors='replace'))
+        elif pair:
+            value = (data[pos + 1:first].decode('utf-8', errors='replace'),
+                     data[first + 1:end].decode('utf-8', errors='replace'))
+        else:
+            value = data[pos + 1:first].decode('utf-8', errors='replace')
+        # Both terminators of a pair are not counted
+        if end - pos - (2 if pair else 1) <= TABLE_STRING:
+            self.table[self.table_index] = value
+            self.table_index = (self.table_index + 1) % TABLE_SIZE
+        return value, end + 1
+
+    def fill(self, o5m_file: Any, data: bytes, pos: int, size: int) -> tuple:
+        """
+        Keep reading until there are size bytes from pos, fewer only at the end of the file
+        Returns:
+            The return value is a tuple of the data and the new position of pos in it
+        """
+        if len(data) - pos >= size:
+            return data, pos
+        data = data[pos:]
+        while len(data) < size:
+            block = o5m_file.read(max(self.block_size, size - len(data)))
+            if not block:
+                break
+            data += block
+        return data, 0
+
+    def datasets(self) -> Iterable[tuple]:
+        """
+        Datasets of the file as (type, data, start, end), a reset or another dataset without a length has no data
+        """
+        with open(self.path, 'rb') as o5m_file:
+            data = b''
+            pos = 0
+            while True:
+                if pos >= len(data):
+                    data, pos = self.fill(o5m_file, data, pos, 1)
+                    if pos >= len(data):
+                        break
+                kind = data[pos]
+                if kind >= 0xf0:
+                    yield kind, None, 0, 0
+                    pos += 1
+                    continue
+                # A length is at most 10 bytes
+                if len(data) - pos < 11:
+                    data, pos = self.fill(o5m_file, data, pos, 11)
+                length, start = uvarint(data, pos + 1)
+                header = start - pos
+                if len(data) - pos < header + length:
+                    data, pos = self.fill(o5m_file, data, pos, header + length)
+                yield kind, data, pos + header, pos + header + length
+                pos += header + length
+
+    def elements(self) -> Iterable[tuple]:
+        """
+        Decoded elements of the file
+        Returns:
+            The return value is a generator of ('node', id, lon, lat, tags), ('way', id, refs, tags) and
+            ('relation', id, members, tags). Ids and refs are integers, lon and lat are degrees, tags are (key, value)
+            pairs and members are (type, ref, role)
+        """
+        for kind, data, pos, end in self.datasets():
+            if kind == RESET:
+                self.reset()
+                continue
+            if kind not in (NODE, WAY, RELATION):
+                continue
+            delta, pos = svarint(data, pos)
+            self.id += delta
+            version, pos = uvarint(data, pos)
+            if version != 0:
+                delta, pos = svarint(data, pos)
+                self.timestamp += delta
+                if self.timestamp != 0:
+                    delta, pos = svarint(data, pos)
+                    self.changeset += delta
+                    # uid and user name, kept in the string table but not decoded
+                    _, pos = self.string(data, pos, decode=False, uid=True)
+            if pos >= end:
+                continue
+
+            if kind == NODE:
+                delta, pos = svarint(data, pos)
+                self.lon += delta
+                delta, pos = svarint(data, pos)
+                self.lat += delta
+                element = ('node', self.id, self.lon / 10000000, self.lat / 10000000)
+            elif kind == WAY:
+                length, pos = uvarint(data, pos)
+                refs_end = pos + length
+                refs = []
+                ref = self.refs[0]
+                while pos < refs_end:
+                    delta, pos = svarint(data, pos)
+                    ref += delta
+                    refs.append(ref)
+                self.refs[0] = ref
+                element = ('way', self.id, refs)
+            else:
+                length, pos = uvarint(data, pos)
+                refs_end = pos + length
+                members = []
+                while pos < refs_end:
+                    delta, pos = svarint(data, pos)
+                    member, pos = self.string(data, pos, pair=False)
+                    member_type = (ord(member[0]) - 48) % 3
+                    self.refs[member_type] += delta
+                    members.append((MEMBER_TYPES[member_type], self.refs[member_type], member[1:]))
+                element = ('relation', self.id, members)
+
+            tags = []
+            while pos < end:
+                tag, pos = self.string(data, pos)
+                tags.append(tag)
+            yield element + (tags,)
@@ -0,0 +1,224 @@
+import glob
+import json
+import os
+import numpy as np
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio
+import pyogrio.raw
+import shapely
+from typing import Iterable
+from osmpgo.tiles import to_mercator, tile_bounds, tile_range, to_lonlat
+from osmpgo.writers import FORMATS, NULLABLE_TYPES, LayerWriter, arrow_table
+
+
+def quadkey(zoom: int, x: int, y: int) -> str:
+    """
+    Bing Maps quadkey of an XYZ tile, one digit per zoom level
+    """
+    return ''.join(str((x >> i & 1) + 2 * (y >> i & 1)) for i in range(zoom - 1, -1, -1))
+
+
+def lonlat_bounds(zoom: int, x: int, y: int) -> tuple:
+    """
+    Longitude and latitude bounds of an XYZ tile
+    """
+    bounds = tile_bounds(zoom, x, y)
+    # Longitudes straight from the column so neighbouring tiles share their edges exactly
+    return (x * 360 / 2 ** zoom - 180, to_lonlat(0, bounds[1])[1], (x + 1) * 360 / 2 ** zoom - 180,
+            to_lonlat(0, bounds[3])[1])
+
+
+class PartitionLayerWriter(LayerWriter):
+    """
+    Writes a layer as one file of the output format per quadkey tile of a zoom level, into {folder}/{quadkey}/.
+    Features go to the tile of their centroid, with clip a feature goes to every tile it crosses cut to the tile
+    bounds. On close the partitions of the layer are listed in {name}_{feature}.partitions.json for write_manifest.
+
+    The features of each chunk are appended to an Arrow stream per tile, {quadkey}/{name}_{feature}.arrows, that is
+    closed again right away, so no file stays open between chunks and no tile buffers rows in memory however many
+    tiles the layer covers. On close the tiles are written to the output format one at a time.
+    """
+
+    def __init__(self, output_format: str, folder: str, name: str, theme: str, feature: str, zoom: int,
+                 clip: bool = False):
+        self.writer_class = FORMATS[output_format]
+        self.folder = folder
+        self.name = name
+        self.theme = theme
+        self.feature = feature
+        self.zoom = zoom
+        self.clip = clip
+        self.path = os.path.join(folder, f'{name}_{feature}.partitions.json')
+        self.layer = f'{theme}_{feature}'
+        self.count = 0
+        self.crs = None
+        self.bounds = {}  # (x, y) to the bounds of the features written to the partition
+
+    def layer_path(self, folder: str, name: str, feature: str) -> str:
+        """
+        File of a layer in the output format, the parts of a large theme are merged from these with copy
+        """
+        return self.writer_class.layer_path(folder, name, feature)
+
+    def spool(self, x: int, y: int) -> str:
+        """
+        Arrow stream file the features of a tile are collected in until close
+        """
+        return os.path.join(self.folder, quadkey(self.zoom, x, y), f'{self.name}_{self.feature}.arrows')
+
+    def append(self, x: int, y: int, table: pa.Table, extent: np.ndarray) -> None:
+        """
+        Append features to the stream file of a tile, each append is a stream of its own
+        Args:
+            x: Tile column
+            y: Tile row
+            table: Features as an Arrow table with WKB geometry, see writers.arrow_table
+            extent: shapely.bounds of the feature geometries
+
+        Returns:
+            None
+        """
+        if (x, y) not in self.bounds:
+            os.makedirs(os.path.dirname(self.spool(x, y)), exist_ok=True)
+            self.bounds[(x, y)] = [np.inf, np.inf, -np.inf, -np.inf]
+        with open(self.spool(x, y), 'ab') as spool_file, pa.ipc.new_stream(spool_file, table.schema) as stream:
+            stream.write_table(table)
+        bounds = self.bounds[(x, y)]
+        self.bounds[(x, y)] = [min(bounds[0], extent[:, 0].min()), min(bounds[1], extent[:, 1].min()),
+                               max(bounds[2], extent[:, 2].max()), max(bounds[3], extent[:, 3].max())]
+
+    def write(self, gdf: gpd.GeoDataFrame) -> None:
+        if len(gdf) == 0:
+            return
+        self.crs = self.crs or gdf.crs
+        geometry = np.asarray(gdf.geometry.values)
+        if self.clip:
+            # Every tile under the bounds, tile_range rows count from the north
+            extent = shapely.bounds(geometry)
+            tiles = tile_range(np.hstack([to_mercator(extent[:, :2]), to_mercator(extent[:, 2:])]), self.zoom)
+            width, height = tiles[:, 2] - tiles[:, 0] + 1, tiles[:, 3] - tiles[:, 1] + 1
+            rows = np.repeat(np.arange(len(gdf)), width * height)
+            offset = np.arange(len(rows)) - np.repeat(np.cumsum(width * height) - width * height, width * height)
+            x = tiles[rows, 0] + offset % width[rows]
+            y = tiles[rows, 1] + offset // width[rows]
+            crossing = (width * height > 1)[rows]
+        else:
+            centroid = shapely.centroid(geometry)
+            centroid = np.column_stack([shapely.get_x(centroid), shapely.get_y(centroid)])
+            tiles = tile_range(np.tile(to_mercator(centroid), 2), self.zoom)
+            rows, x, y = np.arange(len(gdf)), tiles[:, 0], tiles[:, 1]
+            crossing = np.zeros(len(gdf), dtype=bool)
+
+        # The features of each tile follow each other, the chunk is converted to Arrow once and sliced by tile
+        order = np.lexsort((y, x))
+        rows, x, y, crossing = rows[order], x[order], y[order], crossing[order]
+        pieces = geometry[rows]
+        if crossing.any():
+            for begin, end in tile_runs(x, y):
+                cut = np.flatnonzero(crossing[begin:end]) + begin
+                if len(cut) > 0:
+                    pieces[cut] = shapely.clip_by_rect(pieces[cut], *lonlat_bounds(self.zoom, int(x[begin]),
+                                                                                    int(y[begin])))
+            present = ~shapely.is_empty(pieces)
+            rows, x, y, pieces = rows[present], x[present], y[present], pieces[present]
+        if len(rows) > 0:
+            parts = gdf.iloc[rows]
+            table = arrow_table(parts.set_geometry(gpd.GeoSeries(pieces, index=parts.index, crs=gdf.crs,
+                                                                 name=gdf.geometry.name)))
+            extent = shapely.bounds(pieces)
+            for begin, end in tile_runs(x, y):
+                self.append(int(x[begin]), int(y[begin]), table.slice(begin, end - begin), extent[begin:end])
+        self.count += len(gdf)
+
+    def copy(self, path: str, batch_size: int = 65536) -> None:
+        """
+        Partition the same layer of a file written by a writer of the output format, batch by batch so a large part
+        file is never read whole
+        """
+        if not os.path.exists(path):
+            return
+        if self.writer_class.extension.endswith('parquet'):
+            source = pq.ParquetFile(path)
+            # The bbox covering column is left out
+            columns = [name for name in source.schema_arrow.names if name != 'bbox']
+            for batch in source.iter_batches(batch_size=batch_size, columns=columns):
+                self.write(arrow_frame(batch, 'geometry', 'OGC:CRS84'))
+        elif self.layer in pyogrio.list_layers(path)[:, 0]:
+            with pyogrio.raw.open_arrow(path, layer=self.layer, use_pyarrow=True, batch_size=batch_size) as \
+                    (meta, reader):
+                for batch in reader:
+                    geometry = [name for name in batch.schema.names if name not in meta['fields']][0]
+                    self.write(arrow_frame(batch, geometry, meta['crs']))
+
+    def close(self) -> None:
+        partitions = []
+        for x, y in sorted(self.bounds):
+            writer = self.writer_class(os.path.dirname(self.spool(x, y)), self.name, self.theme, self.feature)
+            size = os.path.getsize(self.spool(x, y))
+            with pa.OSFile(self.spool(x, y)) as spool_file:
+                while spool_file.tell() < size:
+                    with pa.ipc.open_stream(spool_file) as reader:
+                        for batch in reader:
+                            writer.write(arrow_frame(batch, 'geometry', self.crs))
+            writer.close()
+            os.remove(self.spool(x, y))
+            if writer.count > 0:
+                partitions.append({'quadkey': quadkey(self.zoom, x, y), 'x': x, 'y': y,
+                                   'path': os.path.relpath(writer.path, self.folder), 'count': writer.count,
+                                   'bbox': [float(value) for value in self.bounds[(x, y)]]})
+        if partitions:
+            with open(self.path, 'w') as layer_file:
+                json.dump({'layer': self.layer, 'partitions': partitions}, layer_file)
+
+
+def tile_runs(x: np.ndarray, y: np.ndarray) -> Iterable[tuple]:
+    """
+    Start and end of each run of the same tile in tile sorted columns and rows
+    """
+    starts = np.flatnonzero(np.r_[True, (x[1:] != x[:-1]) | (y[1:] != y[:-1])])
+    return zip(starts.tolist(), np.r_[starts[1:], len(x)].tolist())
+
+
+def arrow_frame(batch: pa.RecordBatch, geometry: str, crs: str) -> gpd.GeoDataFrame:
+    """
+    GeoDataFrame of a record batch with a WKB geometry column, integer and float columns keep their nulls
+    """
+    frame = batch.drop_columns([geometry]).to_pandas(types_mapper=NULLABLE_TYPES.get)
+    return gpd.GeoDataFrame(frame, geometry=shapely.from_wkb(batch.column(geometry).to_numpy(zero_copy_only=False)),
+                            crs=crs)
+
+
+def write_manifest(folder: str, prefix: str, zoom: int, clip: bool, output_format: str) -> str:
+    """
+    Collects the partition lists of the layers into {prefix}_partitions.json, with the tile bounds, feature count
+    and layer files of every partition
+    Args:
+        folder: Output folder of the export
+        prefix: Prefix of the export
+        zoom: Zoom level of the quadkey tiles
+        clip: Features crossing a tile boundary were cut to the tiles
+        output_format: Key of writers.FORMATS
+
+    Returns:
+        The return value is the path of the manifest
+    """
+    partitions = {}
+    for path in sorted(glob.glob(os.path.join(folder, f'{prefix}_*.partitions.json'))):
+        with open(path) as layer_file:
+            layer = json.load(layer_file)
+        for each in layer['partitions']:
+            partition = partitions.setdefault(each['quadkey'], {
+                'quadkey': each['quadkey'], 'x': each['x'], 'y': each['y'],
+                'bbox': list(lonlat_bounds(zoom, each['x'], each['y'])), 'count': 0, 'layers': {}})
+            partition['count'] += each['count']
+            partition['layers'][layer['layer']] = {'path': each['path'], 'count': each['count'],
+                                                   'bbox': each['bbox']}
+        os.remove(path)
+
+    manifest = os.path.join(folder, f'{prefix}_partitions.json')
+    with open(manifest, 'w') as manifest_file:
+        json.dump({'prefix': prefix, 'format': output_format, 'zoom': zoom, 'clip': clip,
+                   'partitions': [partitions[key] for key in sorted(partitions)]}, manifest_file, indent=1)
+    return manifest
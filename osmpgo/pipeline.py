@@ -0,0 +1,153 @@
+import os
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from shutil import rmtree
+from osmpgo.export_osmxml import ReadOSM, ProcessOSM, ThemeScheduler, NodeOrderError
+from osmpgo.util import timer
+from osmpgo.writers import set_output_queue, output_queue, start_output, stop_output
+from typing import Any
+
+
+def consume_points(posm: ProcessOSM, queue: multiprocessing.Queue, output: Any = None) -> None:
+    """
+    Adds the point batches of the themes assigned to this consumer to their layers as they arrive, the layers are
+    written in chunks and closed once the node section of the XML is finished
+    Args:
+        posm: ProcessOSM used to write the layers
+        queue: Bounded queue of (theme, records) batches, None marks the end of the nodes
+        output: Queue to the writer process of the single output mode
+
+    Returns:
+        None
+    """
+    set_output_queue(output)
+    points = {}
+    begin_time = time.time()
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        theme, batch = item
+        if theme not in points:
+            points[theme] = posm.layer_builder(theme, 'point')
+        for values in batch:
+            points[theme].add(values)
+
+    for theme in points:
+        points[theme].close()
+        print(f'Point Theme {theme} completed after {timer(begin_time, time.time())} '
+              f'with {points[theme].count} points.')
+
+
+class Pipeline:
+    """
+    Runs ReadOSM and ProcessOSM as a streaming producer/consumer pipeline. Point records are sent through bounded
+    queues to consumer processes that write the point layers as soon as the node section is read, and every finished
+    chunk of the way staging is resolved by the process pool while the rest of the file is still being read.
+    """
+
+    def __init__(self, rosm: ReadOSM, posm: ProcessOSM, batch_size: int = 10000, queue_size: int = 8):
+        self.rosm = rosm
+        self.posm = posm
+        self.batch_size = batch_size  # Point records per queue item
+        self.queue_size = queue_size  # Batches a consumer can fall behind before the reader waits
+        self.chunk_size = posm.shard_size  # Way staging bytes per resolve shard
+        self.batches = {}
+        self.queues = []
+        self.consumers = []
+        self.assigned = {}  # Theme to consumer
+        self.scheduler = None
+        self.points_ended = False  # The end of the points was sent to the consumers
+
+    def run(self) -> None:
+        """
+        Read the XML and process it at the same time. Cleans up tmp directory at the end
+        """
+        writer = start_output(self.posm.single_output()) if self.posm.single else None
+        try:
+            with ProcessPoolExecutor(max_workers=self.posm.workers, initializer=set_output_queue,
+                                     initargs=(output_queue(),)) as executor:
+                self.scheduler = ThemeScheduler(self.posm, executor)
+
+                if self.posm.pointb:
+                    for _ in range(max(1, min(self.posm.workers, len(self.posm.themes)))):
+                        queue = multiprocessing.Queue(maxsize=self.queue_size)
+                        consumer = multiprocessing.Process(target=consume_points,
+                                                           args=(self.posm, queue, output_queue()))
+                        consumer.start()
+                        self.queues.append(queue)
+                        self.consumers.append(consumer)
+
+                try:
+                    self.rosm.readxml(self)
+                finally:
+                    # The consumers also finish when reading fails, otherwise they wait on their queues forever
+                    self.end_points()
+                    for consumer in self.consumers:
+                        consumer.join()
+                self.scheduler.run()
+                self.posm.finish_output(executor)
+
+        except BrokenProcessPool as e:
+            print(e)
+            print('This was more than likely a memory issue. Try running with fewer or even 1 '
+                  'work to troubleshoot problem')
+        except NodeOrderError as e:
+            print(e)
+
+        if writer is not None:
+            stop_output(writer)
+        if os.path.exists(self.posm.tempf):
+            rmtree(self.posm.tempf)
+
+    def point(self, theme: str, values: dict) -> None:
+        """
+        Queue a finished point record, records are sent to the consumer of the theme in batches
+        """
+        batch = self.batches.setdefault(theme, [])
+        batch.append(values)
+        if len(batch) >= self.batch_size:
+            self.send(theme)
+
+    def send(self, theme: str) -> None:
+        if theme not in self.assigned:
+            self.assigned[theme] = len(self.assigned) % len(self.queues)
+        # Blocks while the consumer is behind, which keeps the reader from running out of memory
+        self.queues[self.assigned[theme]].put((theme, self.batches.pop(theme)))
+
+    def nodes_done(self, block_count: int) -> None:
+        """
+        The node blocks are final, flush the points and let the consumers write their layers
+        """
+        for theme in list(self.batches):
+            self.send(theme)
+        self.end_points()
+        self.posm.block_count = block_count
+        print(f'Node section finished with {block_count} blocks, writing point layers')
+
+    def end_points(self) -> None:
+        """
+        Tell the consumers that no more point batches will come, once
+        """
+        if not self.points_ended:
+            for queue in self.queues:
+                queue.put(None)
+            self.points_ended = True
+
+    def way_chunk(self, start: int, end: int) -> None:
+        """
+        Resolve a finished chunk of the way staging. The relation members are not known yet, they are collected from
+        the resolved files of the chunk once the relations are read.
+        """
+        self.scheduler.submit_resolve(start, end, store_members=False)
+        self.scheduler.poll()
+
+    def ways_done(self, start: int, end: int) -> None:
+        """
+        Resolve the last chunk of the way staging, which includes the untagged relation members
+        """
+        if end > start:
+            self.scheduler.submit_resolve(start, end)
+        self.scheduler.close_resolve()
@@ -0,0 +1,284 @@
+import os
+import sqlite3
+import numpy as np
+import shapely
+from shapely.geometry import Polygon, MultiPolygon, MultiLineString
+from typing import Iterable, List, Dict
+
+
+class WayGeometryStore:
+    """
+    On disk store of resolved way shapes that are members of a relation. Backed by SQLite so relations can look
+    up their member ways by id without holding every member geometry in memory.
+    """
+
+    def __init__(self, filename: str, batch_size: int = 10000):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.batch = []
+        self.con = sqlite3.connect(filename)
+        self.con.execute('PRAGMA journal_mode = OFF')
+        self.con.execute('PRAGMA synchronous = OFF')
+        self.con.execute('CREATE TABLE IF NOT EXISTS member (way_id INTEGER PRIMARY KEY, shape BLOB)')
+
+    def add(self, way_id: str, shape: list) -> None:
+        """
+        Queue a way shape for insert, shapes are written in batches
+        Args:
+            way_id: OSM way id
+            shape: List of coordinate tuples
+
+        Returns:
+            None
+        """
+        self.batch.append((int(way_id), np.asarray(shape, dtype='float64').tobytes()))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if len(self.batch) > 0:
+            self.con.executemany('INSERT OR REPLACE INTO member VALUES (?, ?)', self.batch)
+            self.con.commit()
+            self.batch = []
+
+    def get(self, way_ids: Iterable[str]) -> Dict[str, list]:
+        """
+        Look up the shapes of a group of ways
+        Args:
+            way_ids: OSM way ids
+
+        Returns:
+            The return value is a dictionary of way id to a list of coordinate tuples. Missing ways are left out.
+        """
+        self.flush()
+        way_ids = list(set(way_ids))
+        shapes = {}
+        for i in range(0, len(way_ids), 500):
+            chunk = way_ids[i:i + 500]
+            sql = 'SELECT way_id, shape FROM member WHERE way_id IN ({})'.format(','.join('?' * len(chunk)))
+            for way_id, blob in self.con.execute(sql, [int(each) for each in chunk]):
+                coords = np.frombuffer(blob, dtype='float64').reshape(-1, 2)
+                shapes[str(way_id)] = [(x, y) for x, y in coords]
+        return shapes
+
+    def close(self) -> None:
+        self.flush()
+        self.con.close()
+
+
+def member_ids(filename: str) -> np.ndarray:
+    """
+    Load the sorted array of way ids that are members of a relation
+    Args:
+        filename: Path to the .npy file written by readxml
+
+    Returns:
+        The return value is a sorted int64 array, empty when there are no relations
+    """
+    if os.path.exists(filename):
+        return np.load(filename)
+    return np.empty(0, dtype='int64')
+
+
+def is_member(members: np.ndarray, way_id: str) -> bool:
+    """
+    Binary search a way id in the sorted member array
+    """
+    if len(members) == 0:
+        return False
+    way_id = int(way_id)
+    i = np.searchsorted(members, way_id)
+    return i < len(members) and members[i] == way_id
+
+
+def stitch_rings(lines: List[list]) -> List[list]:
+    """
+    Join member ways end to end into closed rings. Ways are looked up through a hash index of their end points, so
+    each join is a dictionary lookup rather than a search over every other way.
+    Args:
+        lines: List of way shapes, each a list of coordinate tuples
+
+    Returns:
+        The return value is a list of closed rings. Ways that can not be closed are dropped.
+    """
+    rings = []
+    ends = {}
+    open_lines = []
+    for i, line in enumerate(lines):
+        if len(line) < 2:
+            continue
+        if line[0] == line[-1]:
+            if len(line) > 3:
+                rings.append(line)
+            continue
+        open_lines.append(i)
+        ends.setdefault(line[0], []).append(i)
+        ends.setdefault(line[-1], []).append(i)
+
+    used = set()
+    for i in open_lines:
+        if i in used:
+            continue
+        used.add(i)
+        ring = list(lines[i])
+        while ring[-1] != ring[0]:
+            tail = ring[-1]
+            nxt = None
+            for j in ends.get(tail, []):
+                if j not in used:
+                    nxt = j
+                    break
+            if nxt is None:
+                ring = None  # Open ring, member ways are missing
+                break
+            used.add(nxt)
+            line = lines[nxt]
+            if line[0] != tail:
+                line = line[::-1]
+            ring.extend(line[1:])
+        if ring is not None and len(ring) > 3:
+            rings.append(ring)
+    return rings
+
+
+def assemble_multipolygon(members: list, shapes: dict):
+    """
+    Build a multipolygon relation from its member ways. Outer and inner rings are stitched separately and each inner
+    ring is assigned to the smallest outer ring that covers it through a spatial index.
+    Args:
+        members: List of (way id, role) tuples
+        shapes: Dictionary of way id to shape from WayGeometryStore
+
+    Returns:
+        The return value is a valid MultiPolygon or None if no ring could be closed
+    """
+    outer_lines = []
+    inner_lines = []
+    for way_id, role in members:
+        if way_id not in shapes:
+            continue
+        if role == 'inner':
+            inner_lines.append(shapes[way_id])
+        else:
+            outer_lines.append(shapes[way_id])  # Blank roles are treated as outer
+
+    outers = [Polygon(ring) for ring in stitch_rings(outer_lines)]
+    if len(outers) == 0:
+        return None
+    inners = [Polygon(ring) for ring in stitch_rings(inner_lines)]
+
+    holes = [[] for _ in outers]
+    if len(inners) > 0:
+        areas = shapely.area(outers)
+        tree = shapely.STRtree(outers)
+        inner_idx, outer_idx = tree.query(inners, predicate='covered_by')
+        best = {}
+        for i, o in zip(inner_idx, outer_idx):
+            if i not in best or areas[o] < areas[best[i]]:
+                best[i] = o
+        for i, o in best.items():
+            holes[o].append(inners[i].exterior.coords)
+
+    parts = []
+    for outer, outer_holes in zip(outers, holes):
+        polygon = Polygon(outer.exterior.coords, outer_holes)
+        if not polygon.is_valid:
+            polygon = shapely.make_valid(polygon)
+        parts.extend(polygon_parts(polygon))
+
+    if len(parts) == 0:
+        return None
+    multipolygon = MultiPolygon(parts)
+    if not multipolygon.is_valid:
+        # Outers that overlap or share an edge are merged
+        parts = polygon_parts(shapely.make_valid(multipolygon))
+        multipolygon = MultiPolygon(parts) if len(parts) > 0 else None
+    return multipolygon
+
+
+def polygon_parts(geom) -> list:
+    """
+    Pull the non empty polygons out of any geometry, make_valid can return collections of mixed types
+    """
+    if geom.geom_type == 'Polygon':
+        return [] if geom.is_empty else [geom]
+    if geom.geom_type in ('MultiPolygon', 'GeometryCollection'):
+        parts = []
+        for part in shapely.get_parts(geom):
+            parts.extend(polygon_parts(part))
+        return parts
+    return []
+
+
+def merge_lines(lines: List[list]) -> List[list]:
+    """
+    Merge ways end to end into continuous parts. Each part is grown from both of its ends through an adjacency index
+    of way end points, ways are flipped as needed to follow the direction of the part.
+    Args:
+        lines: List of way shapes, each a list of coordinate tuples
+
+    Returns:
+        The return value is a list of merged parts
+    """
+    ends = {}
+    for i, line in enumerate(lines):
+        if len(line) < 2:
+            continue
+        ends.setdefault(line[0], []).append(i)
+        ends.setdefault(line[-1], []).append(i)
+
+    def next_line(point):
+        for j in ends.get(point, []):
+            if j not in used:
+                used.add(j)
+                return lines[j]
+        return None
+
+    parts = []
+    used = set()
+    for i, line in enumerate(lines):
+        if i in used or len(line) < 2:
+            continue
+        used.add(i)
+        part = list(line)
+        while True:
+            line = next_line(part[-1])
+            if line is None:
+                break
+            part.extend(line[1:] if line[0] == part[-1] else line[::-1][1:])
+        # Ways found at the head are collected in the order they are found and joined once, in reverse
+        heads = []
+        point = part[0]
+        while True:
+            line = next_line(point)
+            if line is None:
+                break
+            line = line if line[-1] == point else line[::-1]
+            heads.append(line[:-1])
+            point = line[0]
+        parts.append([coord for head in reversed(heads) for coord in head] + part)
+    return parts
+
+
+def assemble_route(members: list, shapes: dict):
+    """
+    Build a route relation from its member ways. Platforms and stops are left out.
+    Args:
+        members: List of (way id, role) tuples
+        shapes: Dictionary of way id to shape from WayGeometryStore
+
+    Returns:
+        The return value is a MultiLineString or None if none of the member ways were found
+    """
+    lines = []
+    seen = set()
+    for way_id, role in members:
+        if way_id not in shapes or way_id in seen or role.startswith('platform') or role.startswith('stop'):
+            continue
+        seen.add(way_id)
+        lines.append(shapes[way_id])
+
+    parts = merge_lines(lines)
+    if len(parts) == 0:
+        return None
+    return MultiLineString(parts)
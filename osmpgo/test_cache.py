@@ -0,0 +1,41 @@
+import os
+import time
+import numpy as np
+import shapely
+from osmpgo.cache import ExtractCache
+
+
+def test_cache_key(tmpdir):
+    tmpdir.join('a.osm.pbf').write('osm data')
+    tmpdir.join('b.osm.pbf').write('osm data')
+    cache = ExtractCache(str(tmpdir.join('cache')), 1000)
+    square = shapely.Polygon([(0, 0), (1, 0), (1, 1), (0, 1)])
+    other = shapely.Polygon([(1, 1), (0, 1), (0, 0), (1, 0)])
+    key = cache.key(str(tmpdir.join('a.osm.pbf')), np.asarray([square]), '-B')
+    assert key == cache.key(str(tmpdir.join('b.osm.pbf')), np.asarray([other]), '-B')
+    assert key != cache.key(str(tmpdir.join('a.osm.pbf')), np.asarray([square]), '-b')
+    assert key != cache.key(str(tmpdir.join('a.osm.pbf')))
+
+
+def test_cache_get_put_evict(tmpdir):
+    cache = ExtractCache(str(tmpdir.join('cache')), 25)
+    output = str(tmpdir.join('out.osm.xml'))
+    assert not cache.get('a', output)
+    for key in ('a', 'b'):
+        # Extracts replace the output, they do not write through the link to the cache
+        tmpdir.join('new.osm.xml').write(key * 10)
+        os.replace(str(tmpdir.join('new.osm.xml')), output)
+        cache.put(key, output)
+        # A miss leaves the output alone
+        assert not cache.get('c', output) and open(output).read() == key * 10
+        time.sleep(0.01)
+    assert cache.get('a', output) and open(output).read() == 'a' * 10
+    # The output is already linked to the cache
+    assert cache.get('a', output) and not os.path.exists(output + '.tmp')
+
+    tmpdir.join('new.o5m').write('c' * 10)
+    cache.put('c', str(tmpdir.join('new.o5m')))
+    # The extension is part of the name, b is the least recently used of every extension
+    assert sorted(os.listdir(str(tmpdir.join('cache')))) == ['a.osm.xml', 'c.o5m']
+    assert not cache.get('c', output) and cache.get('c', str(tmpdir.join('c.o5m')))
+    assert tmpdir.join('cache', 'a.osm.xml').read() == 'a' * 10
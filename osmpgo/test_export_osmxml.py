@@ -1,50 +1,199 @@
-import pickle
-from osmpgo.export_osmxml import ProcessOSM, ReadOSM
-import pytest
-
-
-@pytest.fixture
-def create_processosm():
-    return ProcessOSM(['test'], ['point'], 1, 'test', 'test', 'test', 4)
-
-
-@pytest.fixture
-def create_readosm():
-    return ReadOSM('test.xml', ['test'], ['point'], 1)
-
-
-def test_loadall(tmpdir, create_processosm):
-    file = tmpdir.mkdir("pickle").join("pickle.pkl")
-    node_file = open(file, 'wb')
-    info = 'vampire'
-    pickle.dump(info, node_file)
-    info = 'wraith'
-    pickle.dump(info, node_file)
-    node_file.close()
-    assert len(list(create_processosm.loadall(file))) == 2
-
-
-def test_get_element_name(create_readosm):
-    node = '<node id="625025" lat="42.5142133" lon="1.5527243"/>'
-    assert create_readosm.get_element_name(node) == 'node'
-
-
-def test_get_node_details(create_readosm):
-    node = '<node id="625025" lat="42.5142133" lon="1.5527243"/>'
-    assert create_readosm.get_node_details(node) == ('625025', 1.5527243, 42.5142133)
-
-
-def test_get_attribute_value(create_readosm):
-    node = '<node id="625025" lat="42.5142133" lon="1.5527243"/>'
-    assert create_readosm.get_attribute_value('id', node) == '625025'
-
-
-def test_return_id(create_readosm):
-    node = '<node id="625025" lat="42.5142133" lon="1.5527243"/>'
-    assert create_readosm.return_id(node) == '625025'
-
-
-def test_get_tag_details(create_readosm):
-    tag = '<tag k="highway" v="crossing"/>'
-    assert create_readosm.get_tag_details(tag) == ('highway', 'crossing')
-
+import json
+import os
+import pickle
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import Point, Polygon, LineString
+from osmpgo.export_osmxml import ProcessOSM, ReadOSM, PendingWays
+import pytest
+
+
+@pytest.fixture
+def create_processosm():
+    return ProcessOSM(['test'], ['point'], 1, 'test', 'test', 'test', 4)
+
+
+@pytest.fixture
+def create_readosm():
+    return ReadOSM('test.xml', ['test'], ['point'], 1)
+
+
+def test_loadall(tmpdir, create_processosm):
+    file = tmpdir.mkdir("pickle").join("pickle.pkl")
+    node_file = open(file, 'wb')
+    info = 'vampire'
+    pickle.dump(info, node_file)
+    info = 'wraith'
+    pickle.dump(info, node_file)
+    node_file.close()
+    assert len(list(create_processosm.loadall(file))) == 2
+
+
+def test_get_element_name(create_readosm):
+    node = '<node id="625025" lat="42.5142133" lon="1.5527243"/>'
+    assert create_readosm.get_element_name(node) == 'node'
+
+
+def test_get_node_details(create_readosm):
+    node = '<node id="625025" lat="42.5142133" lon="1.5527243"/>'
+    assert create_readosm.get_node_details(node) == ('625025', 1.5527243, 42.5142133)
+
+
+def test_get_attribute_value(create_readosm):
+    node = '<node id="625025" lat="42.5142133" lon="1.5527243"/>'
+    assert create_readosm.get_attribute_value('id', node) == '625025'
+
+
+def test_return_id(create_readosm):
+    node = '<node id="625025" lat="42.5142133" lon="1.5527243"/>'
+    assert create_readosm.return_id(node) == '625025'
+
+
+def test_get_tag_details(create_readosm):
+    tag = '<tag k="highway" v="crossing"/>'
+    assert create_readosm.get_tag_details(tag) == ('highway', 'crossing')
+
+
+
+def test_pending_ways_spill(tmpdir):
+    staged = str(tmpdir.join('test_way.pkl'))
+    with open(staged, 'wb') as fp:
+        for way_id, refs in (('1', ['a', 'b']), ('2', ['b', 'c', 'd']), ('3', ['a', 'd'])):
+            pickle.dump({'way_id': way_id, 'ref': refs, 'ref_remaing': refs, 'coords': {}}, fp)
+    pending = PendingWays(staged, str(tmpdir), 'test', 3)
+
+    built = [way['way_id'] for way in pending.resolve({'a': (0, 0), 'b': (1, 1)})]
+    assert built == ['1']
+    assert len(pending) == 2
+    assert pending.refs <= 3 and pending.spill_count == 1
+
+    built = [way['way_id'] for way in pending.resolve({'c': (2, 2), 'd': (3, 3)})]
+    assert sorted(built) == ['2', '3']
+    assert len(pending) == 0
+    pending.close()
+    assert tmpdir.listdir(lambda p: p.basename.startswith('pending_')) == []
+
+
+def test_resolve_ways_fan_out(tmpdir):
+    tempf = str(tmpdir)
+    with open(tmpdir.join('nodeblock_1.pkl'), 'wb') as fp:
+        for node in (['1', 0.0, 0.0], ['2', 1.0, 0.0], ['3', 1.0, 1.0]):
+            pickle.dump(node, fp)
+    with open(tmpdir.join('way.pkl'), 'wb') as fp:
+        refs = ['1', '2', '3', '1']
+        pickle.dump({'way_id': '10', 'ref': refs, 'ref_remaing': refs, 'coords': {}, 'themes': ['building', 'historic'],
+                     'attrib': {'building': 'yes', 'height': '12', 'historic': 'ruins'}}, fp)
+    posm = ProcessOSM(['building', 'historic'], ['polygon'], 1, tempf, tempf, 'test', 1)
+    posm.resolve_ways()
+
+    building = list(posm.loadall(tmpdir.join('building_resolved_0.pkl')))
+    historic = list(posm.loadall(tmpdir.join('historic_resolved_0.pkl')))
+    assert building[0]['shape'] == historic[0]['shape'] == [(0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 0.0)]
+    assert building[0]['attrib'] == {'building': 'yes', 'height': '12'}
+    assert historic[0]['attrib'] == {'building': 'yes', 'historic': 'ruins'}
+
+
+def test_plan_shards_on_record_boundaries(tmpdir):
+    offsets = []
+    with open(tmpdir.join('way.pkl'), 'wb') as fp:
+        for i in range(100):
+            pickle.dump({'way_id': str(i), 'ref': ['1'] * 10}, fp)
+            offsets.append(fp.tell())
+    np.save(str(tmpdir.join('way_offsets.npy')), np.array(offsets, dtype='int64'))
+    posm = ProcessOSM(['building'], ['polygon'], 4, str(tmpdir), str(tmpdir), 'test', 1)
+    posm.shard_size = 1000
+
+    shards = posm.plan_shards()
+    assert len(shards) == 4
+    assert shards[0][0] == 0 and shards[-1][1] == offsets[-1]
+    ways = [way['way_id'] for start, end in shards for way in posm.loadall(str(tmpdir.join('way.pkl')), start, end)]
+    assert ways == [str(i) for i in range(100)]
+
+
+def test_readxml_staging_stats(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    xml = tmpdir.join('test.osm')
+    xml.write('<osm>\n'
+              '<node id="1" lat="42.5" lon="1.5">\n<tag k="amenity" v="bench"/>\n</node>\n'
+              '<node id="2" lat="42.6" lon="1.6"/>\n'
+              '<way id="3">\n<nd ref="1"/>\n<nd ref="2"/>\n<tag k="highway" v="path"/>\n'
+              '<tag k="amenity" v="parking"/>\n</way>\n'
+              '</osm>\n')
+    rosm = ReadOSM(str(xml), ['amenity', 'building', 'highway'], ['point', 'line'], 1)
+    rosm.readxml()
+    assert rosm.stats['point'] == {'amenity': 1, 'building': 0, 'highway': 0}
+    assert rosm.stats['way'] == {'amenity': 1, 'building': 0, 'highway': 1}
+
+
+def test_readxml_clip(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    xml = tmpdir.join('test.osm')
+    xml.write('<osm>\n'
+              '<node id="1" lat="0.2" lon="0.2">\n<tag k="amenity" v="bench"/>\n</node>\n'
+              '<node id="2" lat="0.1" lon="0.8"/>\n'
+              '<node id="3" lat="0.9" lon="0.8">\n<tag k="amenity" v="bench"/>\n</node>\n'
+              '<node id="4" lat="2" lon="2"/>\n'
+              '<way id="5">\n<nd ref="1"/>\n<nd ref="4"/>\n<tag k="highway" v="path"/>\n</way>\n'
+              '<way id="6">\n<nd ref="3"/>\n<nd ref="4"/>\n<tag k="highway" v="path"/>\n</way>\n'
+              '<way id="7">\n<nd ref="3"/>\n<nd ref="4"/>\n</way>\n'
+              '<relation id="8">\n<member type="way" ref="5" role="outer"/>\n<tag k="type" v="multipolygon"/>\n'
+              '<tag k="building" v="yes"/>\n</relation>\n'
+              '<relation id="9">\n<member type="way" ref="7" role="outer"/>\n<tag k="type" v="multipolygon"/>\n'
+              '<tag k="building" v="yes"/>\n</relation>\n'
+              '</osm>\n')
+    # Node 3 is inside the bounds of the triangle but outside the triangle
+    rosm = ReadOSM(str(xml), ['amenity', 'building', 'highway'], ['point', 'line', 'polygon'], 1,
+                   clip=Polygon([(0, 0), (1, 0), (0, 1)]))
+    rosm.readxml()
+    assert rosm.stats['point'] == {'amenity': 1, 'building': 0, 'highway': 0}
+    assert rosm.stats['way'] == {'amenity': 0, 'building': 0, 'highway': 1}
+    assert rosm.stats['relation'] == {'amenity': 0, 'building': 1, 'highway': 0}
+    # Node 4 is outside but way 5 crosses the border to it
+    assert list(ProcessOSM.loadall(os.path.join(rosm.tempf, 'nodeblock_1.pkl'))) == \
+        [['1', 0.2, 0.2], ['2', 0.8, 0.1], ['4', 2.0, 2.0]]
+    posm = ProcessOSM(['highway'], ['line'], 1, rosm.tempf, str(tmpdir), 'test', rosm.block_count)
+    posm.resolve_ways()
+    ways = list(posm.loadall(os.path.join(rosm.tempf, 'highway_resolved_0.pkl')))
+    assert [(way['way_id'], way['shape']) for way in ways] == [('5', [(0.2, 0.2), (2.0, 2.0)])]
+
+
+def test_schedule_largest_first(tmpdir):
+    stats = {'point': {'amenity': 1, 'building': 0, 'highway': 2}, 'way': {}, 'relation': {}}
+    tmpdir.join('staging_stats.json').write(json.dumps(stats))
+    tmpdir.join('amenity_point.pkl').write('x' * 10)
+    tmpdir.join('highway_point.pkl').write('x' * 100)
+    posm = ProcessOSM(['amenity', 'building', 'highway'], ['point'], 1, str(tmpdir), str(tmpdir), 'test', 1)
+    assert posm.schedule('point') == ['highway', 'amenity']
+
+
+def test_process_nodes_streams_chunks(tmpdir):
+    with open(tmpdir.join('amenity_point.pkl'), 'wb') as f:
+        for i in range(5):
+            pickle.dump({'node_id': str(i), 'amenity': 'bench', 'geometry': Point(i, i)}, f)
+    posm = ProcessOSM(['amenity'], ['point'], 1, str(tmpdir), str(tmpdir), 'test', 1,
+                      output_format='geoparquet', layer_chunk=2)
+    posm.process_nodes('amenity')
+    gdf = gpd.read_parquet(tmpdir.join('test_amenity_point.parquet'))
+    assert list(gdf['node_id']) == ['0', '1', '2', '3', '4']
+    assert set(gdf['amenity']) == {'bench'}
+
+
+def test_merge_parts_selected_features(tmpdir):
+    tempf = tmpdir.mkdir('tmp')
+    posm = ProcessOSM(['highway'], ['line'], 1, str(tempf), str(tmpdir), 'test', 1, output_format='geoparquet')
+    for part in range(2):
+        writer = posm.layer_writer('highway', 'line', part)
+        writer.write(gpd.GeoDataFrame({'way_id': [str(part)]}, geometry=[LineString([(0, 0), (1, part)])], crs=4326))
+        writer.close()
+    opened = []
+    layer_writer = posm.layer_writer
+
+    def record(theme, feature, part=None):
+        opened.append(feature)
+        return layer_writer(theme, feature, part)
+
+    posm.layer_writer = record
+    posm.merge_parts('highway', 2)
+    # Only the line layer is merged, there is no polygon layer to look for in the parts
+    assert opened == ['line']
+    assert list(gpd.read_parquet(str(tmpdir.join('test_highway_line.parquet')))['way_id']) == ['0', '1']
@@ -0,0 +1,49 @@
+import os
+import stat
+import sys
+import pytest
+from osmpgo.extract_jobs import ExtractJob, run_extracts
+from osmpgo.extract_osmxml import osmconvert_args
+
+# Stands in for osmconvert, writes its -o file and reports on stderr like osmconvert --verbose
+FAKE_OSMCONVERT = f'''#!{sys.executable}
+import sys
+import time
+args = dict(arg[1:].split('=', 1) for arg in sys.argv[2:] if '=' in arg)
+if 'B' in args:
+    print('osmconvert Error: no polygon file or too large: -B=' + args['B'], file=sys.stderr)
+    sys.exit(4)
+print('osmconvert: Verbose mode.', file=sys.stderr, flush=True)
+time.sleep(0.3)
+with open(args['o'], 'w') as osm_file:
+    osm_file.write(args['b'])
+print('osmconvert: Last processed: relation 9003.', file=sys.stderr)
+'''
+
+
+def test_osmconvert_args():
+    assert osmconvert_args('osmconvert', 'in.pbf', os.path.join('out', 'a.osm.xml'), bbox=[1, 2, 3.5, 4]) == [
+        'osmconvert', 'in.pbf', '-b=1,2,3.5,4', f'-o={os.path.join("out", "a.osm.xml")}',
+        f'-t={os.path.join("out", "osm_temp")}']
+    assert osmconvert_args('osmconvert', 'in.pbf', 'a.osm.xml', poly='a.poly', temp='a_temp')[2:] == [
+        '-B=a.poly', '-o=a.osm.xml', '-t=a_temp']
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='runs a script as the osmconvert executable')
+def test_run_extracts(tmpdir):
+    osmconvert = str(tmpdir.join('osmconvert'))
+    with open(osmconvert, 'w') as script:
+        script.write(FAKE_OSMCONVERT)
+    os.chmod(osmconvert, os.stat(osmconvert).st_mode | stat.S_IEXEC)
+    jobs = [ExtractJob('a', 'in.pbf', str(tmpdir.join('a.osm.xml')), bbox=[1, 2, 3, 4]),
+            ExtractJob('b', 'in.pbf', str(tmpdir.join('b.osm.xml')), poly='b.poly'),
+            ExtractJob('c', 'in.pbf', str(tmpdir.join('c.osm.xml')), bbox=[5, 6, 7, 8])]
+    calls = []
+    results = run_extracts(jobs, osmconvert, workers=2, progress=lambda *args: calls.append(args), interval=0.1)
+
+    assert [result.job.name for result in results] == ['a', 'b', 'c']
+    assert [result.returncode for result in results] == [0, 4, 0]
+    assert results[0].ok and results[0].size == len('1,2,3,4') and results[0].last == ('relation', 9003)
+    assert not results[1].ok and results[1].last is None and 'too large' in results[1].messages[0]
+    assert results[2].duration >= 0.3
+    assert (jobs[0], 0, None) in calls and (jobs[2], 7, 'osmconvert: Last processed: relation 9003.') in calls
@@ -0,0 +1,85 @@
+import io
+import os
+import geopandas as gpd
+import shapely
+import numpy as np
+from osmpgo.extract_osmxml import RegionSplitter, split_osm, read_regions, write_poly, cover_simplify
+
+OSM = '''<?xml version='1.0' encoding='UTF-8'?>
+<osm version="0.6" generator="osmconvert 0.8.11">
+	<bounds minlat="0" minlon="0" maxlat="2" maxlon="4"/>
+	<node id="1" lat="1" lon="0.5" version="1"/>
+	<node id="2" lat="1" lon="1.5" version="1">
+		<tag k="amenity" v="bench"/>
+	</node>
+	<node id="3" lat="1" lon="2.5" version="1"/>
+	<node id="4" lat="1" lon="3.5" version="1"/>
+	<way id="10" version="1">
+		<nd ref="1"/>
+		<nd ref="2"/>
+		<tag k="highway" v="path"/>
+	</way>
+	<way id="11" version="1">
+		<nd ref="2"/>
+		<nd ref="3"/>
+	</way>
+	<way id="12" version="1">
+		<nd ref="4"/>
+	</way>
+	<relation id="20" version="1">
+		<member type="way" ref="11" role=""/>
+		<tag k="type" v="route"/>
+	</relation>
+	<relation id="21" version="1">
+		<member type="relation" ref="20" role=""/>
+	</relation>
+	<relation id="22" version="1">
+		<member type="node" ref="4" role=""/>
+	</relation>
+</osm>
+'''
+
+
+def test_split_osm_regions(tmpdir):
+    regions = gpd.GeoSeries([shapely.box(0, 0, 2, 2), shapely.box(2, 0, 3, 2)], index=['west', 'east'], crs=4326)
+    counts = split_osm(io.StringIO(OSM), RegionSplitter(regions, str(tmpdir), batch_size=2), block_size=100)
+    assert counts == {'west': (2, 2, 2), 'east': (1, 1, 2)}
+
+    west = tmpdir.join('west.osm.xml').read()
+    assert west.startswith("<?xml version='1.0' encoding='UTF-8'?>\n<osm version")
+    assert '<bounds minlat="0.0000000" minlon="0.0000000" maxlat="2.0000000" maxlon="2.0000000"/>' in west
+    assert '\t<node id="2" lat="1" lon="1.5" version="1">\n\t\t<tag k="amenity" v="bench"/>\n\t</node>\n' in west
+    assert west.endswith('\t</relation>\n</osm>\n') and 'id="12"' not in west
+    east = tmpdir.join('east.osm.xml').read()
+    assert [line.split('"')[1] for line in east.splitlines() if ' id="' in line] == ['3', '11', '20', '21']
+
+
+def test_read_regions_by_field(tmpdir):
+    gpd.GeoDataFrame({'name': ['La Massana', 'Canillo', 'Canillo']},
+                     geometry=[shapely.box(0, 0, 1, 1), shapely.box(1, 0, 2, 1), shapely.box(2, 0, 3, 1)],
+                     crs=4326).to_file(str(tmpdir.join('regions.gpkg')))
+    regions = read_regions(str(tmpdir.join('regions.gpkg')), field='name')
+    assert list(regions.index) == ['Canillo', 'La_Massana']
+    assert regions['Canillo'].area == 2
+
+
+def test_write_poly(tmpdir):
+    square = shapely.box(0, 0, 2, 2).difference(shapely.box(0.5, 0.5, 1, 1))
+    gpd.GeoDataFrame(geometry=[square, shapely.MultiPolygon([shapely.box(3, 0, 4, 1), shapely.box(5, 0, 6, 1)])],
+                     crs=4326).to_file(str(tmpdir.join('clip.shp')))
+    poly = write_poly(str(tmpdir.join('clip.shp')), str(tmpdir.join('clip.osm.xml')))
+    lines = open(poly).read().splitlines()
+    os.remove(poly)
+    assert [line for line in lines if not line.startswith('\t')] == ['clip', '0', 'END', '!1', 'END', '2', 'END', '3',
+                                                                       'END', 'END']
+    assert '\t2.0000000E+00\t2.0000000E+00' in lines[2:7] and len(lines) == 30
+
+
+def test_cover_simplify():
+    angles = np.linspace(0, 2 * np.pi, 5000, endpoint=False)
+    radius = 1 + 0.01 * np.sin(angles * 301)
+    coast = np.array([shapely.Polygon(np.column_stack([radius * np.cos(angles), radius * np.sin(angles)]))])
+    simplified = cover_simplify(coast, 0.02)
+    assert shapely.covers(simplified, coast).all()
+    assert shapely.get_num_coordinates(simplified)[0] < 500
+    assert shapely.hausdorff_distance(simplified, coast)[0] < 0.1
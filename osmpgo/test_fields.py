@@ -0,0 +1,35 @@
+import pytest
+from osmpgo.fields import parse_field, read_field_types, typed_fields
+
+
+def values(series):
+    return series.to_numpy(dtype=object, na_value=None).tolist()
+
+
+def test_read_field_types():
+    types = read_field_types()
+    assert types['lanes'] == 'int' and types['height'] == 'length' and types['maxspeed'] == 'speed'
+    assert 'name' not in types
+
+
+def test_parse_int_and_float():
+    assert values(parse_field(['2', ' 3 ', '2.5', '', 'many', '-1'], 'int')) == [2, 3, None, None, None, -1]
+    assert values(parse_field(['2', '2.5', '.5', '', '3;4'], 'float')) == [2.0, 2.5, 0.5, None, None]
+    assert values(parse_field(['99999999999999999999', '-999999999999999999', '7'], 'int')) == \
+        [None, -999999999999999999, 7]
+
+
+def test_parse_units():
+    heights = parse_field(['12', '12 m', '3.5m', '40 ft', '6\'2"', '', 'tall', '1.2 km'], 'length')
+    assert values(heights.round(3)) == [12.0, 12.0, 3.5, 12.192, 1.88, None, None, 1200.0]
+    speeds = parse_field(['50', '30 mph', 'walk', 'none', '20 knots'], 'speed')
+    assert values(speeds.round(2)) == [50.0, 48.28, None, None, 37.04]
+    with pytest.raises(ValueError):
+        parse_field(['1'], 'date')
+
+
+def test_typed_fields_leaves_strings():
+    flds = typed_fields({'name': ['a', ''], 'lanes': ['1', ''], 'surface': ['asphalt', '']},
+                        {'lanes': 'int', 'surface': 'category'})
+    assert flds['name'] == ['a', ''] and str(flds['lanes'].dtype) == 'Int64'
+    assert list(flds['surface'].cat.categories) == ['asphalt'] and list(flds['surface'].isna()) == [False, True]
@@ -0,0 +1,82 @@
+from osmpgo.o5m import O5mReader, uvarint, svarint
+from osmpgo.export_osmxml import ReadOSM
+
+
+def uvar(value):
+    data = b''
+    while value >= 0x80:
+        data += bytes([value & 0x7f | 0x80])
+        value >>= 7
+    return data + bytes([value])
+
+
+def svar(value):
+    return uvar(value * 2 if value >= 0 else -value * 2 - 1)
+
+
+def dataset(kind, body):
+    return bytes([kind]) + uvar(len(body)) + body
+
+
+def o5m_sample():
+    long_value = b'x' * 300
+    node_1 = svar(10) + uvar(0) + svar(15000000) + svar(425000000) + \
+        b'\0amenity\0bench\0' + b'\0note\0' + long_value + b'\0'
+    # Version, timestamp, changeset and the uid, user pair that takes a place in the string table
+    node_2 = svar(1) + uvar(1) + svar(100) + svar(5) + b'\0\x01\0alice\0' + svar(1000000) + svar(-1000000) + uvar(2)
+    # After the reset the ids, refs and strings start over
+    refs = svar(10) + svar(1)
+    way = svar(20) + uvar(0) + uvar(len(refs)) + refs + b'\0highway\0path\0'
+    members = svar(20) + b'\x001outer\0' + svar(1) + uvar(1) + svar(0) + b'\x000\0'
+    relation = svar(10) + uvar(1) + svar(0) + uvar(len(members)) + members + b'\0type\0multipolygon\0' + uvar(4)
+    return (bytes([0xff]) + dataset(0xe0, b'o5m2') + dataset(0x10, node_1) + dataset(0x10, node_2) + bytes([0xff]) +
+            dataset(0x11, way) + dataset(0x12, relation))
+
+
+def test_varint():
+    assert uvarint(uvar(300), 0) == (300, 2)
+    assert svarint(b'\x00' + svar(-65), 1) == (-65, 3)
+
+
+def test_o5m_elements(tmpdir):
+    o5m = tmpdir.join('test.o5m')
+    o5m.write_binary(o5m_sample())
+    elements = list(O5mReader(str(o5m), block_size=16).elements())
+    assert elements[0] == ('node', 10, 1.5, 42.5, [('amenity', 'bench'), ('note', 'x' * 300)])
+    assert elements[1] == ('node', 11, 1.6, 42.4, [('amenity', 'bench')])
+    assert elements[2] == ('way', 20, [10, 11], [('highway', 'path')])
+    assert elements[3] == ('relation', 30, [('way', 20, 'outer'), ('way', 21, 'outer'), ('node', 11, '')],
+                           [('type', 'multipolygon'), ('highway', 'path')])
+
+
+def test_o5m_block_sizes(tmpdir):
+    o5m = tmpdir.join('test.o5m')
+    o5m.write_binary(o5m_sample())
+    elements = list(O5mReader(str(o5m)).elements())
+    assert len(elements) == 4
+    # Resets, lengths and datasets split at every possible block boundary
+    for block_size in range(1, len(o5m_sample()) + 1):
+        assert list(O5mReader(str(o5m), block_size=block_size).elements()) == elements
+
+
+def test_readxml_o5m(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    o5m = tmpdir.join('test.o5m')
+    o5m.write_binary(o5m_sample())
+    rosm = ReadOSM(str(o5m), ['amenity', 'highway'], ['point', 'line'], 1)
+    rosm.readxml()
+    assert rosm.stats['point'] == {'amenity': 2, 'highway': 0}
+    assert rosm.stats['way'] == {'amenity': 0, 'highway': 1}
+
+
+def test_o5m_anonymous_user(tmpdir):
+    # osmconvert writes an empty uid and user name for anonymous objects
+    node_1 = svar(5) + uvar(1) + svar(100) + svar(5) + b'\0\0\0' + svar(10) + svar(20) + b'\0amenity\0bench\0'
+    # The uid is a varint, the last node refers back to the anonymous pair
+    node_2 = svar(1) + uvar(1) + svar(0) + svar(0) + b'\0' + uvar(128) + b'\0bob\0' + svar(10) + svar(20) + uvar(2)
+    node_3 = svar(1) + uvar(1) + svar(0) + svar(0) + uvar(3) + svar(10) + svar(20)
+    o5m = tmpdir.join('test.o5m')
+    o5m.write_binary(bytes([0xff]) + dataset(0x10, node_1) + dataset(0x10, node_2) + dataset(0x10, node_3))
+    assert list(O5mReader(str(o5m)).elements()) == [('node', 5, 0.000001, 0.000002, [('amenity', 'bench')]),
+                                                    ('node', 6, 0.000002, 0.000004, [('amenity', 'bench')]),
+                                                    ('node', 7, 0.000003, 0.000006, [])]
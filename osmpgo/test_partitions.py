@@ -0,0 +1,90 @@
+import json
+import os
+import geopandas as gpd
+import pytest
+import pandas as pd
+from shapely.geometry import Point, LineString
+from osmpgo.partitions import quadkey, lonlat_bounds, PartitionLayerWriter, write_manifest
+from osmpgo.writers import layer_writer
+
+
+def lines():
+    # The first line crosses from tile 8,5 into tile 9,5 at zoom 4, its centroid is in 9,5
+    return gpd.GeoDataFrame({'way_id': ['1', '2']},
+                            geometry=[LineString([(20, 42), (30, 42)]), LineString([(1, 1), (2, 2)])], crs=4326)
+
+
+def test_quadkey():
+    assert quadkey(3, 3, 5) == '213' and quadkey(1, 1, 0) == '1'
+    assert lonlat_bounds(1, 1, 0) == (0.0, 0.0, 180.0, 85.0511287798066)
+
+
+def test_partition_by_centroid(tmpdir):
+    writer = PartitionLayerWriter('gpkg', str(tmpdir), 'test_highway', 'highway', 'line', 4)
+    writer.write(lines())
+    writer.close()
+    layer = json.load(open(str(tmpdir.join('test_highway_line.partitions.json'))))
+    partitions = sorted((each['quadkey'], each['path'], each['count']) for each in layer['partitions'])
+    assert partitions == [('1203', os.path.join('1203', 'test_highway.gpkg'), 1),
+                          ('1222', os.path.join('1222', 'test_highway.gpkg'), 1)]
+    gdf = gpd.read_file(str(tmpdir.join('1203', 'test_highway.gpkg')), layer='highway_line')
+    assert gdf.geometry[0].length == 10
+
+
+def test_partition_clip_manifest(tmpdir):
+    for feature in ('line', 'point'):
+        writer = PartitionLayerWriter('geoparquet', str(tmpdir), 'test_highway', 'highway', feature, 4, clip=True)
+        writer.write(lines() if feature == 'line' else gpd.GeoDataFrame({'node_id': ['3']}, geometry=[Point(25, 42)],
+                                                                         crs=4326))
+        writer.close()
+    manifest = json.load(open(write_manifest(str(tmpdir), 'test', 4, True, 'geoparquet')))
+    assert not tmpdir.join('test_highway_line.partitions.json').exists()
+    assert manifest['zoom'] == 4 and manifest['clip']
+    assert [(each['quadkey'], each['count']) for each in manifest['partitions']] == [('1202', 1), ('1203', 2),
+                                                                                    ('1222', 1)]
+    west, east = manifest['partitions'][0], manifest['partitions'][1]
+    assert west['bbox'][2] == east['bbox'][0] == 22.5
+    assert sorted(east['layers']) == ['highway_line', 'highway_point']
+    assert west['layers']['highway_line']['bbox'] == [20.0, 42.0, 22.5, 42.0]
+    gdf = gpd.read_parquet(str(tmpdir.join(east['layers']['highway_line']['path'])))
+    assert list(gdf['way_id']) == ['1'] and gdf.geometry[0].length == 7.5
+
+
+def test_partition_copy_batches(tmpdir):
+    for output_format in ('gpkg', 'geoparquet'):
+        folder = tmpdir.mkdir(output_format)
+        gdf = lines()
+        gdf['lanes'] = pd.array([2, None], 'Int64')
+        part = layer_writer(output_format, str(folder), 'highway_part0', 'highway', 'line')
+        part.write(gdf)
+        part.close()
+        writer = PartitionLayerWriter(output_format, str(folder), 'test_highway', 'highway', 'line', 4)
+        # One feature per batch
+        writer.copy(writer.layer_path(str(folder), 'highway_part0', 'line'), batch_size=1)
+        writer.close()
+        layer = json.load(open(writer.path))
+        assert writer.count == 2 and [each['quadkey'] for each in layer['partitions']] == ['1222', '1203']
+        path = str(folder.join(layer['partitions'][1]['path']))
+        copied = gpd.read_parquet(path) if output_format == 'geoparquet' else gpd.read_file(path, layer='highway_line')
+        assert list(copied['way_id']) == ['1'] and copied['lanes'][0] == 2 and copied.geometry[0].length == 10
+
+
+def test_partition_many_tiles(tmpdir):
+    resource = pytest.importorskip('resource')
+    # Far more tiles than the process may open files
+    points = gpd.GeoDataFrame({'node_id': [str(i) for i in range(600)]},
+                              geometry=[Point(1 + i * 0.03, 42) for i in range(600)], crs=4326)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(soft, len(os.listdir('/proc/self/fd')) + 100), hard))
+    try:
+        writer = PartitionLayerWriter('gpkg', str(tmpdir), 'test_amenity', 'amenity', 'point', 14)
+        for i in range(0, 600, 50):
+            writer.write(points.iloc[i:i + 50])
+        writer.close()
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    layer = json.load(open(str(tmpdir.join('test_amenity_point.partitions.json'))))
+    assert len(layer['partitions']) == 600 and sum(each['count'] for each in layer['partitions']) == 600
+    assert not tmpdir.join(layer['partitions'][0]['quadkey'], 'test_amenity_point.arrows').exists()
+    gdf = gpd.read_file(str(tmpdir.join(layer['partitions'][0]['path'])), layer='amenity_point')
+    assert list(gdf['node_id']) == ['0']
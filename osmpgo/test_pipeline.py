@@ -0,0 +1,109 @@
+import os
+import pickle
+import queue
+import numpy as np
+import pytest
+from osmpgo.export_osmxml import ProcessOSM, ReadOSM, NodeOrderError
+from osmpgo.pipeline import Pipeline
+from osmpgo.relations import WayGeometryStore
+
+
+class FakeReader:
+    tempf = 'test'
+
+
+def test_point_batches_and_end_of_nodes():
+    posm = ProcessOSM(['amenity', 'place'], ['point'], 2, 'test', 'test', 'test', 1)
+    pipeline = Pipeline(FakeReader(), posm, batch_size=2)
+    pipeline.queues = [queue.Queue(), queue.Queue()]
+
+    for i in range(3):
+        pipeline.point('amenity', {'node_id': str(i)})
+    pipeline.point('place', {'node_id': '9'})
+    assert pipeline.queues[0].get_nowait() == ('amenity', [{'node_id': '0'}, {'node_id': '1'}])
+
+    pipeline.nodes_done(5)
+    assert posm.block_count == 5
+    assert pipeline.queues[0].get_nowait() == ('amenity', [{'node_id': '2'}])
+    assert pipeline.queues[1].get_nowait() == ('place', [{'node_id': '9'}])
+    assert pipeline.queues[0].get_nowait() is None
+    assert pipeline.queues[1].get_nowait() is None
+
+
+class FakePipeline:
+    def __init__(self):
+        self.calls = []
+
+    def point(self, theme, values):
+        self.calls.append(('point', theme))
+
+    def nodes_done(self, block_count):
+        self.calls.append(('nodes_done', block_count))
+
+    def way_chunk(self, start, end):
+        self.calls.append(('way_chunk', start, end))
+
+    def ways_done(self, start, end):
+        self.calls.append(('ways_done', start, end))
+
+
+def test_node_after_way(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    xml = tmpdir.join('test.osm')
+    xml.write('<osm>\n'
+              '<node id="1" lat="42.5" lon="1.5"/>\n'
+              '<way id="3">\n<nd ref="1"/>\n<nd ref="2"/>\n<tag k="highway" v="path"/>\n</way>\n'
+              '<node id="2" lat="42.6" lon="1.6"/>\n'
+              '</osm>\n')
+    rosm = ReadOSM(str(xml), ['highway'], ['point', 'line'], 1)
+    pipeline = FakePipeline()
+    with pytest.raises(ValueError, match='Node 2 comes after the first way'):
+        rosm.readxml(pipeline)
+    assert pipeline.calls == [('nodes_done', 1)]
+
+
+def test_collect_members_after_resolve(tmpdir):
+    tempf = str(tmpdir)
+    with open(tmpdir.join('nodeblock_1.pkl'), 'wb') as fp:
+        for node in (['1', 0.0, 0.0], ['2', 1.0, 0.0], ['3', 1.0, 1.0]):
+            pickle.dump(node, fp)
+    with open(tmpdir.join('way.pkl'), 'wb') as fp:
+        for way_id, themes in (('10', ['building']), ('11', ['building', 'historic'])):
+            refs = ['1', '2', '3', '1']
+            pickle.dump({'way_id': way_id, 'ref': refs, 'ref_remaing': refs, 'coords': {}, 'themes': themes,
+                         'attrib': {'building': 'yes'}}, fp)
+    posm = ProcessOSM(['building', 'historic'], ['polygon'], 1, tempf, tempf, 'test', 1)
+    # A pipeline chunk is resolved before the relations are read, no shapes are stored
+    posm.resolve_ways(store_members=False)
+    store = WayGeometryStore(os.path.join(tempf, 'member_geom_0.sqlite'))
+    assert store.get(['10', '11']) == {}
+    store.close()
+
+    np.save(os.path.join(tempf, 'member_ids.npy'), np.array([11], dtype='int64'))
+    assert posm.collect_members(0) == 'Collected 1 relation members from shard 0'
+    store = WayGeometryStore(os.path.join(tempf, 'member_geom_0.sqlite'))
+    assert store.get(['10', '11']) == {'11': [(0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 0.0)]}
+    store.close()
+
+
+class FailingReader:
+    def __init__(self, error):
+        self.error = error
+
+    def readxml(self, pipeline):
+        raise self.error
+
+
+def test_run_ends_consumers_on_failure(tmpdir):
+    tempf = tmpdir.mkdir('tmp')
+    posm = ProcessOSM(['amenity'], ['point'], 1, str(tempf), str(tmpdir), 'test', 1)
+    # An unrelated error is raised, the consumers still get the end of the points
+    pipeline = Pipeline(FailingReader(RuntimeError('broken')), posm)
+    with pytest.raises(RuntimeError):
+        pipeline.run()
+    assert pipeline.points_ended and len(pipeline.consumers) == 1
+    assert not pipeline.consumers[0].is_alive()
+
+    pipeline = Pipeline(FailingReader(NodeOrderError('Node 2 comes after the first way')), posm)
+    pipeline.run()
+    assert not pipeline.consumers[0].is_alive() and not tempf.exists()
@@ -0,0 +1,61 @@
+from osmpgo.relations import WayGeometryStore, stitch_rings, assemble_multipolygon, assemble_route, merge_lines, \
+    is_member
+import numpy as np
+
+
+def test_stitch_rings_reversed_way():
+    lines = [[(0, 0), (1, 0), (1, 1)], [(0, 0), (0, 1), (1, 1)]]
+    rings = stitch_rings(lines)
+    assert len(rings) == 1
+    assert rings[0][0] == rings[0][-1]
+    assert len(rings[0]) == 5
+
+
+def test_stitch_rings_drops_open_ring():
+    assert stitch_rings([[(0, 0), (1, 0), (1, 1)]]) == []
+
+
+def test_assemble_multipolygon_inner_to_smallest_outer():
+    shapes = {'1': [(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)],
+              '2': [(2, 2), (8, 2), (8, 8), (2, 8), (2, 2)],
+              '3': [(3, 3), (7, 3), (7, 7), (3, 7), (3, 3)],
+              '4': [(4, 4), (6, 4), (6, 6), (4, 6), (4, 4)]}
+    members = [('1', 'outer'), ('2', 'inner'), ('3', 'outer'), ('4', 'inner'), ('5', 'outer')]
+    multipolygon = assemble_multipolygon(members, shapes)
+    assert multipolygon.is_valid
+    assert len(multipolygon.geoms) == 2
+    assert multipolygon.area == 100 - 36 + 16 - 4
+
+
+def test_way_geometry_store(tmpdir):
+    store = WayGeometryStore(str(tmpdir.join('member.sqlite')))
+    store.add('42', [(1.5, 42.5), (1.6, 42.6)])
+    assert store.get(['42', '43']) == {'42': [(1.5, 42.5), (1.6, 42.6)]}
+    store.close()
+
+
+def test_is_member():
+    members = np.array([3, 5, 9], dtype='int64')
+    assert is_member(members, '5')
+    assert not is_member(members, '10')
+
+
+def test_merge_lines_grows_both_ends():
+    lines = [[(1, 0), (2, 0)], [(3, 0), (2, 0)], [(0, 0), (1, 0)], [(5, 0), (6, 0)]]
+    parts = merge_lines(lines)
+    assert parts == [[(0, 0), (1, 0), (2, 0), (3, 0)], [(5, 0), (6, 0)]]
+
+
+def test_merge_lines_long_head():
+    # The first way is in the middle, half of the ways are added at the head, some of them reversed
+    lines = [[(i, 0), (i + 1, 0)] if i % 3 else [(i + 1, 0), (i, 0)] for i in range(2000)]
+    parts = merge_lines(lines[1000:] + lines[:1000][::-1])
+    assert parts == [[(i, 0) for i in range(2001)]]
+
+
+def test_assemble_route_skips_platforms():
+    shapes = {'1': [(0, 0), (1, 0)], '2': [(1, 0), (2, 0)], '3': [(5, 5), (5, 6)]}
+    route = assemble_route([('1', ''), ('2', 'forward'), ('3', 'platform'), ('1', '')], shapes)
+    assert route.geom_type == 'MultiLineString'
+    assert len(route.geoms) == 1
+    assert route.length == 2
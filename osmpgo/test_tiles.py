@@ -0,0 +1,192 @@
+import gzip
+import json
+import sqlite3
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely.geometry import Point, Polygon
+from osmpgo.tiles import varint, varint_array, zigzag, encode_geometry, tile_bounds, build_mbtiles, plan_tasks, \
+    TileSource
+from osmpgo.writers import TileLayerWriter
+
+
+def read_varint(buffer, position):
+    value, shift = 0, 0
+    while True:
+        byte = buffer[position]
+        value |= (byte & 0x7f) << shift
+        position += 1
+        shift += 7
+        if byte < 0x80:
+            return value, position
+
+
+def read_fields(buffer):
+    position, fields = 0, []
+    while position < len(buffer):
+        key, position = read_varint(buffer, position)
+        if key & 7 == 0:
+            value, position = read_varint(buffer, position)
+        elif key & 7 == 1:
+            value, position = buffer[position:position + 8], position + 8
+        else:
+            length, position = read_varint(buffer, position)
+            value, position = buffer[position:position + length], position + length
+        fields.append((key >> 3, value))
+    return fields
+
+
+def read_packed(buffer):
+    position, values = 0, []
+    while position < len(buffer):
+        value, position = read_varint(buffer, position)
+        values.append(value)
+    return values
+
+
+def decode_value(buffer):
+    field, value = read_fields(buffer)[0]
+    if field == 3:
+        return struct.unpack('<d', value)[0]
+    if field == 6:
+        return (value >> 1) ^ -(value & 1)
+    return value.decode()
+
+
+def decode_tile(data):
+    layers = {}
+    for number, layer in read_fields(gzip.decompress(data)):
+        fields = read_fields(layer)
+        name = [value for field, value in fields if field == 1][0].decode()
+        keys = [value.decode() for field, value in fields if field == 3]
+        values = [decode_value(value) for field, value in fields if field == 4]
+        features = []
+        for feature in [dict(read_fields(value)) for field, value in fields if field == 2]:
+            tags = read_packed(feature.get(2, b''))
+            features.append({'id': feature.get(1), 'type': feature[3], 'geometry': read_packed(feature[4]),
+                             'tags': {keys[k]: values[v] for k, v in zip(tags[::2], tags[1::2])}})
+        layers[name] = features
+    return layers
+
+
+def test_varints():
+    assert varint(1) == b'\x01' and varint(300) == b'\xac\x02'
+    values = np.arange(0, 2 ** 20, 997)
+    assert varint_array(values)[0] == b''.join(varint(int(value)) for value in values)
+    assert list(zigzag([0, -1, 1, -2])) == [0, 1, 2, 3]
+
+
+def test_encode_polygon_winding():
+    bounds = tile_bounds(0, 0, 0)
+    size = bounds[2] - bounds[0]
+    exterior = [(bounds[0] + size * x, bounds[3] - size * y) for x, y in ((0.25, 0.25), (0.25, 0.75), (0.75, 0.75),
+                                                                          (0.75, 0.25))]
+    hole = [(bounds[0] + size * x, bounds[3] - size * y) for x, y in ((0.4, 0.4), (0.6, 0.4), (0.6, 0.6),
+                                                                      (0.4, 0.6))]
+    encoded, = encode_geometry(np.array([Polygon(exterior, [hole])]), 2, bounds)
+    commands = np.array(read_packed(encoded), dtype=np.int64)
+    # MoveTo, 2 deltas, LineTo 3, 6 deltas, ClosePath for each ring
+    assert len(commands) == 22 and commands[0] == 9 and commands[3] == 26 and commands[10] == 15
+
+    def area(ring):
+        x, y = ring[:, 0], ring[:, 1]
+        return np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y)
+
+    cursor = np.zeros(2)
+    rings = []
+    for start in (0, 11):
+        deltas = np.r_[commands[start + 1:start + 3], commands[start + 4:start + 10]]
+        deltas = ((deltas >> 1) ^ -(deltas & 1)).reshape(-1, 2).astype(np.int64)
+        ring = cursor + np.cumsum(deltas, axis=0)
+        cursor = ring[-1]
+        rings.append(ring)
+    assert area(rings[0]) > 0 > area(rings[1])
+    assert rings[0].min() == 1024 and rings[0].max() == 3072
+
+
+def test_encode_points_dedupe():
+    bounds = tile_bounds(10, 500, 300)
+    unit = (bounds[2] - bounds[0]) / 4096
+    points = np.array([Point(bounds[0] + 100 * unit, bounds[3] - 100 * unit),
+                       Point(bounds[0] + 100.2 * unit, bounds[3] - 100.2 * unit)])
+    # Below the max zoom the second point is on the tile unit of the first, at the max zoom both are kept
+    assert [each is None for each in encode_geometry(points, 0, bounds)] == [False, True]
+    kept = encode_geometry(points, 0, bounds, dedupe=False)
+    assert kept[0] is not None and kept[1] is not None
+
+
+def test_plan_low_zooms():
+    tasks = plan_tasks([1.4, 42.4, 1.8, 42.7], 0, 13, 4)
+    # Zooms below the split zoom get one task per zoom and block, the blocks of the split zoom go on to zoom 13
+    assert tasks[:2] == [(list(range(9, 14)), (257, 188, 257, 189)), (list(range(9, 14)), (258, 188, 258, 189))]
+    # Tiles next to the extent are included for their buffer, at zoom 1 the one west of the meridian
+    assert [zooms[0] for zooms, block in tasks[2:]] == [0, 1, 1, 2, 2, 3, 4, 5, 6, 7, 8, 8]
+    assert tasks[3:5] == [([1], (0, 0, 0, 0)), ([1], (1, 0, 1, 0))]
+
+
+def test_generalized_source(tmpdir):
+    writer = TileLayerWriter(str(tmpdir), 'test_amenity', 'amenity', 'point')
+    writer.write(gpd.GeoDataFrame({'node_id': ['1', '2', '3']},
+                                  geometry=[Point(2.1, 42.1), Point(2.1001, 42.1001), Point(3.0, 43.0)], crs=4326))
+    writer.close()
+    writer = TileLayerWriter(str(tmpdir), 'test_landuse', 'landuse', 'polygon')
+    writer.write(gpd.GeoDataFrame({'way_id': ['4', '5']},
+                                  geometry=[shapely.box(1.0, 41.0, 3.0, 43.0), shapely.box(2.0, 42.0, 2.001, 42.001)],
+                                  crs=4326))
+    writer.close()
+    bbox = (-180, -85, 180, 85)
+    points = str(tmpdir.join('test_amenity_point.tiles.parquet'))
+    polygons = str(tmpdir.join('test_landuse_polygon.tiles.parquet'))
+    assert len(TileSource('amenity_point', points, bbox).geometry) == 3
+    assert len(TileSource('landuse_polygon', polygons, bbox).geometry) == 2
+    # At zoom 2 the first two points share a tile unit and the small square is under a unit
+    source = TileSource('amenity_point', points, bbox, zoom=2, batch_size=2)
+    assert [tags['node_id'] for tags in source.properties] == ['1', '3'] and source.ids == [1, 3]
+    source = TileSource('landuse_polygon', polygons, bbox, zoom=2)
+    selected, geometry = source.zoom(2)
+    assert source.ids == [4] and list(selected) == [0] and list(source.dimension) == [2]
+
+
+def test_build_mbtiles(tmpdir):
+    writer = TileLayerWriter(str(tmpdir), 'test_amenity', 'amenity', 'point')
+    writer.write(gpd.GeoDataFrame({'node_id': ['1', '2'], 'name': ['a', ''],
+                                   'capacity': pd.array([-3, None], 'Int64'), 'ele': pd.array([None, 1.5], 'Float64')},
+                                  geometry=[Point(2.1, 42.1), Point(2.2, 42.2)], crs=4326))
+    writer.close()
+    writer = TileLayerWriter(str(tmpdir), 'test_landuse', 'landuse', 'polygon')
+    writer.write(gpd.GeoDataFrame({'way_id': ['5'], 'relation_id': ['']},
+                                  geometry=[shapely.box(1.0, 41.0, 3.0, 43.0)], crs=4326))
+    writer.close()
+
+    path = str(tmpdir.join('test.mbtiles'))
+    layers = [('amenity_point', str(tmpdir.join('test_amenity_point.tiles.parquet'))),
+              ('landuse_polygon', str(tmpdir.join('test_landuse_polygon.tiles.parquet'))),
+              ('place_point', str(tmpdir.join('test_place_point.tiles.parquet')))]
+    with ThreadPoolExecutor(2) as executor:
+        build_mbtiles(layers, path, executor, 2, max_zoom=10)
+
+    con = sqlite3.connect(path)
+    metadata = dict(con.execute('SELECT name, value FROM metadata'))
+    assert metadata['format'] == 'pbf' and metadata['maxzoom'] == '10'
+    vector_layers = json.loads(metadata['json'])['vector_layers']
+    assert [layer['id'] for layer in vector_layers] == ['amenity_point', 'landuse_polygon']
+    assert vector_layers[0]['fields'] == {'node_id': 'String', 'name': 'String', 'capacity': 'Number',
+                                          'ele': 'Number'}
+    tile, = con.execute('SELECT tile_data FROM tiles WHERE zoom_level = 0').fetchone()
+    layers = decode_tile(tile)
+    assert [feature['id'] for feature in layers['amenity_point']] == [1, 2]
+    assert layers['amenity_point'][0]['tags'] == {'node_id': '1', 'name': 'a', 'capacity': -3}
+    assert layers['amenity_point'][1]['tags'] == {'node_id': '2', 'ele': 1.5}
+    assert layers['landuse_polygon'][0]['type'] == 3
+
+    # The landuse square covers 7 by 8 tiles at zoom 10. The inner tiles share one image and so do the tiles along
+    # each edge, only the 4 corners and the 2 tiles with points differ.
+    tiles, images = con.execute('SELECT count(*), count(DISTINCT tile_id) FROM map WHERE zoom_level = 10').fetchone()
+    assert (tiles, images) == (56, 1 + 4 + 4 + 2)
+    # TMS rows count from the south
+    row, = con.execute('SELECT min(tile_row) FROM map WHERE zoom_level = 10').fetchone()
+    assert row == 2 ** 10 - 1 - 383
+    con.close()
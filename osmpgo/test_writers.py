@@ -0,0 +1,278 @@
+import json
+import queue
+import sqlite3
+import geopandas as gpd
+import pyarrow.parquet as pq
+import pyogrio
+import numpy as np
+import shapely
+from shapely.geometry import Point, LineString, Polygon
+from osmpgo.util import combine_gpkg, combine_fgb
+from osmpgo.writers import layer_writer, LayerBuilder, QueueLayerWriter, write_output, reduce_geometry
+
+
+def points(start, count):
+    return gpd.GeoDataFrame({'node_id': [str(i) for i in range(start, start + count)]},
+                            geometry=[Point(i, i / 2) for i in range(start, start + count)], crs=4326)
+
+
+def test_parquet_writer_row_groups(tmpdir):
+    writer = layer_writer('geoparquet', str(tmpdir), 'test_amenity', 'amenity', 'point')
+    writer.row_group_size = 4
+    writer.write(points(0, 3))
+    writer.write(points(3, 7))
+    writer.close()
+
+    assert writer.path == str(tmpdir.join('test_amenity_point.parquet'))
+    parquet = pq.ParquetFile(writer.path)
+    assert [parquet.metadata.row_group(i).num_rows for i in range(parquet.metadata.num_row_groups)] == [4, 4, 2]
+    geo = json.loads(parquet.metadata.metadata[b'geo'])
+    assert geo['columns']['geometry']['bbox'] == [0, 0, 9, 4.5]
+    assert geo['columns']['geometry']['geometry_types'] == ['Point']
+
+    gdf = gpd.read_parquet(writer.path, bbox=(2.5, 0, 5.5, 5))
+    assert list(gdf['node_id']) == ['3', '4', '5']
+
+
+def test_parquet_writer_copy_parts(tmpdir):
+    for part in range(2):
+        writer = layer_writer('geoparquet', str(tmpdir), f'amenity_part{part}', 'amenity', 'point')
+        writer.write(points(part * 5, 5))
+        writer.close()
+
+    writer = layer_writer('geoparquet', str(tmpdir), 'test_amenity', 'amenity', 'point')
+    for part in range(3):
+        writer.copy(writer.layer_path(str(tmpdir), f'amenity_part{part}', 'point'))
+    writer.close()
+    assert list(gpd.read_parquet(writer.path)['node_id']) == [str(i) for i in range(10)]
+
+
+def test_empty_layer_writes_nothing(tmpdir):
+    writer = layer_writer('gpkg', str(tmpdir), 'test_amenity', 'amenity', 'point')
+    writer.write(points(0, 0))
+    writer.close()
+    assert not tmpdir.join('test_amenity.gpkg').exists()
+
+
+def test_gpkg_writer_packed_rtree(tmpdir):
+    writer = layer_writer('gpkg', str(tmpdir), 'test_amenity', 'amenity', 'point')
+    writer.write(points(0, 120))
+    writer.write(points(120, 80))
+    writer.close()
+
+    con = sqlite3.connect(writer.path)
+    assert con.execute("SELECT rtreecheck('rtree_amenity_point_geom')").fetchone() == ('ok',)
+    assert con.execute('SELECT min_x, min_y, max_x, max_y FROM gpkg_contents').fetchone() == (0, 0, 199, 99.5)
+    con.close()
+    gdf = gpd.read_file(writer.path, layer='amenity_point', bbox=(10.5, 0, 20.5, 100))
+    assert sorted(gdf['node_id'].astype(int)) == list(range(11, 21))
+
+
+def test_gpkg_writer_copy_parts(tmpdir):
+    for part in range(2):
+        writer = layer_writer('gpkg', str(tmpdir), f'amenity_part{part}', 'amenity', 'point')
+        writer.write(points(part * 60, 60))
+        writer.close()
+
+    writer = layer_writer('gpkg', str(tmpdir), 'test_amenity', 'amenity', 'point')
+    for part in range(3):
+        writer.copy(writer.layer_path(str(tmpdir), f'amenity_part{part}', 'point'))
+    writer.close()
+
+    gdf = gpd.read_file(writer.path, layer='amenity_point', fid_as_index=True)
+    assert list(gdf.index) == list(range(1, 121))
+    assert list(gdf['node_id']) == [str(i) for i in range(120)]
+    assert len(gpd.read_file(writer.path, layer='amenity_point', bbox=(70.5, 0, 80.5, 100))) == 10
+
+
+class ChunkWriter:
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, gdf):
+        self.chunks.append(gdf)
+
+    def close(self):
+        self.closed = True
+
+
+def test_layer_builder_flushes_chunks():
+    writer = ChunkWriter()
+    builder = LayerBuilder(writer, ['node_id', 'geometry', 'name'], chunk_size=2)
+    for i in range(5):
+        builder.add({'node_id': str(i), 'geometry': Point(i, i)})
+    assert [len(chunk) for chunk in writer.chunks] == [2, 2]
+    builder.close()
+    assert [len(chunk) for chunk in writer.chunks] == [2, 2, 1]
+    assert writer.closed and builder.count == 5
+    assert list(writer.chunks[2]['name']) == ['']
+    assert writer.chunks[0].crs.to_epsg() == 4326
+
+
+def test_gpkg_builders_share_theme_file(tmpdir):
+    # The line and polygon layers of a theme go to one geopackage and their chunks are written in turns
+    lines = LayerBuilder(layer_writer('gpkg', str(tmpdir), 'test_natural', 'natural', 'line'), ['way_id', 'geometry'],
+                         chunk_size=2)
+    polygons = LayerBuilder(layer_writer('gpkg', str(tmpdir), 'test_natural', 'natural', 'polygon'),
+                            ['way_id', 'geometry'], chunk_size=2)
+    for i in range(5):
+        lines.add({'way_id': str(i), 'geometry': LineString([(i, i), (i + 1, i)])})
+        polygons.add({'way_id': str(i), 'geometry': shapely.box(i, i, i + 1, i + 1)})
+    polygons.close()
+    lines.close()
+    path = str(tmpdir.join('test_natural.gpkg'))
+    assert sorted(pyogrio.list_layers(path)[:, 0]) == ['natural_line', 'natural_polygon']
+    # The spatial index of each layer is complete
+    for layer, found in (('natural_line', ['3']), ('natural_polygon', ['2', '3'])):
+        assert sorted(gpd.read_file(path, layer=layer, bbox=(2.5, 2.5, 3.5, 3.5))['way_id']) == found
+    assert pyogrio.read_info(path, layer='natural_line')['features'] == 5
+
+
+def test_layer_builder_typed_fields(tmpdir):
+    types = {'lanes': 'int', 'maxspeed': 'speed'}
+    for output_format in ('gpkg', 'geoparquet'):
+        writer = layer_writer(output_format, str(tmpdir), f'typed_{output_format}', 'highway', 'line')
+        builder = LayerBuilder(writer, ['way_id', 'geometry', 'lanes', 'maxspeed'], types=types)
+        for i, (lanes, maxspeed) in enumerate((('2', '50'), ('', '30 mph'), ('2;3', 'walk'))):
+            builder.add({'way_id': str(i), 'geometry': Point(i, i), 'lanes': lanes, 'maxspeed': maxspeed})
+        builder.close()
+
+    con = sqlite3.connect(str(tmpdir.join('typed_gpkg.gpkg')))
+    assert {name: kind for _, name, kind, *_ in con.execute('PRAGMA table_info(highway_line)')} == \
+        {'fid': 'INTEGER', 'geom': 'GEOMETRY', 'way_id': 'TEXT', 'lanes': 'INTEGER', 'maxspeed': 'REAL'}
+    assert con.execute('SELECT lanes, round(maxspeed, 2) FROM highway_line ORDER BY fid').fetchall() == \
+        [(2, 50.0), (None, 48.28), (None, None)]
+    con.close()
+    schema = pq.read_schema(str(tmpdir.join('typed_geoparquet_line.parquet')))
+    assert str(schema.field('lanes').type) == 'int64' and str(schema.field('maxspeed').type) == 'double'
+
+
+def test_layer_builder_category_fields(tmpdir):
+    writer = layer_writer('geoparquet', str(tmpdir), 'category', 'highway', 'line')
+    builder = LayerBuilder(writer, ['way_id', 'geometry', 'highway'], chunk_size=200, types={'highway': 'category'})
+    # The second chunk has more than 127 categories, which pandas stores with wider codes
+    for i in range(400):
+        highway = '' if i == 1 else 'road' if i < 200 else f'road{i}'
+        builder.add({'way_id': str(i), 'geometry': Point(i, i), 'highway': highway})
+    assert builder.flds['highway'] == [] and len(builder.interned) == 201 and '' not in builder.interned
+    builder.close()
+
+    table = pq.read_table(str(tmpdir.join('category_line.parquet')))
+    assert str(table.schema.field('highway').type) == 'dictionary<values=string, indices=int32, ordered=0>'
+    gdf = gpd.read_parquet(str(tmpdir.join('category_line.parquet')))
+    assert str(gdf['highway'].dtype) == 'category' and list(gdf['highway'][[0, 399]]) == ['road', 'road399']
+    assert gdf['highway'].isna().sum() == 1 and gdf['highway'].isna()[1]
+
+
+def test_reduce_geometry():
+    zigzag = LineString([(0, 0), (1, 0.001), (2, 0), (3, 0.001), (4, 0)])
+    # A bow tie once its corners are snapped
+    polygon = Polygon([(0, 0), (1, 0.4), (1, -0.4), (0.6, 1), (0, 1)])
+    reduced = reduce_geometry(np.array([zigzag, Point(0.26, 0.74), polygon]), precision=0.5, tolerance=0.01)
+    assert list(shapely.get_coordinates(reduced[0]).ravel()) == [0, 0, 4, 0]
+    assert reduced[1].equals(Point(0.5, 0.5))
+    assert shapely.is_valid(reduced[2]) and shapely.get_coordinates(reduced[2]).max() == 1
+    assert reduce_geometry(np.array([zigzag]))[0] is zigzag
+
+
+def test_layer_builder_drops_collapsed_geometry():
+    writer = ChunkWriter()
+    builder = LayerBuilder(writer, ['way_id', 'geometry'], precision=0.1)
+    builder.add({'way_id': '1', 'geometry': LineString([(0, 0), (0.01, 0.01)])})
+    builder.add({'way_id': '2', 'geometry': LineString([(0, 0), (1.01, 1.01)])})
+    builder.close()
+    assert list(writer.chunks[0]['way_id']) == ['2']
+    assert list(shapely.get_coordinates(writer.chunks[0].geometry.values).ravel()) == [0, 0, 1, 1]
+
+
+def test_write_output_single_geopackage(tmpdir):
+    output = queue.Queue()
+    for theme, start in (('amenity', 0), ('place', 10), ('amenity', 5)):
+        QueueLayerWriter(output, theme, 'point').write(points(start, 5))
+    output.put(None)
+    write_output(output, str(tmpdir.join('test.gpkg')))
+
+    assert sorted(name for name, _ in pyogrio.list_layers(str(tmpdir.join('test.gpkg')))) == \
+        ['amenity_point', 'place_point']
+    gdf = gpd.read_file(str(tmpdir.join('test.gpkg')), layer='amenity_point')
+    assert list(gdf['node_id']) == [str(i) for i in range(10)]
+    assert gdf.crs.to_epsg() == 4326
+
+
+def test_combine_gpkg_appends_layers(tmpdir):
+    for part in range(2):
+        writer = layer_writer('gpkg', str(tmpdir), f'region{part}', 'amenity', 'point')
+        writer.write(points(part * 60, 60))
+        writer.close()
+    # A source written without a spatial index
+    points(200, 5).to_file(str(tmpdir.join('region2.gpkg')), layer='place_point', driver='GPKG',
+                           engine='pyogrio', SPATIAL_INDEX='NO', GEOMETRY_NAME='shape')
+
+    output = str(tmpdir.join('combined.gpkg'))
+    combine_gpkg(str(tmpdir), output, 'region')
+    assert sorted(name for name, _ in pyogrio.list_layers(output)) == ['amenity_point', 'place_point']
+    gdf = gpd.read_file(output, layer='amenity_point')
+    assert list(gdf['node_id']) == [str(i) for i in range(120)]
+    assert len(gpd.read_file(output, layer='place_point', bbox=(201.5, 0, 203.5, 200))) == 2
+
+    con = sqlite3.connect(output)
+    assert con.execute("SELECT rtreecheck('rtree_place_point_shape')").fetchone() == ('ok',)
+    con.close()
+
+
+def test_combine_gpkg_regions_dedupe(tmpdir):
+    for region, start in (('france', 0), ('germany', 40)):
+        tmpdir.mkdir(region)
+        writer = layer_writer('gpkg', str(tmpdir.join(region)), region, 'amenity', 'point')
+        writer.write(points(start, 60))
+        writer.close()
+        ways = gpd.GeoDataFrame({'way_id': [str(start), str(start + 1), ''], 'relation_id': ['', '', '7']},
+                                geometry=[Point(start, 0), Point(start + 1, 0), Point(0, 0)], crs=4326)
+        writer = layer_writer('gpkg', str(tmpdir.join(region)), region, 'route', 'line')
+        writer.write(ways)
+        writer.close()
+
+    output = str(tmpdir.join('europe.gpkg'))
+    combine_gpkg([str(tmpdir.join('france')), str(tmpdir.join('germany'))], output, ['france', 'germany'])
+    gdf = gpd.read_file(output, layer='amenity_point')
+    assert list(gdf['node_id']) == [str(i) for i in range(100)]
+    assert len(gpd.read_file(output, layer='amenity_point', bbox=(89.5, 0, 99.5, 100))) == 10
+    gdf = gpd.read_file(output, layer='route_line')
+    assert list(zip(gdf['way_id'], gdf['relation_id'])) == [('0', ''), ('1', ''), ('', '7'), ('40', ''), ('41', '')]
+
+    output = str(tmpdir.join('appended.gpkg'))
+    combine_gpkg([str(tmpdir.join('france')), str(tmpdir.join('germany'))], output, ['france', 'germany'], False)
+    assert len(gpd.read_file(output, layer='amenity_point')) == 120
+
+
+def test_fgb_writer_copy_parts(tmpdir):
+    for part in range(2):
+        writer = layer_writer('fgb', str(tmpdir), f'amenity_part{part}', 'amenity', 'point')
+        writer.write(points(part * 60, 30))
+        writer.write(points(part * 60 + 30, 30))
+        writer.close()
+
+    writer = layer_writer('fgb', str(tmpdir), 'test_amenity', 'amenity', 'point')
+    for part in range(3):
+        writer.copy(writer.layer_path(str(tmpdir), f'amenity_part{part}', 'point'))
+    writer.close()
+
+    assert writer.path == str(tmpdir.join('test_amenity_point.fgb'))
+    assert not tmpdir.join('test_amenity_point.fgb.arrows').exists()
+    info = pyogrio.read_info(writer.path)
+    assert (info['layer_name'], info['geometry_type'], info['features']) == ('amenity_point', 'Point', 120)
+    gdf = gpd.read_file(writer.path, bbox=(70.5, 0, 80.5, 100))
+    assert sorted(gdf['node_id'].astype(int)) == list(range(71, 81))
+    assert gdf.crs.to_epsg() == 4326
+
+
+def test_combine_fgb_regions_dedupe(tmpdir):
+    for region, start in (('france', 0), ('germany', 40)):
+        writer = layer_writer('fgb', str(tmpdir), f'{region}_amenity', 'amenity', 'point')
+        writer.write(points(start, 60))
+        writer.close()
+
+    combine_fgb(str(tmpdir), str(tmpdir.join('europe')), ['france', 'germany'])
+    gdf = gpd.read_file(str(tmpdir.join('europe', 'amenity_point.fgb')))
+    assert sorted(gdf['node_id'].astype(int)) == list(range(100))
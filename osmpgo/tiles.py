@@ -0,0 +1,579 @@
+import gzip
+import hashlib
+import itertools
+import json
+import math
+import os
+import sqlite3
+import struct
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import shapely
+from concurrent.futures import Executor, as_completed
+from typing import Any
+from osmpgo.writers import NULLABLE_TYPES
+
+EXTENT = 4096  # Tile units per tile side
+BUFFER = 64  # Tile units drawn around each tile so lines and polygons join at the tile edges
+ORIGIN = math.pi * 6378137  # Half the width of the Web Mercator plane in meters
+MAX_LATITUDE = 85.0511287798066
+
+MOVE_TO, LINE_TO, CLOSE_PATH = 1, 2, 7
+# Field keys of the MVT feature message and of its place in the layer message, with the geometry type of each
+# dimension as point, linestring and polygon
+FEATURE_ID, FEATURE_TAGS, FEATURE_GEOMETRY, LAYER_FEATURE = b'\x08', b'\x12', b'\x22', b'\x12'
+FEATURE_TYPES = {0: b'\x18\x01', 1: b'\x18\x02', 2: b'\x18\x03'}
+ID_FIELDS = ('node_id', 'way_id')
+# Varints of the small integers, which most lengths and tag indices are
+SMALL_VARINT = 1 << 14
+VARINTS = [bytes([value]) if value < 0x80 else bytes([value & 0x7f | 0x80, value >> 7])
+           for value in range(SMALL_VARINT)]
+
+MBTILES_SCHEMA = [
+    'CREATE TABLE metadata (name TEXT, value TEXT)',
+    'CREATE UNIQUE INDEX name ON metadata (name)',
+    'CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT)',
+    'CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, tile_row)',
+    'CREATE TABLE images (tile_data BLOB, tile_id TEXT)',
+    'CREATE UNIQUE INDEX images_id ON images (tile_id)',
+    'CREATE VIEW tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, '
+    'map.tile_row AS tile_row, images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id',
+]
+
+
+def varint(value: int) -> bytes:
+    """
+    Protobuf varint encoding of an unsigned integer
+    """
+    if value < SMALL_VARINT:
+        return VARINTS[value]
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append(value & 0x7f | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def varint_array(values: Any) -> tuple:
+    """
+    Protobuf varint encoding of an array of unsigned integers with numpy
+    Args:
+        values: Unsigned integers
+
+    Returns:
+        The return value is the encoded bytes and the number of bytes of each value
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    groups = np.empty((len(values), 10), dtype=np.uint8)
+    length = np.ones(len(values), dtype=np.int64)
+    for i in range(10):
+        groups[:, i] = values & np.uint64(0x7f)
+        values = values >> np.uint64(7)
+        more = values > 0
+        groups[more, i] |= 0x80
+        length += more
+        if not more.any():
+            break
+    return groups[np.arange(10) < length[:, None]].tobytes(), length
+
+
+def split_varints(arrays: list) -> list:
+    """
+    Protobuf varint encodings of many arrays of unsigned integers, encoded together in one numpy pass
+    """
+    counts = np.fromiter((len(each) for each in arrays), dtype=np.int64, count=len(arrays))
+    values = np.fromiter(itertools.chain.from_iterable(arrays), dtype=np.uint64, count=int(counts.sum()))
+    encoded, length = varint_array(values)
+    offsets = np.r_[0, np.cumsum(length)][np.r_[0, np.cumsum(counts)]].tolist()
+    return [encoded[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def zigzag(values: np.ndarray) -> np.ndarray:
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def key(number: int, wire_type: int) -> bytes:
+    return varint(number << 3 | wire_type)
+
+
+def message(number: int, payload: bytes) -> bytes:
+    """
+    Length delimited protobuf field
+    """
+    return key(number, 2) + varint(len(payload)) + payload
+
+
+def to_mercator(coords: np.ndarray) -> np.ndarray:
+    lon = coords[:, 0]
+    lat = np.clip(coords[:, 1], -MAX_LATITUDE, MAX_LATITUDE)
+    return np.column_stack([lon * ORIGIN / 180, np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * ORIGIN / np.pi])
+
+
+def tile_size(zoom: int) -> float:
+    return 2 * ORIGIN / 2 ** zoom
+
+
+def tile_bounds(zoom: int, x: int, y: int) -> tuple:
+    """
+    Web Mercator bounds of an XYZ tile
+    """
+    size = tile_size(zoom)
+    return -ORIGIN + x * size, ORIGIN - (y + 1) * size, -ORIGIN + (x + 1) * size, ORIGIN - y * size
+
+
+def tile_range(bounds: np.ndarray, zoom: int) -> np.ndarray:
+    """
+    Columns and rows of the tiles under Web Mercator bounds as minx, miny, maxx, maxy rows of tile indices
+    """
+    size = tile_size(zoom)
+    tiles = np.column_stack([(bounds[:, 0] + ORIGIN) / size, (ORIGIN - bounds[:, 3]) / size,
+                             (bounds[:, 2] + ORIGIN) / size, (ORIGIN - bounds[:, 1]) / size])
+    return np.clip(np.floor(tiles), 0, 2 ** zoom - 1).astype(np.int64)
+
+
+def to_lonlat(x: float, y: float) -> tuple:
+    return x * 180 / ORIGIN, math.degrees(math.atan(math.sinh(y * math.pi / ORIGIN)))
+
+
+def encode_geometry(geometry: np.ndarray, dimension: int, bounds: tuple, dedupe: bool = True) -> list:
+    """
+    Encoded MVT geometry commands of clipped geometries of one dimension. Coordinates are quantized to the tile grid,
+    repeated vertices are dropped together with the lines and rings they make degenerate, and polygon rings are
+    wound exterior positive and interior negative in tile coordinates.
+    Args:
+        geometry: Clipped geometries in Web Mercator
+        dimension: 0 for points, 1 for lines and 2 for polygons
+        bounds: Web Mercator bounds of the tile
+        dedupe: Drop the points on the same tile unit as an earlier point, only below the max zoom
+
+    Returns:
+        The return value is a list of varint encoded command streams, None for the geometries that vanish in the tile
+    """
+    scale = EXTENT / (bounds[2] - bounds[0])
+    parts, index = shapely.get_parts(geometry, return_index=True)
+    keep = shapely.get_dimensions(parts) == dimension
+    parts, index = parts[keep], index[keep]
+    commands = [None] * len(geometry)
+    if len(parts) == 0:
+        return commands
+
+    if dimension == 2:
+        rings, ring_index = shapely.get_rings(parts, return_index=True)
+        exterior = np.r_[True, ring_index[1:] != ring_index[:-1]]
+        ring_feature = index[ring_index]
+    else:
+        rings, ring_feature, exterior = parts, index, np.ones(len(parts), dtype=bool)
+
+    coords, vertex_ring = shapely.get_coordinates(rings, return_index=True)
+    coords = np.rint(np.column_stack([(coords[:, 0] - bounds[0]) * scale,
+                                      (bounds[3] - coords[:, 1]) * scale])).astype(np.int64)
+    ring_start = np.r_[True, vertex_ring[1:] != vertex_ring[:-1]]
+    keep = ring_start | np.any(coords != np.roll(coords, 1, axis=0), axis=1)
+    if dimension == 2:
+        # MVT closes rings with ClosePath, so vertices that fall back on the first one are dropped
+        first = coords[np.flatnonzero(ring_start)[np.cumsum(ring_start) - 1]]
+        keep &= ring_start | np.any(coords != first, axis=1)
+    if dimension == 0 and dedupe:
+        # Points that fall on the same tile unit as an earlier point of the layer add nothing at this zoom
+        keep &= np.isin(np.arange(len(coords)), np.unique(coords, axis=0, return_index=True)[1])
+    coords, vertex_ring = coords[keep], vertex_ring[keep]
+
+    count = np.bincount(vertex_ring, minlength=len(rings))
+    start = np.r_[0, np.cumsum(count)[:-1]]
+    minimum = {0: 1, 1: 2, 2: 3}[dimension]
+    valid = count >= minimum
+    if dimension == 2:
+        nxt = np.roll(coords, -1, axis=0)
+        nxt[start[valid] + count[valid] - 1] = coords[start[valid]]
+        cross = coords[:, 0] * nxt[:, 1] - nxt[:, 0] * coords[:, 1]
+        area = np.bincount(vertex_ring, weights=cross, minlength=len(rings))
+        valid &= area != 0
+        # Holes of a dropped exterior go with it
+        polygon = np.cumsum(exterior) - 1
+        valid &= np.bincount(polygon, weights=exterior & valid, minlength=polygon.max() + 1)[polygon] > 0
+        reverse = valid & ((area > 0) != exterior)
+        for ring in np.flatnonzero(reverse):
+            coords[start[ring]:start[ring] + count[ring]] = coords[start[ring]:start[ring] + count[ring]][::-1]
+
+    # Lay out the command stream of every kept ring in one array, the cursor starts at 0, 0 for each feature
+    rings = np.flatnonzero(valid)
+    if len(rings) == 0:
+        return commands
+    n = count[rings]
+    feature = ring_feature[rings]
+    ring_first = np.cumsum(n) - n
+    local = np.arange(n.sum()) - np.repeat(ring_first, n)
+    vertices = coords[np.repeat(start[rings], n) + local]
+    new_feature = np.r_[True, feature[1:] != feature[:-1]]
+    previous = np.roll(vertices, 1, axis=0)
+    previous[(local == 0) & np.repeat(new_feature, n)] = 0
+    deltas = zigzag(vertices - previous)
+
+    if dimension == 0:
+        # One MoveTo with the count of the points of the feature, every point part is a single vertex
+        group = np.cumsum(new_feature) - 1
+        points = np.bincount(group)
+        size = 1 + 2 * points
+        offset = np.cumsum(size) - size
+        stream = np.zeros(size.sum(), dtype=np.uint64)
+        stream[offset] = (points << 3 | MOVE_TO).astype(np.uint64)
+        position = offset[group] + 1 + 2 * (np.arange(len(rings)) - (np.cumsum(points) - points)[group])
+        feature_offset = offset
+    else:
+        # MoveTo, LineTo n - 1 and for polygons ClosePath for every ring
+        size = 2 * n + 2 + (dimension == 2)
+        offset = np.cumsum(size) - size
+        stream = np.zeros(size.sum(), dtype=np.uint64)
+        stream[offset] = 1 << 3 | MOVE_TO
+        stream[offset + 3] = ((n - 1) << 3 | LINE_TO).astype(np.uint64)
+        if dimension == 2:
+            stream[offset + size - 1] = 1 << 3 | CLOSE_PATH
+        position = np.repeat(offset, n) + np.where(local == 0, 1, 2 + 2 * local)
+        feature_offset = offset[new_feature]
+    stream[position] = deltas[:, 0]
+    stream[position + 1] = deltas[:, 1]
+
+    encoded, length = varint_array(stream)
+    byte_offset = np.r_[0, np.cumsum(length)]
+    edges = byte_offset[np.r_[feature_offset, len(stream)]].tolist()
+    for each, begin, end in zip(feature[new_feature].tolist(), edges[:-1], edges[1:]):
+        commands[each] = encoded[begin:end]
+    return commands
+
+
+def encode_layer(name: str, commands: list, dimensions: np.ndarray, properties: list, ids: list) -> bytes:
+    """
+    MVT layer message of the encoded features of a tile, see encode_geometry
+    """
+    present = [i for i, geometry in enumerate(commands) if geometry is not None]
+    if len(present) == 0:
+        return b''
+    keys, values = {}, {}
+    tags = []
+    for i in present:
+        tag_index = []
+        for field, value in properties[i].items():
+            # 1 and 1.0 are different MVT values
+            tag_index += [keys.setdefault(field, len(keys)), values.setdefault((type(value), value), len(values))]
+        tags.append(tag_index)
+
+    features = []
+    for i, tag_index in zip(present, split_varints(tags)):
+        feature = FEATURE_ID + varint(ids[i]) if ids[i] else b''
+        if tag_index:
+            feature += FEATURE_TAGS + varint(len(tag_index)) + tag_index
+        feature += FEATURE_TYPES[dimensions[i]] + FEATURE_GEOMETRY + varint(len(commands[i])) + commands[i]
+        features.append(LAYER_FEATURE + varint(len(feature)) + feature)
+    layer = key(15, 0) + varint(2) + message(1, name.encode())
+    layer += b''.join(features)
+    layer += b''.join(message(3, field.encode()) for field in keys)
+    layer += b''.join(message(4, encode_value(value)) for _, value in values)
+    layer += key(5, 0) + varint(EXTENT)
+    return message(3, layer)
+
+
+def encode_value(value: Any) -> bytes:
+    """
+    MVT value message, integers are sint_value, floats double_value and everything else string_value
+    """
+    if isinstance(value, int):
+        return key(6, 0) + varint(value << 1 ^ value >> 63)
+    if isinstance(value, float):
+        return key(3, 1) + struct.pack('<d', value)
+    return message(1, str(value).encode())
+
+
+class TileSource:
+    """
+    Features of a staged layer in Web Mercator with their MVT attributes, read for the tiles of one task. A task of a
+    zoom below the max zoom reads the layer in batches and generalizes it for that zoom on the way, so its memory
+    follows the number of tile units rather than the size of the layer, see generalize
+    """
+
+    def __init__(self, name: str, path: str, bbox: tuple, zoom: int = None, batch_size: int = 65536):
+        self.name = name
+        self.generalized = zoom
+        minx, miny, maxx, maxy = bbox
+        bbox_filter = (ds.field('bbox', 'xmin') <= maxx) & (ds.field('bbox', 'xmax') >= minx) & \
+                      (ds.field('bbox', 'ymin') <= maxy) & (ds.field('bbox', 'ymax') >= miny)
+        geometries, dimensions, self.properties = [], [], []
+        occupied = np.empty(0, dtype=np.int64)
+        for batch in ds.dataset(path, format='parquet').to_batches(filter=bbox_filter, batch_size=batch_size):
+            if batch.num_rows == 0:
+                continue
+            geometry = shapely.transform(shapely.from_wkb(batch['geometry'].to_numpy(zero_copy_only=False)),
+                                         to_mercator)
+            frame = pa.Table.from_batches([batch]).drop_columns(['geometry', 'bbox']).to_pandas(
+                types_mapper=NULLABLE_TYPES.get)
+            if zoom is not None:
+                keep, occupied = generalize(geometry, zoom, occupied)
+                geometry = shapely.simplify(geometry[keep], tile_size(zoom) / EXTENT, preserve_topology=False)
+                frame = frame[keep]
+                present = ~shapely.is_empty(geometry)
+                geometry, frame = geometry[present], frame[present]
+            geometries.append(geometry)
+            dimensions.append(shapely.get_dimensions(geometry))
+            self.properties += feature_properties(frame)
+        self.geometry = np.concatenate(geometries) if geometries else np.empty(0, dtype=object)
+        self.dimension = np.concatenate(dimensions) if dimensions else np.empty(0, dtype=np.int64)
+        self.ids = [next((int(tags[field]) for field in ID_FIELDS if tags.get(field, '').isdigit()), 0)
+                    for tags in self.properties]
+
+    def zoom(self, zoom: int) -> tuple:
+        """
+        Geometries simplified to the tile unit of the zoom, lines and polygons smaller than a unit are left out
+        """
+        if zoom == self.generalized:
+            return np.arange(len(self.geometry)), self.geometry
+        unit = tile_size(zoom) / EXTENT
+        bounds = shapely.bounds(self.geometry)
+        visible = (self.dimension == 0) | (np.maximum(bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1]) >= unit)
+        selected = np.flatnonzero(visible)
+        geometry = shapely.simplify(self.geometry[selected], unit, preserve_topology=False)
+        present = ~shapely.is_empty(geometry)
+        return selected[present], geometry[present]
+
+
+def feature_properties(frame: pd.DataFrame) -> list:
+    """
+    MVT attributes of every feature, the fields that are set
+    """
+    fields = list(frame.columns)
+    columns = [frame[field].to_numpy(dtype=object, na_value='').tolist() if pd.api.types.is_numeric_dtype(frame[field])
+               else frame[field].fillna('').astype(str).tolist() for field in fields]
+    return [{field: value for field, value in zip(fields, row) if value != ''} for row in zip(*columns)]
+
+
+def generalize(geometry: np.ndarray, zoom: int, occupied: np.ndarray) -> tuple:
+    """
+    Features of a batch that show at a zoom below the max zoom. Lines and polygons smaller than a tile unit are left
+    out like TileSource.zoom does, and so is a point on the same tile unit as an earlier point like encode_geometry
+    does. Tile units line up with the tile grid, so the global unit of a point is its unit in any tile.
+    Args:
+        geometry: Geometries of the batch in Web Mercator
+        zoom: Zoom level
+        occupied: Sorted keys of the tile units of the points kept from the earlier batches
+
+    Returns:
+        The return value is a tuple of the mask of the kept features and the updated occupied keys
+    """
+    unit = tile_size(zoom) / EXTENT
+    bounds = shapely.bounds(geometry)
+    dimension = shapely.get_dimensions(geometry)
+    keep = (dimension > 0) & (np.maximum(bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1]) >= unit)
+    # Multipoints are deduped by encode_geometry
+    keep |= (dimension == 0) & (shapely.get_type_id(geometry) != 0)
+    points = np.flatnonzero((shapely.get_type_id(geometry) == 0) & ~shapely.is_empty(geometry))
+    if len(points) > 0:
+        column = np.rint((bounds[points, 0] + ORIGIN) / unit).astype(np.int64)
+        row = np.rint((ORIGIN - bounds[points, 1]) / unit).astype(np.int64)
+        keys = column << 32 | row
+        keys, first = np.unique(keys, return_index=True)
+        new = ~np.isin(keys, occupied, assume_unique=True)
+        keep[points[first[new]]] = True
+        occupied = np.union1d(occupied, keys[new])
+    return keep, occupied
+
+
+def covered_tiles(geometry: Any, tiles: np.ndarray, zoom: int, margin: float) -> list:
+    """
+    Tiles of a range whose buffered bounds intersect the geometry, a long route only touches a few of the tiles
+    under its bounds
+    """
+    x, y = np.meshgrid(np.arange(tiles[0], tiles[2] + 1), np.arange(tiles[1], tiles[3] + 1))
+    x, y = x.ravel(), y.ravel()
+    size = tile_size(zoom)
+    boxes = shapely.box(-ORIGIN + x * size - margin, ORIGIN - (y + 1) * size - margin,
+                        -ORIGIN + (x + 1) * size + margin, ORIGIN - y * size + margin)
+    shapely.prepare(geometry)
+    hit = shapely.intersects(geometry, boxes)
+    return list(zip(x[hit].tolist(), y[hit].tolist()))
+
+
+def tile_task(layers: list, zooms: list, block: tuple, max_zoom: int = None) -> list:
+    """
+    Encode the tiles of a block of tiles and of its child tiles, this is the unit of work of a process pool worker
+    Args:
+        layers: List of (layer name, staged GeoParquet path)
+        zooms: Zoom levels to build, the block is given at the first one
+        block: First column, first row, last column and last row of the block at the first zoom
+        max_zoom: Last zoom level of the pyramid, the last of the zooms if None
+
+    Returns:
+        The return value is a list of (zoom, column, row, gzip compressed tile)
+    """
+    first = zooms[0]
+    max_zoom = zooms[-1] if max_zoom is None else max_zoom
+    pad = BUFFER / EXTENT * tile_size(first)
+    west, south, _, _ = tile_bounds(first, block[0], block[3])
+    _, _, east, north = tile_bounds(first, block[2], block[1])
+    bbox = to_lonlat(west - pad, south - pad) + to_lonlat(east + pad, north + pad)
+    # A task below the max zoom builds a single zoom and reads the layers generalized for it
+    generalized = zooms[-1] if zooms[-1] < max_zoom else None
+    sources = [TileSource(name, path, bbox, zoom=generalized) for name, path in layers]
+    sources = [source for source in sources if len(source.geometry) > 0]
+
+    tiles = []
+    for zoom in zooms:
+        factor = 2 ** (zoom - first)
+        low = np.array(block[:2]) * factor
+        high = (np.array(block[2:]) + 1) * factor - 1
+        margin = BUFFER / EXTENT * tile_size(zoom)
+        layered = []
+        wanted = set()
+        for source in sources:
+            selected, geometry = source.zoom(zoom)
+            bounds = shapely.bounds(geometry) + [-margin, -margin, margin, margin]
+            ranges = tile_range(bounds, zoom)
+            ranges[:, :2] = np.maximum(ranges[:, :2], low)
+            ranges[:, 2:] = np.minimum(ranges[:, 2:], high)
+            inside = (ranges[:, 0] <= ranges[:, 2]) & (ranges[:, 1] <= ranges[:, 3])
+            single = inside & (ranges[:, 0] == ranges[:, 2]) & (ranges[:, 1] == ranges[:, 3])
+            wanted.update(zip(ranges[single, 0].tolist(), ranges[single, 1].tolist()))
+            for i in np.flatnonzero(inside & ~single):
+                wanted.update(covered_tiles(geometry[i], ranges[i], zoom, margin))
+            layered.append((source, selected, geometry, shapely.STRtree(geometry)))
+
+        for x, y in sorted(wanted):
+            bounds = tile_bounds(zoom, x, y)
+            clip = (bounds[0] - margin, bounds[1] - margin, bounds[2] + margin, bounds[3] + margin)
+            data = b''
+            for source, selected, geometry, tree in layered:
+                hits = np.sort(tree.query(shapely.box(*clip)))
+                if len(hits) == 0:
+                    continue
+                clipped = shapely.clip_by_rect(geometry[hits], *clip)
+                features = selected[hits]
+                dimensions = source.dimension[features]
+                commands = [None] * len(hits)
+                for dimension in np.unique(dimensions):
+                    of_dimension = np.flatnonzero(dimensions == dimension)
+                    for i, each in zip(of_dimension, encode_geometry(clipped[of_dimension], dimension, bounds,
+                                                                     dedupe=zoom < max_zoom)):
+                        commands[i] = each
+                data += encode_layer(source.name, commands, dimensions, [source.properties[i] for i in features],
+                                     [source.ids[i] for i in features])
+            if data:
+                tiles.append((zoom, x, y, gzip.compress(data, compresslevel=6, mtime=0)))
+    return tiles
+
+
+def split_blocks(tiles: tuple, blocks: int) -> list:
+    """
+    Cut a range of tiles along its longer side into at most the given number of blocks
+    """
+    x0, y0, x1, y1 = (int(each) for each in tiles)
+    if x1 - x0 >= y1 - y0:
+        edges = np.linspace(x0, x1 + 1, min(blocks, x1 - x0 + 1) + 1).astype(int)
+        return [(int(low), y0, int(high) - 1, y1) for low, high in zip(edges[:-1], edges[1:])]
+    edges = np.linspace(y0, y1 + 1, min(blocks, y1 - y0 + 1) + 1).astype(int)
+    return [(x0, int(low), x1, int(high) - 1) for low, high in zip(edges[:-1], edges[1:])]
+
+
+def plan_tasks(bounds: list, min_zoom: int, max_zoom: int, blocks: int) -> list:
+    """
+    Split the tile pyramid into blocks of tiles. At the split zoom the data extent covers at least the given number
+    of tiles and is cut into blocks along its longer side, every block task builds the child tiles of its own block at
+    the higher zooms. Every zoom below the split zoom is cut into blocks of its own tiles, one zoom per task, those
+    tasks read the layers generalized for their zoom.
+    Args:
+        bounds: lon/lat bounds of the data
+        min_zoom: First zoom level
+        max_zoom: Last zoom level
+        blocks: Number of blocks to aim for
+
+    Returns:
+        The return value is a list of (zooms, block) tasks
+    """
+    box = to_mercator(np.array([[bounds[0], bounds[1]], [bounds[2], bounds[3]]]))
+    extent = np.array([[box[0, 0], box[0, 1], box[1, 0], box[1, 1]]])
+    split = max_zoom
+    for zoom in range(min_zoom, max_zoom + 1):
+        x0, y0, x1, y1 = tile_range(extent, zoom)[0]
+        if (x1 - x0 + 1) * (y1 - y0 + 1) >= blocks:
+            split = zoom
+            break
+
+    zooms = list(range(split, max_zoom + 1))
+    tasks = [(zooms, block) for block in split_blocks(tile_range(extent, split)[0], blocks)]
+    for zoom in range(min_zoom, split):
+        # Tiles next to the extent get features through their buffer
+        pad = BUFFER / EXTENT * tile_size(zoom)
+        tiles = tile_range(extent + [-pad, -pad, pad, pad], zoom)[0]
+        tasks += [([zoom], block) for block in split_blocks(tiles, blocks)]
+    return tasks
+
+
+def build_mbtiles(layers: list, path: str, executor: Executor, workers: int, min_zoom: int = 0,
+                  max_zoom: int = 14, name: str = None) -> None:
+    """
+    Build the vector tile pyramid of staged layers into an MBTiles file. The tile blocks of plan_tasks are encoded
+    by the process pool and the tiles are stored once per content hash, tiles with the same content share one image.
+    Args:
+        layers: List of (layer name, staged GeoParquet path)
+        path: Path of the MBTiles file
+        executor: Process pool that encodes the tiles
+        workers: Number of workers of the pool
+        min_zoom: First zoom level
+        max_zoom: Last zoom level
+        name: Name of the tileset in the metadata
+
+    Returns:
+        None
+    """
+    begin_time = time.time()
+    layers = [(layer, source) for layer, source in layers if os.path.exists(source)]
+    if len(layers) == 0:
+        return
+    bounds = [math.inf, math.inf, -math.inf, -math.inf]
+    vector_layers = []
+    for layer, source in layers:
+        geo = json.loads(pq.read_metadata(source).metadata[b'geo'])
+        bbox = geo['columns'][geo['primary_column']]['bbox']
+        bounds = [min(bounds[0], bbox[0]), min(bounds[1], bbox[1]), max(bounds[2], bbox[2]), max(bounds[3], bbox[3])]
+        schema = pq.read_schema(source)
+        fields = {field.name: 'Number' if pa.types.is_integer(field.type) or pa.types.is_floating(field.type)
+                  else 'String' for field in schema if field.name not in ('geometry', 'bbox')}
+        vector_layers.append({'id': layer, 'fields': fields, 'minzoom': min_zoom, 'maxzoom': max_zoom})
+
+    if os.path.exists(path):
+        os.remove(path)
+    con = sqlite3.connect(path, isolation_level=None)
+    con.execute('PRAGMA synchronous = OFF')
+    con.execute('PRAGMA journal_mode = MEMORY')
+    con.execute('BEGIN')
+    for statement in MBTILES_SCHEMA:
+        con.execute(statement)
+    center = [(bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2, min_zoom]
+    metadata = {'name': name or os.path.splitext(os.path.basename(path))[0], 'format': 'pbf', 'type': 'overlay',
+                'version': '2', 'minzoom': str(min_zoom), 'maxzoom': str(max_zoom),
+                'bounds': ','.join(str(each) for each in bounds), 'center': ','.join(str(each) for each in center),
+                'json': json.dumps({'vector_layers': vector_layers})}
+    con.executemany('INSERT INTO metadata VALUES (?, ?)', metadata.items())
+
+    count = 0
+    futures = [executor.submit(tile_task, layers, zooms, block, max_zoom)
+               for zooms, block in plan_tasks(bounds, min_zoom, max_zoom, max(1, workers) * 4)]
+    for future in as_completed(futures):
+        rows = []
+        images = {}
+        for zoom, x, y, data in future.result():
+            tile_id = hashlib.md5(data).hexdigest()
+            images[tile_id] = data
+            # MBTiles rows count from the south like TMS
+            rows.append((zoom, x, 2 ** zoom - 1 - y, tile_id))
+        con.executemany('INSERT OR IGNORE INTO images VALUES (?, ?)', [(data, tile_id)
+                                                                        for tile_id, data in images.items()])
+        con.executemany('INSERT INTO map VALUES (?, ?, ?, ?)', rows)
+        count += len(rows)
+    con.execute('COMMIT')
+    images, = con.execute('SELECT count(*) FROM images').fetchone()
+    con.close()
+    print(f'Wrote {count} tiles with {images} distinct images to {path} after '
+          f'{round(time.time() - begin_time, 1)} seconds')
@@ -1,47 +1,117 @@
-import glob
-import geopandas as gpd
-import fiona
-
-# :TODO Test Code with prefix
-import os
-
-
-def combine_gpkg(inputs: str, outputs: str, prefix: str) -> None:
-    """
-    Combines separate geopackages
-    Args:
-        inputs: path to geopackages
-        outputs: output geopackage
-        prefix: prefix to input geopackage
-
-    Returns:
-
-    """
-    all_gpkg = glob.glob(os.path.join(inputs, f'{prefix}*gpkg'))
-
-    target_gpkg = []
-    if len(all_gpkg) > 0:
-        for each in all_gpkg:
-            if prefix in each:
-                target_gpkg.append(each)
-        for each in target_gpkg:
-            for layername in fiona.listlayers(each):
-                print(f'Processing {layername}')
-                gdf = gpd.read_file(each, layer=layername)
-                gdf.to_file(outputs, layer=layername, driver="GPKG")
-
-    else:
-        print('No input files found')
-
-    # combine_gpkg('/vagrant/output','/vagrant/test.gpkg','andorra_e_l-ns3')
-
-
-def timer(start, end):
-    hours, rem = divmod(end-start, 3600)
-    minutes, seconds = divmod(rem, 60)
-    if int(hours) > 0:
-        return '{:0>2} Hour {:0>2} Minutes {:05.2f} Seconds '.format(int(hours), int(minutes), seconds)
-    elif int(minutes) > 0:
-        return '{:0>2} Minutes {:05.2f} Seconds'.format(int(minutes), seconds)
-    else:
-        return '{:05.2f} Seconds '.format(seconds)
+import glob
+import os
+import pyogrio
+from typing import Union
+from osmpgo.writers import GpkgLayerWriter, FgbLayerWriter, OsmIdSet, gpkg_connect
+
+
+def combine_gpkg(inputs: Union[str, list], outputs: str, prefix: Union[str, list], unique: bool = True) -> None:
+    """
+    Combines separate geopackages. Every source is attached to the output database and its layers are appended with
+    INSERT SELECT, so the geometry blobs are copied without being decoded. Layers of the same name are appended to each
+    other and their spatial index is built once at the end. Features that an earlier source already added, like the
+    ways that cross the border of two regional exports, are skipped by their OSM id.
+    Args:
+        inputs: path or list of paths to geopackages
+        outputs: output geopackage
+        prefix: prefix or list of prefixes to input geopackages, sources are combined in the order given
+        unique: skip the features of a layer whose node_id or way_id was added by an earlier source
+
+    Returns:
+        None
+    """
+    all_gpkg = source_files(inputs, outputs, prefix, 'gpkg')
+    if len(all_gpkg) == 0:
+        print('No input files found')
+        return
+
+    con = gpkg_connect(outputs)
+    writers = {}
+    for each in all_gpkg:
+        print(f'Combining {each}')
+        con.execute('ATTACH DATABASE ? AS source', (each,))
+        con.execute('BEGIN')
+        for layername, in con.execute("SELECT table_name FROM source.gpkg_contents WHERE data_type = 'features' "
+                                      "ORDER BY table_name").fetchall():
+            print(f'Processing {layername}')
+            if layername not in writers:
+                theme, _, feature = layername.rpartition('_')
+                writers[layername] = GpkgLayerWriter(os.path.dirname(outputs),
+                                                     os.path.splitext(os.path.basename(outputs))[0], theme,
+                                                     feature, con, layer=layername)
+            writers[layername].copy_from('source', unique)
+        con.execute('COMMIT')
+        con.execute('DETACH DATABASE source')
+
+    con.execute('BEGIN')
+    for layername, writer in writers.items():
+        print(f'\tWrote {writer.count} features to {layername}')
+        writer.close()
+    con.execute('COMMIT')
+    con.close()
+
+    # combine_gpkg('/vagrant/output','/vagrant/test.gpkg','andorra_e_l-ns3')
+
+
+def combine_fgb(inputs: Union[str, list], outputs: str, prefix: Union[str, list], unique: bool = True) -> None:
+    """
+    Combines separate FlatGeobuf exports into one FlatGeobuf file per layer in the outputs folder. Same-named layers
+    are appended to each other batch by batch and each combined layer is written with a new Hilbert R-tree.
+    Args:
+        inputs: path or list of paths to FlatGeobuf files
+        outputs: output folder
+        prefix: prefix or list of prefixes to input files, sources are combined in the order given
+        unique: skip the features of a layer whose node_id or way_id was added by an earlier source
+
+    Returns:
+        None
+    """
+    all_fgb = source_files(inputs, outputs, prefix, 'fgb')
+    if len(all_fgb) == 0:
+        print('No input files found')
+        return
+
+    os.makedirs(outputs, exist_ok=True)
+    seen = OsmIdSet() if unique else None
+    writers = {}
+    for each in all_fgb:
+        layername = pyogrio.read_info(each)['layer_name']
+        print(f'Processing {layername} of {each}')
+        if layername not in writers:
+            theme, _, feature = layername.rpartition('_')
+            writers[layername] = FgbLayerWriter(outputs, theme, theme, feature)
+        if seen is not None:
+            seen.next_source()
+        writers[layername].copy(each, seen)
+
+    for layername, writer in writers.items():
+        print(f'\tWrote {writer.count} features to {layername}')
+        writer.close()
+    if seen is not None:
+        seen.close()
+
+
+def source_files(inputs: Union[str, list], outputs: str, prefix: Union[str, list], extension: str) -> list:
+    """
+    Files of each input folder and prefix in the order given, without the output itself
+    """
+    inputs = [inputs] if isinstance(inputs, str) else inputs
+    prefix = [prefix] if isinstance(prefix, str) else prefix
+    files = []
+    for folder in inputs:
+        for name in prefix:
+            for each in sorted(glob.glob(os.path.join(folder, f'{name}*{extension}'))):
+                if os.path.abspath(each) != os.path.abspath(outputs) and each not in files:
+                    files.append(each)
+    return files
+
+
+def timer(start, end):
+    hours, rem = divmod(end-start, 3600)
+    minutes, seconds = divmod(rem, 60)
+    if int(hours) > 0:
+        return '{:0>2} Hour {:0>2} Minutes {:05.2f} Seconds '.format(int(hours), int(minutes), seconds)
+    elif int(minutes) > 0:
+        return '{:0>2} Minutes {:05.2f} Seconds'.format(int(minutes), seconds)
+    else:
+        return '{:05.2f} Seconds '.format(seconds)
@@ -0,0 +1,1023 @@
+import json
+import math
+import multiprocessing
+import os
+import sqlite3
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import geopandas as gpd
+import pyogrio
+import pyogrio.raw
+import shapely
+from typing import Iterable, Any
+from osmpgo.fields import typed_fields
+
+OUTPUT_QUEUE = None  # Queue to the writer process of the single output mode, see set_output_queue
+
+GEOMETRY_TYPES = ['Point', 'LineString', 'LinearRing', 'Polygon', 'MultiPoint', 'MultiLineString', 'MultiPolygon',
+                  'GeometryCollection']
+
+RTREE_CELL = np.dtype([('id', '>i8'), ('box', '>f4', (4,))])
+
+GPKG_APPLICATION_ID = 0x47504B47  # GPKG
+GPKG_VERSION = 10200
+
+GPKG_HEADER = np.dtype([('magic', 'S2'), ('version', 'u1'), ('flags', 'u1'), ('srs_id', '<i4'),
+                        ('envelope', '<f8', (4,))])
+
+GPKG_ENVELOPE = [0, 32, 48, 48, 64]  # Envelope bytes of each header envelope type
+
+NULLABLE_TYPES = {pa.int64(): pd.Int64Dtype(), pa.float64(): pd.Float64Dtype()}
+
+DICTIONARY = pa.dictionary(pa.int32(), pa.string())  # Arrow type of the category fields
+
+GPKG_NAMES = {name.upper(): name for name in GEOMETRY_TYPES}
+
+GPKG_SRS = [('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', 'undefined cartesian coordinate reference system'),
+            ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', 'undefined geographic coordinate reference system')]
+
+GPKG_TABLES = [
+    'CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER NOT NULL PRIMARY KEY, '
+    'organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, '
+    'description TEXT)',
+    "CREATE TABLE IF NOT EXISTS gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, "
+    "identifier TEXT UNIQUE, description TEXT DEFAULT '', "
+    "last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), min_x DOUBLE, min_y DOUBLE, "
+    "max_x DOUBLE, max_y DOUBLE, srs_id INTEGER, "
+    "CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id))",
+    'CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL, '
+    'geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL, '
+    'CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name), '
+    'CONSTRAINT uk_gc_table_name UNIQUE (table_name), '
+    'CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name), '
+    'CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id))',
+    'CREATE TABLE IF NOT EXISTS gpkg_extensions (table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL, '
+    'definition TEXT NOT NULL, scope TEXT NOT NULL, '
+    'CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name))',
+]
+
+# R-tree triggers of the GeoPackage 1.2 rtree extension, created after the bulk load
+RTREE_TRIGGERS = [
+    'CREATE TRIGGER "rtree_{t}_{c}_insert" AFTER INSERT ON "{t}" '
+    'WHEN (new."{c}" NOT NULL AND NOT ST_IsEmpty(NEW."{c}")) BEGIN '
+    'INSERT OR REPLACE INTO "rtree_{t}_{c}" VALUES (NEW."{i}", ST_MinX(NEW."{c}"), ST_MaxX(NEW."{c}"), '
+    'ST_MinY(NEW."{c}"), ST_MaxY(NEW."{c}")); END',
+    'CREATE TRIGGER "rtree_{t}_{c}_update1" AFTER UPDATE OF "{c}" ON "{t}" '
+    'WHEN OLD."{i}" = NEW."{i}" AND (NEW."{c}" NOTNULL AND NOT ST_IsEmpty(NEW."{c}")) BEGIN '
+    'INSERT OR REPLACE INTO "rtree_{t}_{c}" VALUES (NEW."{i}", ST_MinX(NEW."{c}"), ST_MaxX(NEW."{c}"), '
+    'ST_MinY(NEW."{c}"), ST_MaxY(NEW."{c}")); END',
+    'CREATE TRIGGER "rtree_{t}_{c}_update2" AFTER UPDATE OF "{c}" ON "{t}" '
+    'WHEN OLD."{i}" = NEW."{i}" AND (NEW."{c}" ISNULL OR ST_IsEmpty(NEW."{c}")) BEGIN '
+    'DELETE FROM "rtree_{t}_{c}" WHERE id = OLD."{i}"; END',
+    'CREATE TRIGGER "rtree_{t}_{c}_update3" AFTER UPDATE ON "{t}" '
+    'WHEN OLD."{i}" != NEW."{i}" AND (NEW."{c}" NOTNULL AND NOT ST_IsEmpty(NEW."{c}")) BEGIN '
+    'DELETE FROM "rtree_{t}_{c}" WHERE id = OLD."{i}"; '
+    'INSERT OR REPLACE INTO "rtree_{t}_{c}" VALUES (NEW."{i}", ST_MinX(NEW."{c}"), ST_MaxX(NEW."{c}"), '
+    'ST_MinY(NEW."{c}"), ST_MaxY(NEW."{c}")); END',
+    'CREATE TRIGGER "rtree_{t}_{c}_update4" AFTER UPDATE ON "{t}" '
+    'WHEN OLD."{i}" != NEW."{i}" AND (NEW."{c}" ISNULL OR ST_IsEmpty(NEW."{c}")) BEGIN '
+    'DELETE FROM "rtree_{t}_{c}" WHERE id IN (OLD."{i}", NEW."{i}"); END',
+    'CREATE TRIGGER "rtree_{t}_{c}_delete" AFTER DELETE ON "{t}" WHEN old."{c}" NOT NULL BEGIN '
+    'DELETE FROM "rtree_{t}_{c}" WHERE id = OLD."{i}"; END',
+]
+
+
+class LayerWriter:
+    """
+    Writes the features of one theme layer to an output file. Features are passed in as GeoDataFrame chunks and the
+    file is only created when the first chunk is written, so empty layers leave no file behind.
+    """
+
+    extension = None
+
+    def __init__(self, folder: str, name: str, theme: str, feature: str):
+        self.path = self.layer_path(folder, name, feature)
+        self.layer = f'{theme}_{feature}'
+        self.count = 0
+
+    @classmethod
+    def layer_path(cls, folder: str, name: str, feature: str) -> str:
+        """
+        File a layer is written to, formats that hold a single layer per file add the feature to the name
+        Args:
+            folder: Output folder
+            name: File name without the extension, {prefix}_{theme} for the export
+            feature: point, line or polygon
+
+        Returns:
+            The return value is the path of the output file
+        """
+        return os.path.join(folder, f'{name}_{feature}.{cls.extension}')
+
+    def has_layer(self, path: str) -> bool:
+        return os.path.exists(path)
+
+    def write(self, gdf: gpd.GeoDataFrame) -> None:
+        raise NotImplementedError
+
+    def copy(self, path: str) -> None:
+        """
+        Append the same layer from another file of this format, used to merge the parts of a large theme
+        Args:
+            path: File written by a writer of the same class
+
+        Returns:
+            None
+        """
+        if self.has_layer(path):
+            self.write(gpd.read_file(path, layer=self.layer))
+
+    def close(self) -> None:
+        pass
+
+
+class GpkgLayerWriter(LayerWriter):
+    """
+    Writes a layer into the theme geopackage, every layer of a theme shares {prefix}_{theme}.gpkg
+
+    Features are inserted with SQLite executemany as prebuilt GeoPackage geometry blobs inside one transaction per
+    chunk. No lock is held between chunks, so the writers of the other layers of the theme can load their chunks into
+    the same geopackage in turns. The R-tree is not maintained while loading, the feature bounds are kept in a temporary
+    table and the spatial index is packed in one pass when the layer is closed, see pack_rtree.
+    """
+
+    extension = 'gpkg'
+
+    def __init__(self, folder: str, name: str, theme: str, feature: str, con: sqlite3.Connection = None,
+                 layer: str = None):
+        super().__init__(folder, name, theme, feature)
+        if layer is not None:
+            self.layer = layer
+        self.geometry_column = 'geom'
+        self.fid_column = 'fid'
+        self.con = con
+        self.shared = con is not None  # A shared connection and its transaction belong to the caller, see gpkg_connect
+        self.bounds = f'temp."bounds_{self.layer}"'
+        self.seen = f'temp."seen_{self.layer}"'  # OSM ids of the features copied by copy_from with unique
+        self.columns = None
+        self.srs_id = None
+        self.fid = 0
+        self.geometry_types = set()
+        self.bulk_limit = 10000000  # Features whose bounds are sorted in memory to pack the R-tree
+        self.bounds_count = 0
+        self.extent = [np.inf, np.inf, -np.inf, -np.inf]
+
+    @classmethod
+    def layer_path(cls, folder: str, name: str, feature: str) -> str:
+        return os.path.join(folder, f'{name}.{cls.extension}')
+
+    def has_layer(self, path: str) -> bool:
+        if not os.path.exists(path):
+            return False
+        con = sqlite3.connect(path)
+        try:
+            return con.execute('SELECT 1 FROM gpkg_contents WHERE table_name = ?', (self.layer,)).fetchone() is not None
+        finally:
+            con.close()
+
+    def create_layer(self, create_sql: str) -> None:
+        """
+        Create the feature table inside the open transaction, an existing layer of the same name is replaced
+        """
+        self.drop_layer()
+        self.con.execute(create_sql)
+        self.con.execute("INSERT INTO main.gpkg_contents (table_name, data_type, identifier, srs_id) "
+                         "VALUES (?, 'features', ?, ?)", (self.layer, self.layer, self.srs_id))
+        self.con.execute(f'CREATE TABLE {self.bounds} (chunk INTEGER PRIMARY KEY, ids BLOB, boxes BLOB)')
+
+    def add_bounds(self, ids: np.ndarray, boxes: np.ndarray) -> None:
+        """
+        Keep the bounds of a chunk of features for the R-tree, one row per chunk
+        Args:
+            ids: Feature ids
+            boxes: Feature bounds as minx, maxx, miny, maxy rows, empty geometries have NaN bounds and are left out
+
+        Returns:
+            None
+        """
+        keep = ~np.isnan(boxes).any(axis=1)
+        ids, boxes = ids[keep].astype('int64'), boxes[keep].astype('float64')
+        if len(ids) == 0:
+            return
+        self.con.execute(f'INSERT INTO {self.bounds} (ids, boxes) VALUES (?, ?)', (ids.tobytes(), boxes.tobytes()))
+        self.bounds_count += len(ids)
+        self.extent = [min(self.extent[0], boxes[:, 0].min()), min(self.extent[1], boxes[:, 2].min()),
+                       max(self.extent[2], boxes[:, 1].max()), max(self.extent[3], boxes[:, 3].max())]
+
+    def iter_bounds(self) -> Iterable[tuple]:
+        for ids, boxes in self.con.execute(f'SELECT ids, boxes FROM {self.bounds} ORDER BY chunk'):
+            yield np.frombuffer(ids, dtype='int64'), np.frombuffer(boxes, dtype='float64').reshape(-1, 4)
+
+    def open(self, gdf: gpd.GeoDataFrame) -> None:
+        """
+        Create the layer from the schema of the first chunk inside the transaction of the chunk
+        """
+        crs = gdf.crs
+        self.srs_id = crs.to_epsg() if crs is not None and crs.to_epsg() is not None else -1
+        if self.srs_id > 0:
+            self.con.execute('INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)',
+                             (crs.name, self.srs_id, 'EPSG', self.srs_id, crs.to_wkt('WKT1_GDAL'), ''))
+
+        self.columns = [column for column in gdf.columns if column != gdf.geometry.name]
+        definition = ''.join(f', "{column}" {sqlite_type(gdf[column].dtype)}' for column in self.columns)
+        self.create_layer(f'CREATE TABLE "{self.layer}" ("{self.fid_column}" INTEGER PRIMARY KEY AUTOINCREMENT '
+                          f'NOT NULL, "{self.geometry_column}" GEOMETRY{definition})')
+
+    def drop_layer(self) -> None:
+        self.con.execute(f'DROP TABLE IF EXISTS main."{self.layer}"')
+        self.con.execute(f'DROP TABLE IF EXISTS main."rtree_{self.layer}_{self.geometry_column}"')
+        for table in ('gpkg_contents', 'gpkg_geometry_columns', 'gpkg_extensions'):
+            self.con.execute(f'DELETE FROM main.{table} WHERE table_name = ?', (self.layer,))
+
+    def write(self, gdf: gpd.GeoDataFrame) -> None:
+        if len(gdf) == 0:
+            return
+        self.begin()
+        if self.columns is None:
+            self.open(gdf)
+        geometry = np.asarray(gdf.geometry.values)
+        bounds = shapely.bounds(geometry)
+        type_ids = shapely.get_type_id(geometry)
+        self.geometry_types.update(GEOMETRY_TYPES[each] for each in np.unique(type_ids) if each >= 0)
+
+        fids = np.arange(self.fid + 1, self.fid + 1 + len(gdf))
+        self.fid += len(gdf)
+        blobs = gpkg_blobs(geometry, bounds, self.srs_id)
+        values = [gdf[column].to_numpy(dtype=object, na_value=None).tolist() for column in self.columns]
+        self.con.executemany(f'INSERT INTO "{self.layer}" VALUES ({",".join("?" * (len(self.columns) + 2))})',
+                             zip(fids.tolist(), blobs, *values))
+        self.add_bounds(fids, bounds[:, [0, 2, 1, 3]])
+        self.count += len(gdf)
+        self.commit()
+
+    def begin(self) -> None:
+        """
+        Start the transaction of a chunk, the connection is opened with the first one. A shared connection is already
+        inside the transaction of its caller.
+        """
+        if self.shared:
+            return
+        if self.con is None:
+            self.con = gpkg_connect(self.path)
+        self.con.execute('BEGIN')
+
+    def commit(self) -> None:
+        if not self.shared:
+            self.con.execute('COMMIT')
+
+    def copy(self, path: str) -> None:
+        """
+        Append the layer of a partial geopackage, see copy_from
+        """
+        if not self.has_layer(path):
+            return
+        if self.con is None:
+            self.con = gpkg_connect(self.path)
+        # SQLite can not attach a database inside a transaction
+        self.con.execute('ATTACH DATABASE ? AS part', (path,))
+        self.con.execute('BEGIN')
+        self.copy_from('part')
+        self.con.execute('COMMIT')
+        self.con.execute('DETACH DATABASE part')
+
+    def copy_from(self, schema: str, unique: bool = False) -> None:
+        """
+        Append the layer of an attached geopackage with INSERT SELECT. The geometry blobs are copied as they are and the
+        bounds come from the source R-tree, so no geometry is decoded. The first source gives the layer its table
+        definition, columns that a later source is missing are left NULL.
+        Args:
+            schema: Name the source geopackage is attached as
+            unique: Skip the features whose OSM id was copied from an earlier source, see feature_key
+
+        Returns:
+            None
+        """
+        geometry_column, srs_id, type_name = self.con.execute(
+            f'SELECT column_name, srs_id, geometry_type_name FROM {schema}.gpkg_geometry_columns WHERE table_name = ?',
+            (self.layer,)).fetchone()
+        info = self.con.execute(f'PRAGMA {schema}.table_info("{self.layer}")').fetchall()
+        fid_column = [row[1] for row in info if row[5] == 1][0]
+        source_columns = {row[1] for row in info}
+
+        if self.columns is None:
+            self.srs_id = srs_id
+            self.geometry_column = geometry_column
+            self.fid_column = fid_column
+            self.con.execute(f'INSERT OR IGNORE INTO main.gpkg_spatial_ref_sys '
+                             f'SELECT * FROM {schema}.gpkg_spatial_ref_sys WHERE srs_id = ?', (srs_id,))
+            create_sql, = self.con.execute(f"SELECT sql FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?",
+                                           (self.layer,)).fetchone()
+            self.create_layer(create_sql)
+            self.columns = [row[1] for row in info if row[1] not in (fid_column, geometry_column)]
+
+        source = f'{schema}."{self.layer}" AS s'
+        key = feature_key(source_columns) if unique else None
+        where = ''
+        if key is not None:
+            # The ids copied so far live in an indexed temp table, which SQLite keeps on disk
+            self.con.execute(f'CREATE TABLE IF NOT EXISTS {self.seen} (id TEXT PRIMARY KEY) WITHOUT ROWID')
+            where = f' WHERE NOT EXISTS (SELECT 1 FROM {self.seen} WHERE id = {key})'
+
+        columns = ', '.join([f'"{self.geometry_column}"'] + [f'"{column}"' for column in self.columns])
+        selected = ', '.join([f's."{geometry_column}"'] + [f's."{column}"' if column in source_columns else 'NULL'
+                                                            for column in self.columns])
+        inserted = self.con.execute(f'INSERT INTO main."{self.layer}" ("{self.fid_column}", {columns}) '
+                                    f'SELECT s."{fid_column}" + {self.fid}, {selected} FROM {source}{where} '
+                                    f'ORDER BY s."{fid_column}"').rowcount
+
+        rtree = f'rtree_{self.layer}_{geometry_column}'
+        if self.con.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE name = ?", (rtree,)).fetchone():
+            copied = f' WHERE id IN (SELECT s."{fid_column}" FROM {source}{where})' if where else ''
+            cursor = self.con.execute(f'SELECT id + {self.fid}, minx, maxx, miny, maxy FROM {schema}."{rtree}"{copied}')
+            while True:
+                rows = cursor.fetchmany(100000)
+                if len(rows) == 0:
+                    break
+                rows = np.array(rows, dtype='float64')
+                self.add_bounds(rows[:, 0], rows[:, 1:])
+        else:
+            # Source without a spatial index, the bounds are read from the geometry blobs
+            present = f' AND s."{geometry_column}" IS NOT NULL' if where else \
+                f' WHERE s."{geometry_column}" IS NOT NULL'
+            cursor = self.con.execute(f'SELECT s."{fid_column}" + {self.fid}, s."{geometry_column}" '
+                                      f'FROM {source}{where}{present}')
+            while True:
+                rows = cursor.fetchmany(100000)
+                if len(rows) == 0:
+                    break
+                self.add_bounds(np.array([row[0] for row in rows]), gpkg_bounds([row[1] for row in rows]))
+
+        if key is not None:
+            self.con.execute(f'INSERT OR IGNORE INTO {self.seen} SELECT {key} FROM {source}')
+
+        self.geometry_types.add(GPKG_NAMES.get(type_name, type_name))
+        self.fid = self.con.execute(f'SELECT max("{self.fid_column}") FROM main."{self.layer}"').fetchone()[0] or 0
+        self.count += inserted
+
+    def close(self) -> None:
+        """
+        Bulk load the R-tree, add the index triggers and fill in the layer metadata in the last transaction
+        """
+        if self.columns is None:
+            return
+        self.begin()
+        rtree = f'rtree_{self.layer}_{self.geometry_column}'
+        self.con.execute(f'CREATE VIRTUAL TABLE "{rtree}" USING rtree(id, minx, maxx, miny, maxy)')
+        if 0 < self.bounds_count <= self.bulk_limit:
+            chunks = list(self.iter_bounds())
+            pack_rtree(self.con, rtree, np.concatenate([ids for ids, _ in chunks]),
+                       np.concatenate([boxes for _, boxes in chunks]))
+        else:
+            # Too many bounds to sort in memory, let SQLite insert them one by one
+            for ids, boxes in self.iter_bounds():
+                self.con.executemany(f'INSERT INTO "{rtree}" VALUES (?, ?, ?, ?, ?)',
+                                     zip(ids.tolist(), *boxes.T.tolist()))
+        for trigger in RTREE_TRIGGERS:
+            self.con.execute(trigger.format(t=self.layer, c=self.geometry_column, i=self.fid_column))
+        self.con.execute('INSERT INTO gpkg_extensions VALUES (?, ?, ?, ?, ?)',
+                         (self.layer, self.geometry_column, 'gpkg_rtree_index',
+                          'http://www.geopackage.org/spec120/#extension_rtree', 'write-only'))
+
+        self.con.execute('INSERT INTO gpkg_geometry_columns VALUES (?, ?, ?, ?, 0, 0)',
+                         (self.layer, self.geometry_column, gpkg_type(self.geometry_types), self.srs_id))
+        extent = [float(each) if np.isfinite(each) else None for each in self.extent]
+        self.con.execute("UPDATE gpkg_contents SET min_x = ?, min_y = ?, max_x = ?, max_y = ?, "
+                         "last_change = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') WHERE table_name = ?",
+                         extent + [self.layer])
+        self.con.execute(f'DROP TABLE {self.bounds}')
+        self.con.execute(f'DROP TABLE IF EXISTS {self.seen}')
+        self.columns = None
+        self.commit()
+        if not self.shared:
+            self.con.close()
+            self.con = None
+
+
+def gpkg_connect(path: str) -> sqlite3.Connection:
+    """
+    Open a geopackage for loading and create the metadata tables if they are missing. The connection is in autocommit
+    mode, the caller starts the load transaction.
+    Args:
+        path: Path of the geopackage
+
+    Returns:
+        The return value is the SQLite connection
+    """
+    con = sqlite3.connect(path, isolation_level=None)
+    con.execute('PRAGMA synchronous = OFF')
+    con.execute('PRAGMA journal_mode = MEMORY')
+    con.execute(f'PRAGMA application_id = {GPKG_APPLICATION_ID}')
+    con.execute(f'PRAGMA user_version = {GPKG_VERSION}')
+    for sql in GPKG_TABLES:
+        con.execute(sql)
+    con.executemany('INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)', GPKG_SRS)
+    return con
+
+
+def gpkg_bounds(blobs: list) -> np.ndarray:
+    """
+    Bounds of GeoPackage geometry blobs as minx, maxx, miny, maxy rows, the WKB after the header is read with shapely
+    """
+    wkb = [blob[8 + GPKG_ENVELOPE[(blob[3] >> 1) & 7]:] for blob in blobs]
+    return shapely.bounds(shapely.from_wkb(wkb))[:, [0, 2, 1, 3]]
+
+
+def feature_key(columns: Iterable[str]) -> Any:
+    """
+    SQL expression of the OSM id of a feature of the source aliased as s. Points are keyed by node_id, lines and
+    polygons by way_id or, for relation shapes that have no way_id, by relation_id.
+    Args:
+        columns: Column names of the layer
+
+    Returns:
+        The return value is the SQL expression, None if the layer has no OSM id columns
+    """
+    if 'node_id' in columns:
+        return "NULLIF(s.\"node_id\", '')"
+    if 'way_id' in columns and 'relation_id' in columns:
+        return "CASE WHEN s.\"way_id\" <> '' THEN 'w' || s.\"way_id\" ELSE 'r' || NULLIF(s.\"relation_id\", '') END"
+    return None
+
+
+def feature_keys(table: pa.Table) -> Any:
+    """
+    OSM ids of the rows of an Arrow table in the form of feature_key
+    """
+    if 'node_id' in table.column_names:
+        return [each or None for each in table['node_id'].to_pylist()]
+    if 'way_id' in table.column_names and 'relation_id' in table.column_names:
+        return [f'w{way}' if way else (f'r{relation}' if relation else None)
+                for way, relation in zip(table['way_id'].to_pylist(), table['relation_id'].to_pylist())]
+    return None
+
+
+def sqlite_type(dtype) -> str:
+    """
+    GeoPackage column type of a pandas column
+    """
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'BOOLEAN'
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    return 'TEXT'
+
+
+def gpkg_type(geometry_types: set) -> str:
+    """
+    GeoPackage geometry type name of a layer, mixed layers are stored as GEOMETRY
+    """
+    if len(geometry_types) == 1:
+        return next(iter(geometry_types)).upper()
+    return 'GEOMETRY'
+
+
+def gpkg_blobs(geometry: np.ndarray, bounds: np.ndarray, srs_id: int) -> list:
+    """
+    Build GeoPackage geometry blobs, the 40 byte header with an xy envelope followed by little endian WKB
+    Args:
+        geometry: Array of shapely geometries
+        bounds: shapely.bounds of the geometries
+        srs_id: Spatial reference id of the layer
+
+    Returns:
+        The return value is a list of bytes, one blob per geometry
+    """
+    header = np.zeros(len(geometry), dtype=GPKG_HEADER)
+    header['magic'] = b'GP'
+    header['flags'] = np.where(shapely.is_empty(geometry), 0b00010011, 0b00000011)
+    header['srs_id'] = srs_id
+    header['envelope'] = bounds[:, [0, 2, 1, 3]]
+    header = header.tobytes()
+    size = GPKG_HEADER.itemsize
+    return [header[i * size:(i + 1) * size] + wkb
+            for i, wkb in enumerate(shapely.to_wkb(geometry, byte_order=1))]
+
+
+def str_order(boxes: np.ndarray, capacity: int) -> np.ndarray:
+    """
+    Sort-Tile-Recursive order of a group of boxes, the boxes are cut into vertical slabs by their center x and each slab
+    is sorted by center y so consecutive runs of capacity boxes make compact nodes
+    """
+    count = len(boxes)
+    slabs = math.ceil(math.sqrt(math.ceil(count / capacity)))
+    rank = np.empty(count, dtype='int64')
+    rank[np.argsort(boxes[:, 0] + boxes[:, 1], kind='stable')] = np.arange(count)
+    return np.lexsort((boxes[:, 2] + boxes[:, 3], rank // (slabs * capacity)))
+
+
+def pack_rtree(con: sqlite3.Connection, rtree: str, ids: np.ndarray, boxes: np.ndarray) -> None:
+    """
+    Bulk load an empty SQLite R-tree by writing its _node, _parent and _rowid tables directly. The tree is packed
+    bottom up in Sort-Tile-Recursive order, which is far quicker than inserting the features one by one and gives
+    fuller nodes.
+    Args:
+        con: Connection holding the R-tree
+        rtree: Name of the R-tree virtual table
+        ids: Feature ids
+        boxes: Feature bounds as minx, maxx, miny, maxy rows
+
+    Returns:
+        None
+    """
+    if len(ids) == 0:
+        return
+    node_size, = con.execute(f'SELECT length(data) FROM "{rtree}_node" WHERE nodeno = 1').fetchone()
+    capacity = (node_size - 4) // RTREE_CELL.itemsize
+
+    # The R-tree stores 32 bit floats, round the bounds outward so every box still covers its feature
+    low = boxes[:, [0, 2]].astype('float32')
+    low = np.where(low > boxes[:, [0, 2]], np.nextafter(low, np.float32(-np.inf)), low)
+    high = boxes[:, [1, 3]].astype('float32')
+    high = np.where(high < boxes[:, [1, 3]], np.nextafter(high, np.float32(np.inf)), high)
+    boxes = np.stack([low[:, 0], high[:, 0], low[:, 1], high[:, 1]], axis=1)
+
+    # Each level holds its entries in node order, the entries of the upper levels are indexes of the nodes below
+    levels = []
+    while True:
+        order = str_order(boxes, capacity)
+        ids, boxes = ids[order], boxes[order]
+        levels.append((ids, boxes))
+        if len(ids) <= capacity:
+            break
+        starts = np.arange(0, len(ids), capacity)
+        boxes = np.stack([np.minimum.reduceat(boxes[:, 0], starts), np.maximum.reduceat(boxes[:, 1], starts),
+                          np.minimum.reduceat(boxes[:, 2], starts), np.maximum.reduceat(boxes[:, 3], starts)], axis=1)
+        ids = np.arange(len(starts), dtype='int64')
+
+    # Node numbers run from the root down, the root has to be node 1
+    first = [0] * len(levels)
+    nodeno = 1
+    for level in reversed(range(len(levels))):
+        first[level] = nodeno
+        nodeno += math.ceil(len(levels[level][0]) / capacity)
+
+    con.execute(f'DELETE FROM "{rtree}_node"')
+    for level, (ids, boxes) in enumerate(levels):
+        node_count = math.ceil(len(ids) / capacity)
+        cells = np.zeros(node_count * capacity, dtype=RTREE_CELL)
+        cells['id'][:len(ids)] = ids if level == 0 else ids + first[level - 1]
+        cells['box'][:len(ids)] = boxes
+        data = np.zeros((node_count, node_size), dtype='uint8')
+        data[:, 4:4 + capacity * RTREE_CELL.itemsize] = cells.view('uint8').reshape(node_count, -1)
+        counts = np.minimum(capacity, len(ids) - np.arange(node_count) * capacity).astype('>u2')
+        data[:, 2:4] = counts.view('uint8').reshape(node_count, 2)
+        if level == len(levels) - 1:
+            data[0, 0:2] = np.array([level], dtype='>u2').view('uint8')  # Depth of the tree is kept in the root
+        nodes = np.arange(node_count) + first[level]
+        con.executemany(f'INSERT INTO "{rtree}_node" VALUES (?, ?)',
+                        zip(nodes.tolist(), (row.tobytes() for row in data)))
+
+        parents = np.arange(len(ids)) // capacity + first[level]
+        if level == 0:
+            con.executemany(f'INSERT INTO "{rtree}_rowid" VALUES (?, ?)', zip(ids.tolist(), parents.tolist()))
+        else:
+            con.executemany(f'INSERT INTO "{rtree}_parent" VALUES (?, ?)',
+                            zip((ids + first[level - 1]).tolist(), parents.tolist()))
+
+
+class ParquetLayerWriter(LayerWriter):
+    """
+    Writes a layer to {prefix}_{theme}_{feature}.parquet as GeoParquet. Geometry is stored as WKB next to a bbox
+    covering column so readers can skip row groups by extent. Chunks are buffered into full row groups before they
+    are written with zstd compression.
+    """
+
+    extension = 'parquet'
+
+    def __init__(self, folder: str, name: str, theme: str, feature: str, row_group_size: int = 100000,
+                 compression: str = 'zstd'):
+        super().__init__(folder, name, theme, feature)
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.writer = None
+        self.pending = []
+        self.pending_rows = 0
+        self.bbox = [np.inf, np.inf, -np.inf, -np.inf]
+        self.geometry_types = set()
+
+    def write(self, gdf: gpd.GeoDataFrame) -> None:
+        if len(gdf) == 0:
+            return
+        geometry = gdf.geometry.values
+        bounds = shapely.bounds(np.asarray(geometry))
+        self.geometry_types.update(GEOMETRY_TYPES[each] for each in np.unique(shapely.get_type_id(geometry))
+                                   if each >= 0)
+
+        table = arrow_table(gdf)
+        bbox = pa.StructArray.from_arrays([pa.array(bounds[:, i]) for i in range(4)],
+                                          names=['xmin', 'ymin', 'xmax', 'ymax'])
+        self.write_table(table.append_column('bbox', bbox))
+
+    def write_table(self, table: pa.Table) -> None:
+        """
+        Buffer an Arrow table that already holds the WKB geometry and bbox columns
+        """
+        if table.num_rows == 0:
+            return
+        bbox = table['bbox'].combine_chunks()
+        self.bbox = [min(self.bbox[0], pc.min(bbox.field('xmin')).as_py()),
+                     min(self.bbox[1], pc.min(bbox.field('ymin')).as_py()),
+                     max(self.bbox[2], pc.max(bbox.field('xmax')).as_py()),
+                     max(self.bbox[3], pc.max(bbox.field('ymax')).as_py())]
+        self.pending.append(table)
+        self.pending_rows += table.num_rows
+        self.count += table.num_rows
+        if self.pending_rows >= self.row_group_size:
+            self.flush()
+
+    def flush(self, final: bool = False) -> None:
+        """
+        Write the buffered rows as full row groups, the remainder is kept for the next chunk unless final
+        """
+        if self.pending_rows == 0:
+            return
+        table = pa.concat_tables(self.pending)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema, compression=self.compression)
+        full = table.num_rows if final else table.num_rows - table.num_rows % self.row_group_size
+        if full > 0:
+            self.writer.write_table(table.slice(0, full), row_group_size=self.row_group_size)
+        self.pending = [table.slice(full)] if full < table.num_rows else []
+        self.pending_rows = table.num_rows - full
+
+    def copy(self, path: str) -> None:
+        if not self.has_layer(path):
+            return
+        source = pq.ParquetFile(path)
+        geo = json.loads(source.metadata.metadata[b'geo'])
+        self.geometry_types.update(geo['columns']['geometry']['geometry_types'])
+        for batch in source.iter_batches(batch_size=self.row_group_size):
+            self.write_table(pa.Table.from_batches([batch]))
+
+    def metadata(self) -> dict:
+        """
+        GeoParquet 1.1 file metadata, the crs is left out which means OGC:CRS84 (EPSG:4326 in lon/lat order)
+        """
+        return {'version': '1.1.0',
+                'primary_column': 'geometry',
+                'columns': {'geometry': {
+                    'encoding': 'WKB',
+                    'geometry_types': sorted(self.geometry_types),
+                    'bbox': self.bbox,
+                    'covering': {'bbox': {'xmin': ['bbox', 'xmin'], 'ymin': ['bbox', 'ymin'],
+                                          'xmax': ['bbox', 'xmax'], 'ymax': ['bbox', 'ymax']}}}}}
+
+    def close(self) -> None:
+        self.flush(final=True)
+        if self.writer is not None:
+            self.writer.add_key_value_metadata({'geo': json.dumps(self.metadata())})
+            self.writer.close()
+            self.writer = None
+
+
+class FgbLayerWriter(LayerWriter):
+    """
+    Writes a layer to {prefix}_{theme}_{feature}.fgb as FlatGeobuf. The chunks are streamed as Arrow batches into a
+    temporary file next to the output, on close GDAL sorts the features along the Hilbert curve and writes them after
+    the packed R-tree in one sequential pass.
+    """
+
+    extension = 'fgb'
+
+    def __init__(self, folder: str, name: str, theme: str, feature: str):
+        super().__init__(folder, name, theme, feature)
+        self.buffer = f'{self.path}.arrows'
+        self.sink = None
+        self.schema = None
+        self.crs = None
+        self.geometry_types = set()
+
+    def write(self, gdf: gpd.GeoDataFrame) -> None:
+        if len(gdf) == 0:
+            return
+        self.crs = self.crs or (gdf.crs.to_string() if gdf.crs else None)
+        self.geometry_types.update(GEOMETRY_TYPES[each] for each in np.unique(shapely.get_type_id(gdf.geometry.values))
+                                   if each >= 0)
+        self.write_table(arrow_table(gdf))
+
+    def write_table(self, table: pa.Table) -> None:
+        """
+        Buffer an Arrow table that already holds the WKB geometry column
+        """
+        if table.num_rows == 0:
+            return
+        table = table.replace_schema_metadata(None)
+        if self.sink is None:
+            self.schema = table.schema
+            self.sink = pa.ipc.new_stream(self.buffer, self.schema)
+        elif not table.schema.equals(self.schema):
+            table = table.select(self.schema.names).cast(self.schema)
+        self.sink.write_table(table)
+        self.count += table.num_rows
+
+    def copy(self, path: str, seen: Any = None) -> None:
+        """
+        Append the features of a FlatGeobuf file batch by batch
+        Args:
+            path: Path of the FlatGeobuf file
+            seen: OsmIdSet that skips the features an earlier source already added
+
+        Returns:
+            None
+        """
+        if not os.path.exists(path):
+            return
+        with pyogrio.raw.open_arrow(path, use_pyarrow=True) as (meta, reader):
+            self.crs = self.crs or meta['crs']
+            if meta['geometry_type'] != 'Unknown':
+                self.geometry_types.add(meta['geometry_type'])
+            for batch in reader:
+                # Drop the geoarrow field metadata and the geometry column name GDAL reads the file with
+                names = [name for name in batch.schema.names if name != meta['fid_column']]
+                table = pa.Table.from_arrays([batch.column(name) for name in names],
+                                             names=[name if name in meta['fields'] else 'geometry' for name in names])
+                if seen is not None:
+                    table = seen.filter(self.layer, table)
+                self.write_table(table)
+
+    def close(self) -> None:
+        if self.sink is None:
+            return
+        self.sink.close()
+        self.sink = None
+        geometry_type = next(iter(self.geometry_types)) if len(self.geometry_types) == 1 else 'Unknown'
+        with pa.ipc.open_stream(self.buffer) as reader:
+            pyogrio.raw.write_arrow(reader, self.path, layer=self.layer, driver='FlatGeobuf', geometry_name='geometry',
+                                    geometry_type=geometry_type, crs=self.crs, SPATIAL_INDEX='YES')
+        os.remove(self.buffer)
+
+
+class OsmIdSet:
+    """
+    On-disk set of the OSM ids of the features added to each layer, used when combining files that are not
+    geopackages. A feature is skipped when an earlier source added its id, like feature_key does for geopackages.
+    The ids live in an indexed SQLite table in a temporary file, so the set can grow past the memory.
+    """
+
+    def __init__(self):
+        self.con = sqlite3.connect('', isolation_level=None)  # An empty path is a private temporary database on disk
+        self.con.execute('CREATE TABLE seen (layer TEXT, id TEXT, source INTEGER, PRIMARY KEY (layer, id)) '
+                         'WITHOUT ROWID')
+        self.con.execute('CREATE TABLE batch (pos INTEGER PRIMARY KEY, id TEXT)')
+        self.source = 0
+
+    def next_source(self) -> None:
+        """
+        The ids added from now on belong to the next source file
+        """
+        self.source += 1
+
+    def filter(self, layer: str, table: pa.Table) -> pa.Table:
+        """
+        Rows of an Arrow table whose OSM id was not added by an earlier source
+        """
+        keys = feature_keys(table)
+        if keys is None:
+            return table
+        self.con.execute('BEGIN')
+        self.con.execute('DELETE FROM batch')
+        self.con.executemany('INSERT INTO batch VALUES (?, ?)', enumerate(keys))
+        self.con.execute('INSERT OR IGNORE INTO seen SELECT ?, id, ? FROM batch WHERE id IS NOT NULL',
+                         (layer, self.source))
+        older = [pos for pos, in self.con.execute('SELECT b.pos FROM batch AS b JOIN seen AS s ON s.layer = ? '
+                                                  'AND s.id = b.id WHERE s.source < ?', (layer, self.source))]
+        self.con.execute('COMMIT')
+        if len(older) == 0:
+            return table
+        mask = np.ones(table.num_rows, dtype=bool)
+        mask[older] = False
+        return table.filter(pa.array(mask))
+
+    def close(self) -> None:
+        self.con.close()
+
+
+class TileLayerWriter(ParquetLayerWriter):
+    """
+    Stages a layer as {prefix}_{theme}_{feature}.tiles.parquet for the vector tile pyramid of tiles.build_mbtiles,
+    the staged files are removed once the MBTiles file is written
+    """
+
+    extension = 'tiles.parquet'
+
+
+class QueueLayerWriter(LayerWriter):
+    """
+    Sends the chunks of a layer to the output writer process as Arrow IPC streams with WKB geometry, see write_output
+    """
+
+    def __init__(self, queue: Any, theme: str, feature: str):
+        self.queue = queue
+        self.theme = theme
+        self.feature = feature
+        self.layer = f'{theme}_{feature}'
+        self.count = 0
+
+    def write(self, gdf: gpd.GeoDataFrame) -> None:
+        if len(gdf) == 0:
+            return
+        table = arrow_table(gdf)
+        table = table.replace_schema_metadata({'crs': gdf.crs.to_string() if gdf.crs is not None else ''})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as stream:
+            stream.write_table(table)
+        # Blocks while the writer process is behind
+        self.queue.put((self.theme, self.feature, sink.getvalue().to_pybytes()))
+        self.count += len(gdf)
+
+
+def arrow_table(gdf: gpd.GeoDataFrame) -> pa.Table:
+    """
+    Arrow table of a GeoDataFrame with the geometry as a WKB column named geometry
+    """
+    table = pa.Table.from_pandas(pd.DataFrame(gdf.drop(columns=gdf.geometry.name)), preserve_index=False)
+    # pandas picks the index width from the number of categories, one type keeps the chunks of a layer compatible
+    table = table.cast(pa.schema([pa.field(field.name, DICTIONARY) if pa.types.is_dictionary(field.type) else field
+                                  for field in table.schema], metadata=table.schema.metadata))
+    return table.append_column('geometry', pa.array(shapely.to_wkb(np.asarray(gdf.geometry.values)), pa.binary()))
+
+
+def read_batch(batch: bytes) -> gpd.GeoDataFrame:
+    """
+    GeoDataFrame of an Arrow IPC stream sent by QueueLayerWriter
+    """
+    table = pa.ipc.open_stream(batch).read_all()
+    crs = table.schema.metadata.get(b'crs', b'').decode() or None
+    geometry = shapely.from_wkb(table['geometry'].to_numpy(zero_copy_only=False))
+    # Keep the parsed numeric fields nullable instead of turning missing integers into NaN floats
+    columns = table.drop_columns(['geometry']).to_pandas(types_mapper=NULLABLE_TYPES.get)
+    return gpd.GeoDataFrame(columns, geometry=geometry, crs=crs)
+
+
+def write_output(queue: Any, path: str) -> None:
+    """
+    Writer process of the single output mode. Owns the output geopackage and writes the chunks of every theme layer
+    that the workers send through the queue into it, all layers share one connection and one load transaction.
+    Args:
+        queue: Bounded queue of (theme, feature, batch) items, None marks the end of the export
+        path: Path of the output geopackage
+
+    Returns:
+        None
+    """
+    begin_time = time.time()
+    folder, name = os.path.split(os.path.splitext(path)[0])
+    con = gpkg_connect(path)
+    con.execute('BEGIN')
+    writers = {}
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        theme, feature, batch = item
+        if (theme, feature) not in writers:
+            writers[(theme, feature)] = GpkgLayerWriter(folder, name, theme, feature, con=con)
+        writers[(theme, feature)].write(read_batch(batch))
+
+    for writer in writers.values():
+        writer.close()
+        print(f'\tWrote {writer.count:,} features to {writer.layer}')
+    con.execute('COMMIT')
+    con.close()
+    print(f'Finished writing {path} after {round(time.time() - begin_time, 1)} seconds')
+
+
+def set_output_queue(queue: Any) -> None:
+    """
+    Process pool initializer of the single output mode, a multiprocessing queue can only be handed to the workers when
+    they start
+    """
+    global OUTPUT_QUEUE
+    OUTPUT_QUEUE = queue
+
+
+def output_queue() -> Any:
+    return OUTPUT_QUEUE
+
+
+def start_output(path: str, queue_size: int = 8) -> multiprocessing.Process:
+    """
+    Start the writer process of the single output mode, the workers reach its queue through output_queue
+    Args:
+        path: Path of the output geopackage
+        queue_size: Batches the writer can fall behind before the workers wait
+
+    Returns:
+        The return value is the writer process, pass it to stop_output once every layer is sent
+    """
+    queue = multiprocessing.Queue(maxsize=queue_size)
+    process = multiprocessing.Process(target=write_output, args=(queue, path))
+    process.start()
+    set_output_queue(queue)
+    return process
+
+
+def stop_output(process: multiprocessing.Process) -> None:
+    OUTPUT_QUEUE.put(None)
+    process.join()
+    set_output_queue(None)
+
+
+class LayerBuilder:
+    """
+    Collects the fields of a layer's features and appends them to the layer writer every chunk_size features, so the
+    memory used to build a layer does not grow with the size of the theme. Fields listed in types are parsed into
+    nullable numeric or categorical columns when a chunk is written, see fields.read_field_types. The geometry of a
+    chunk can be simplified and snapped to a grid in one pass over the chunk, see reduce_geometry.
+    """
+
+    def __init__(self, writer: LayerWriter, fields: list, chunk_size: int = 50000, types: dict = None,
+                 precision: float = None, tolerance: float = None):
+        self.writer = writer
+        self.chunk_size = chunk_size
+        self.types = types or {}
+        self.precision = precision  # Grid size in degrees the coordinates are snapped to
+        self.tolerance = tolerance  # Topology preserving simplification tolerance in degrees
+        # Values of the category fields share one string object each instead of a copy per feature
+        self.categories = {field for field in fields if self.types.get(field) == 'category'}
+        self.interned = {}
+        self.flds = {field: [] for field in fields}
+        self.count = 0
+
+    def add(self, values: dict) -> None:
+        """
+        Add a feature, fields missing from values are left blank
+        Args:
+            values: Field values of the feature including its geometry
+
+        Returns:
+            None
+        """
+        for key in self.flds:
+            value = values.get(key, '')
+            if key in self.categories:
+                value = None if value == '' else self.interned.setdefault(value, value)
+            self.flds[key].append(value)
+        self.count += 1
+        if len(self.flds['geometry']) >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if len(self.flds['geometry']) > 0:
+            gdf = gpd.GeoDataFrame(typed_fields(self.flds, self.types), geometry='geometry')
+            gdf.set_crs(epsg=4326, inplace=True)
+            if self.precision or self.tolerance:
+                geometry = reduce_geometry(np.asarray(gdf.geometry.values), self.precision, self.tolerance)
+                gdf = gdf.set_geometry(gpd.GeoSeries(geometry, index=gdf.index, crs=gdf.crs, name='geometry'))
+                # Lines and rings that collapse on the grid are left out
+                gdf = gdf[~shapely.is_empty(geometry)]
+            self.writer.write(gdf)
+            self.flds = {field: [] for field in self.flds}
+
+    def close(self) -> None:
+        self.flush()
+        self.writer.close()
+
+
+def reduce_geometry(geometry: np.ndarray, precision: float = None, tolerance: float = None) -> np.ndarray:
+    """
+    Simplify and quantize an array of geometries with the vectorized shapely functions
+    Args:
+        geometry: Array of geometries
+        precision: Grid size the coordinates are snapped to, None keeps full precision
+        tolerance: Topology preserving simplification tolerance, None keeps every vertex
+
+    Returns:
+        The return value is the array of reduced geometries, geometries that collapse on the grid are empty
+    """
+    if tolerance:
+        geometry = shapely.simplify(geometry, tolerance, preserve_topology=True)
+    if precision:
+        # Snapping point by point is an order of magnitude faster than the default valid_output mode, only the
+        # collapsed lines and the polygons it leaves invalid are snapped again with the default mode
+        snapped = shapely.set_precision(geometry, precision, mode='pointwise')
+        invalid = np.flatnonzero((shapely.get_dimensions(snapped) > 0) & ~shapely.is_valid(snapped))
+        snapped[invalid] = shapely.set_precision(geometry[invalid], precision)
+        geometry = snapped
+    return geometry
+
+
+FORMATS = {'gpkg': GpkgLayerWriter, 'geoparquet': ParquetLayerWriter, 'fgb': FgbLayerWriter,
+           'mbtiles': TileLayerWriter}
+
+
+def layer_writer(output_format: str, folder: str, name: str, theme: str, feature: str) -> LayerWriter:
+    """
+    Open a writer for one layer of a theme
+    Args:
+        output_format: Key of FORMATS
+        folder: Output folder
+        name: File name without the extension
+        theme: Key theme from OSM
+        feature: point, line or polygon
+
+    Returns:
+        The return value is a LayerWriter, close it once every chunk is written
+    """
+    return FORMATS[output_format](folder, name, theme, feature)
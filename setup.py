@@ -57,6 +57,8 @@ setup(
     install_requires=[
         'Click',
         'geopandas',
+        'shapely>=2.0',
+        'pyarrow',
     ],
     entry_points='''
         [console_scripts]